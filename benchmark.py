@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the LlamaCpp Client Node
+Runs the node against a local stub llama-server, so no model or GPU is needed.
+
+    python benchmark.py                      # full run, JSON to stdout
+    python benchmark.py --quick -o bench.json
+
+Measures client overhead per call, throughput at several concurrency levels,
+memory allocated per request and streaming time-to-first-token. Results are a
+single JSON document, so runs from different commits can be diffed.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from llamacpp_client_node import LlamaCppClientNode
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Concurrency benchmarks open many connections at once
+    request_queue_size = 1024
+
+
+class StubLlamaServer:
+    """
+    Stand-in llama-server speaking the endpoints the node uses.
+
+    latency_ms:      delay before the first byte of every response (prompt processing)
+    token_rate:      generated tokens per second (0 = instant)
+    slots:           requests processed at once; the rest wait for a free slot
+    response_tokens: tokens generated when the request does not set n_predict/max_tokens
+    embedding_dim:   length of every embedding vector
+    n_ctx:           context size reported by /props
+    """
+
+    def __init__(self, latency_ms: float = 0.0, token_rate: float = 0.0, slots: int = 4,
+                 response_tokens: int = 16, embedding_dim: int = 768, n_ctx: int = 4096):
+        self.latency_ms = latency_ms
+        self.token_rate = token_rate
+        self.slots = slots
+        self.response_tokens = response_tokens
+        self.embedding_dim = embedding_dim
+        self.n_ctx = n_ctx
+        self.handled = deque(maxlen=100000)  # server-side handling time of each request, in ms
+        self.saved_slots = set()  # checkpoint filenames saved with /slots
+        self.disconnects = 0  # streams the client closed before they finished
+        self._slot_semaphore = threading.BoundedSemaphore(slots)
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def configure(self, **settings):
+        """Change stub behavior between benchmark runs."""
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError(f"Unknown stub setting: {name}")
+            setattr(self, name, value)
+        if "slots" in settings:
+            self._slot_semaphore = threading.BoundedSemaphore(self.slots)
+        self.handled.clear()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "StubLlamaServer":
+        stub = self
+
+        class Handler(StubHandler):
+            server_stub = stub
+
+        self._server = StubHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="stub-llama-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle + delayed ACK add ~40 ms per response
+    disable_nagle_algorithm = True
+    server_stub = None  # set per server by StubLlamaServer.start
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj: Any, status: int = 200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        stub = self.server_stub
+        path = urlsplit(self.path).path
+        if path == "/health":
+            return self._send_json({"status": "ok"})
+        if path == "/props":
+            return self._send_json({
+                "model_path": "/models/stub.gguf",
+                "total_slots": stub.slots,
+                "default_generation_settings": {"n_ctx": stub.n_ctx},
+            })
+        if path == "/slots":
+            return self._send_json([{"id": i, "n_ctx": stub.n_ctx, "is_processing": False} for i in range(stub.slots)])
+        self._send_json({"error": {"code": 404, "message": "File Not Found"}}, 404)
+
+    def do_POST(self):
+        stub = self.server_stub
+        started = time.perf_counter()
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json({"error": {"code": 400, "message": "Invalid JSON"}}, 400)
+
+        parts = urlsplit(self.path)
+        path = parts.path
+        try:
+            if path == "/tokenize":
+                return self._send_json(self._tokenize(body))
+            if path == "/detokenize":
+                tokens = [t for t in body.get("tokens", []) if isinstance(t, int)]
+                return self._send_json({"content": bytes(t % 256 for t in tokens).decode("utf-8", errors="replace")})
+            if path == "/apply-template":
+                messages = body.get("messages") or []
+                prompt = "".join(f"<|{m.get('role')}|>{m.get('content')}\n" for m in messages) + "<|assistant|>"
+                return self._send_json({"prompt": prompt})
+            if path.startswith("/slots/"):
+                return self._slot_action(int(path.rsplit("/", 1)[1]), parse_qs(parts.query).get("action", [""])[0],
+                                         body.get("filename", ""))
+
+            with stub._slot_semaphore:
+                time.sleep(stub.latency_ms / 1000.0)
+                if path == "/v1/embeddings":
+                    return self._send_json(self._embeddings(body))
+                if path == "/v1/rerank":
+                    return self._send_json(self._rerank(body))
+                if path in ("/completion", "/infill", "/v1/chat/completions"):
+                    return self._generate(path, body)
+            self._send_json({"error": {"code": 404, "message": "File Not Found"}}, 404)
+        finally:
+            stub.handled.append((time.perf_counter() - started) * 1000.0)
+
+    def _slot_action(self, slot: int, action: str, filename: str):
+        stub = self.server_stub
+        if action == "save":
+            stub.saved_slots.add(filename)
+            return self._send_json({"id_slot": slot, "filename": filename, "n_saved": stub.n_ctx // 2})
+        if action == "restore":
+            if filename not in stub.saved_slots:
+                return self._send_json({"error": {"code": 400, "message": "failed to restore slot"}}, 400)
+            return self._send_json({"id_slot": slot, "filename": filename, "n_restored": stub.n_ctx // 2})
+        if action == "erase":
+            return self._send_json({"id_slot": slot, "n_erased": 0})
+        self._send_json({"error": {"code": 400, "message": "Invalid action"}}, 400)
+
+    def _tokenize(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        tokens = list(str(body.get("content", "")).encode("utf-8"))
+        if body.get("with_pieces"):
+            # Like llama-server, pieces that are not valid UTF-8 on their own come back as byte lists
+            return {"tokens": [{"id": t, "piece": chr(t) if t < 128 else [t]} for t in tokens]}
+        return {"tokens": tokens}
+
+    def _embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        texts = body.get("input")
+        texts = texts if isinstance(texts, list) else [texts]
+        dim = self.server_stub.embedding_dim
+        data = []
+        for index, text in enumerate(texts):
+            seed = hashlib.blake2b(str(text).encode("utf-8"), digest_size=8).digest()
+            rng = np.random.default_rng(int.from_bytes(seed, "little"))
+            vector = rng.standard_normal(dim).astype(np.float32)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text)) for text in texts)
+        return {"object": "list", "data": data, "model": "stub",
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def _rerank(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        query = str(body.get("query", ""))
+        results = []
+        for index, document in enumerate(body.get("documents") or []):
+            overlap = len(set(query.lower().split()) & set(str(document).lower().split()))
+            results.append({"index": index, "relevance_score": overlap + 1.0 / (1 + len(str(document)))})
+        results.sort(key=lambda result: -result["relevance_score"])
+        top_n = body.get("top_n") or len(results)
+        return {"model": "stub", "object": "list", "results": results[:top_n]}
+
+    def _generate(self, path: str, body: Dict[str, Any]):
+        stub = self.server_stub
+        chat = path == "/v1/chat/completions"
+        n_predict = body.get("max_tokens" if chat else "n_predict", -1)
+        n_predict = stub.response_tokens if n_predict is None or n_predict < 0 else n_predict
+        prompt_n = len(json.dumps(body.get("messages") if chat else body.get("prompt", "")))
+        delay = 1.0 / stub.token_rate if stub.token_rate > 0 else 0.0
+        timings = {"prompt_n": prompt_n, "prompt_ms": stub.latency_ms,
+                   "predicted_n": n_predict, "predicted_ms": n_predict * delay * 1000.0}
+        pieces = [f"tok{i} " for i in range(n_predict)]
+
+        if not body.get("stream"):
+            time.sleep(n_predict * delay)
+            text = "".join(pieces)
+            if chat:
+                return self._send_json({
+                    "object": "chat.completion", "model": "stub",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "length"}],
+                    "usage": {"prompt_tokens": prompt_n, "completion_tokens": n_predict,
+                              "total_tokens": prompt_n + n_predict},
+                    "timings": timings,
+                })
+            return self._send_json({"content": text, "stop": True, "tokens_predicted": n_predict,
+                                    "tokens_evaluated": prompt_n, "timings": timings})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(delay)
+            if chat:
+                event = {"object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            else:
+                event = {"content": piece, "stop": False}
+            try:
+                self._send_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            except (BrokenPipeError, ConnectionResetError):
+                # Like llama-server, stop generating once the client has gone away
+                stub.disconnects += 1
+                self.close_connection = True
+                return
+        if chat:
+            final = {"object": "chat.completion.chunk", "timings": timings,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "length"}]}
+            self._send_chunk(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        else:
+            final = {"content": "", "stop": True, "tokens_evaluated": prompt_n, "timings": timings}
+            self._send_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+# Node inputs for one representative call per endpoint
+ENDPOINT_CALLS = {
+    "completion": {"prompt": "The quick brown fox", "n_predict": 16},
+    "chat_completions": {"user_message": "What is 2+2?", "max_tokens": 16},
+    "embeddings": {"input_text": "The quick brown fox jumps over the lazy dog"},
+    "tokenize": {"content": "The quick brown fox jumps over the lazy dog"},
+    "detokenize": {"tokens": "[84, 104, 101, 32, 113, 117, 105, 99, 107]"},
+    "apply_template": {"messages": '[{"role": "user", "content": "Hello"}]'},
+    "infill": {"input_prefix": "def add(a, b):\n    ", "input_suffix": "\n", "n_predict": 16},
+    "reranking": {"query": "fast fox", "documents": '["a fast fox", "a lazy dog", "slow turtle"]'},
+}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": round(at(0.50), 4),
+        "p95": round(at(0.95), 4),
+        "p99": round(at(0.99), 4),
+        "min": round(ordered[0], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def call(node: LlamaCppClientNode, stub: StubLlamaServer, endpoint: str, transport: str, **inputs):
+    inputs = dict(ENDPOINT_CALLS[endpoint], **inputs)
+    result = node.process_request(stub.url, endpoint, inputs.pop("prompt", ""), transport=transport,
+                                  raw_response_mode="off", **inputs)
+    if result[2] or result[3] >= 400:
+        raise RuntimeError(f"{endpoint} failed: {result[2]} ({result[3]})")
+    return result
+
+
+def bench_overhead(node: LlamaCppClientNode, stub: StubLlamaServer, transports: List[str],
+                   iterations: int) -> Dict[str, Any]:
+    """Client time per call that is not spent inside the server handler, per endpoint."""
+    stub.configure(latency_ms=0.0, token_rate=0.0)
+    results = {}
+    for transport in transports:
+        for endpoint in ENDPOINT_CALLS:
+            for _ in range(max(iterations // 10, 3)):
+                call(node, stub, endpoint, transport)
+            wall, overhead = [], []
+            for _ in range(iterations):
+                stub.handled.clear()
+                started = time.perf_counter()
+                call(node, stub, endpoint, transport)
+                elapsed = (time.perf_counter() - started) * 1000.0
+                wall.append(elapsed)
+                overhead.append(elapsed - sum(stub.handled))
+            results[f"{transport}/{endpoint}"] = {
+                "wall_ms": percentiles(wall),
+                "overhead_ms": percentiles(overhead),
+            }
+    return results
+
+
+def bench_throughput(node: LlamaCppClientNode, stub: StubLlamaServer, transports: List[str],
+                     levels: List[int], requests_per_level: int, latency_ms: float) -> Dict[str, Any]:
+    """Completed requests per second for a batch of completions at each concurrency level."""
+    stub.configure(latency_ms=latency_ms, token_rate=0.0, slots=max(levels))
+    prompts = json.dumps([f"prompt {i}" for i in range(requests_per_level)])
+    results = {}
+    for transport in transports:
+        for level in levels:
+            started = time.perf_counter()
+            call(node, stub, "completion", transport, batch_prompts=prompts, batch_concurrency=level)
+            elapsed = time.perf_counter() - started
+            results[f"{transport}/c{level}"] = {
+                "concurrency": level,
+                "requests": requests_per_level,
+                "seconds": round(elapsed, 4),
+                "requests_per_second": round(requests_per_level / elapsed, 2),
+                "ideal_requests_per_second": round(level * 1000.0 / latency_ms, 2) if latency_ms else None,
+            }
+    return results
+
+
+def bench_memory(node: LlamaCppClientNode, stub: StubLlamaServer, transports: List[str],
+                 iterations: int) -> Dict[str, Any]:
+    """Peak Python memory allocated while handling one request (tracemalloc), per workload."""
+    stub.configure(latency_ms=0.0, token_rate=0.0, response_tokens=512, embedding_dim=4096)
+    workloads = {
+        "completion_512_tokens": ("completion", {"n_predict": 512}),
+        "embeddings_4096_dim": ("embeddings", {}),
+        "batch_16_completions": ("completion", {"batch_prompts": json.dumps([f"p{i}" for i in range(16)]),
+                                               "n_predict": 64}),
+    }
+    results = {}
+    for transport in transports:
+        for name, (endpoint, inputs) in workloads.items():
+            call(node, stub, endpoint, transport, **inputs)
+            peaks = []
+            for _ in range(iterations):
+                tracemalloc.start()
+                call(node, stub, endpoint, transport, **inputs)
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+                tracemalloc.stop()
+            results[f"{transport}/{name}"] = {"peak_kib": percentiles(peaks)}
+    stub.configure(response_tokens=16, embedding_dim=768)
+    return results
+
+
+def bench_streaming(node: LlamaCppClientNode, stub: StubLlamaServer, transports: List[str],
+                    iterations: int, latency_ms: float, token_rate: float) -> Dict[str, Any]:
+    """Time to first token and total time of streamed chat completions."""
+    stub.configure(latency_ms=latency_ms, token_rate=token_rate)
+    delay_ms = 1000.0 / token_rate if token_rate > 0 else 0.0
+    results = {}
+    for transport in transports:
+        ttft, total = [], []
+        for _ in range(iterations):
+            response = call(node, stub, "chat_completions", transport, stream=True, max_tokens=32)[0]
+            stats = json.loads(response)["stream_stats"] if isinstance(response, str) else response["stream_stats"]
+            ttft.append(stats["ttft_ms"])
+            total.append(stats["total_ms"])
+        results[transport] = {
+            "ttft_ms": percentiles(ttft),
+            "total_ms": percentiles(total),
+            "server_first_token_ms": latency_ms,
+            "server_total_ms": round(latency_ms + 31 * delay_ms, 3),
+        }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the LlamaCpp Client Node")
+    parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations, for a fast sanity check")
+    parser.add_argument("--transport", choices=["requests", "asyncio", "both"], default="both")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stub latency for throughput/streaming runs")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Stub streaming tokens per second")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="Comma-separated concurrency levels")
+    args = parser.parse_args(argv)
+
+    transports = ["requests", "asyncio"] if args.transport == "both" else [args.transport]
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    iterations = 20 if args.quick else 200
+
+    node = LlamaCppClientNode()
+    with StubLlamaServer() as stub:
+        started = time.time()
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "started": round(started, 3),
+                "quick": args.quick,
+                "latency_ms": args.latency_ms,
+                "token_rate": args.token_rate,
+            },
+            "overhead": bench_overhead(node, stub, transports, iterations),
+            "throughput": bench_throughput(node, stub, transports, levels, 64 if args.quick else 256,
+                                           args.latency_ms),
+            "memory": bench_memory(node, stub, transports, 5 if args.quick else 20),
+            "streaming": bench_streaming(node, stub, transports, 5 if args.quick else 30,
+                                         args.latency_ms, args.token_rate),
+        }
+        report["meta"]["duration_s"] = round(time.time() - started, 3)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+"""llama-server client for ComfyUI, split by concern: transport, lb, cache, index, telemetry and nodes."""
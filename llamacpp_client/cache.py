@@ -0,0 +1,681 @@
+"""Process-wide caches: server props, responses, in-flight requests, images, cassettes and tokens."""
+
+import asyncio
+import requests
+import base64
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Union
+import io
+import numpy as np
+from PIL import Image
+
+from .util import canonical_hash, canonical_json, endpoint_path, json_dumps_bytes, json_loads, run_bounded
+from .transport import SESSIONS, SessionRegistry, interrupt_requested
+from .lb import BALANCERS
+
+
+class ServerPropsCache:
+    """
+    Short-lived cache of each server's `/props`, used to identify the loaded model.
+    """
+    
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._props = {}  # base_url -> (fetched_at, props)
+        self._recorded = set()  # (cassette path, props hash) already in a cassette
+    
+    def get(self, url: str, api_key: str = "", timeout: float = 10,
+            options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Return `/props` for the server `url` points at ({} if unavailable)."""
+        options = options or {}
+        mode = options.get("cassette_mode", "off")
+        cassette = CASSETTES.get(options["cassette_path"]) if mode != "off" and options.get("cassette_path") else None
+        key = Cassette.request_key("/props", None)
+        if cassette is not None and mode in ("replay", "replay_or_live"):
+            entry = cassette.get(key)
+            if entry is not None:
+                return entry["response"]
+            if mode == "replay":
+                return {}
+        
+        base_url = SessionRegistry.base_url(BALANCERS.concrete(url))
+        with self._lock:
+            cached = self._props.get(base_url)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            props = cached[1]
+        elif interrupt_requested():
+            return {}
+        else:
+            headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+            try:
+                response = SESSIONS.get(base_url).get(f"{base_url}/props", headers=headers, timeout=timeout)
+                props = response.json() if response.status_code == 200 else {}
+            except (requests.exceptions.RequestException, ValueError):
+                props = {}
+            with self._lock:
+                self._props[base_url] = (time.monotonic(), props)
+        
+        if cassette is not None and props:
+            recorded = (cassette.path, canonical_hash(props))
+            with self._lock:
+                fresh = recorded not in self._recorded
+                self._recorded.add(recorded)
+            if fresh:
+                cassette.put(key, {"endpoint": "/props", "request": None, "status_code": 200, "response": props})
+        return props
+    
+    def cached(self, url: str, options: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """`/props` if `get` would answer from memory without any I/O, else None."""
+        if (options or {}).get("cassette_mode", "off") != "off":
+            return None
+        with self._lock:
+            cached = self._props.get(SessionRegistry.base_url(BALANCERS.concrete(url)))
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+    
+    def model_identity(self, url: str, api_key: str = "", timeout: float = 10,
+                       options: Optional[Dict[str, Any]] = None) -> str:
+        """A string that changes whenever the server loads a different model."""
+        return self.identity(self.get(url, api_key, timeout, options))
+    
+    @staticmethod
+    def identity(props: Dict[str, Any]) -> str:
+        """`model_identity` of already fetched `/props`."""
+        settings = props.get("default_generation_settings") or {}
+        return canonical_json([
+            props.get("model_path") or props.get("model_alias") or "",
+            settings.get("n_ctx") or props.get("n_ctx"),
+            props.get("build_info", ""),
+        ])
+    
+    def invalidate(self, url: Optional[str] = None):
+        with self._lock:
+            if url is None:
+                self._props.clear()
+            else:
+                self._props.pop(SessionRegistry.base_url(BALANCERS.concrete(url)), None)
+
+
+PROPS = ServerPropsCache()
+
+
+class ResponseCache:
+    """
+    Two-tier cache for deterministic responses: a bounded in-memory LRU with TTL and an
+    optional SQLite file that several ComfyUI processes can share.
+    """
+    
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (expires_at, value as JSON)
+        self._db = None
+        self._db_path = ""
+        self.counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0,
+                         "stores": 0, "evictions": 0, "expirations": 0}
+    
+    def configure(self, max_entries: Optional[int] = None, db_path: Optional[str] = None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+                self._trim_locked()
+            if db_path is not None and db_path != self._db_path:
+                if self._db is not None:
+                    self._db.close()
+                    self._db = None
+                self._db_path = db_path
+                if db_path:
+                    self._db = self._open_db(db_path)
+    
+    @property
+    def persistent(self) -> bool:
+        """Whether lookups may read the SQLite file (blocking I/O) rather than only memory."""
+        return self._db is not None
+    
+    @staticmethod
+    def _open_db(path: str) -> sqlite3.Connection:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, expires_at REAL, value TEXT NOT NULL)"
+        )
+        return db
+    
+    def get(self, key: str):
+        """Return a fresh copy of the cached value for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            blob = self._lookup_locked(key, now)
+        # Every hit decodes its own copy, so callers may modify what they get
+        return json_loads(blob) if blob is not None else None
+    
+    def _lookup_locked(self, key: str, now: float) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] and entry[0] < now:
+                del self._memory[key]
+                self.counters["expirations"] += 1
+            else:
+                self._memory.move_to_end(key)
+                self.counters["hits"] += 1
+                self.counters["memory_hits"] += 1
+                return entry[1]
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT expires_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if row[0] and row[0] < now:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.counters["expirations"] += 1
+                else:
+                    self._memory[key] = (row[0], row[1])
+                    self._trim_locked()
+                    self.counters["hits"] += 1
+                    self.counters["disk_hits"] += 1
+                    return row[1]
+        self.counters["misses"] += 1
+        return None
+    
+    def put(self, key: str, value: Any, ttl: float = 0):
+        """Store `value` as JSON, in memory as on disk."""
+        expires_at = time.time() + ttl if ttl > 0 else 0
+        blob = json_dumps_bytes(value).decode("utf-8")
+        with self._lock:
+            self._memory[key] = (expires_at, blob)
+            self._memory.move_to_end(key)
+            self._trim_locked()
+            self.counters["stores"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires_at, value) VALUES (?, ?, ?)",
+                    (key, expires_at, blob))
+    
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["db_path"] = self._db_path
+            return stats
+    
+    def _trim_locked(self):
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests: the first caller sends, later callers with the same
+    key wait for its result. `run` serves coroutines on the shared event loop, `call` plain threads.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> asyncio.Future
+        self._waiting = {}  # key -> [threading.Event, outcome]
+        self.counters = {"leaders": 0, "shared": 0}
+    
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+    
+    async def run(self, key: str, factory):
+        """Return the result of `factory()`, shared with concurrent callers using the same key."""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._count("shared")
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The leader was cancelled; this caller still wants an answer
+                return await self.run(key, factory)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self._count("leaders")
+        try:
+            result = await factory()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Followers re-raise it; mark it retrieved so an unshared failure is not logged twice
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+    
+    def call(self, key: str, fn):
+        """Return the result of `fn()`, shared with concurrent threads using the same key."""
+        with self._lock:
+            waiter = self._waiting.get(key)
+            leader = waiter is None
+            if leader:
+                waiter = self._waiting[key] = [threading.Event(), None]
+            self.counters["leaders" if leader else "shared"] += 1
+        if not leader:
+            waiter[0].wait()
+            result, error = waiter[1]
+            if error is None:
+                return result
+            if not isinstance(error, Exception):
+                # The leader was interrupted; this caller still wants an answer
+                return self.call(key, fn)
+            raise error
+        
+        waiter[1] = (None, RuntimeError("request was abandoned"))
+        try:
+            waiter[1] = (fn(), None)
+            return waiter[1][0]
+        except BaseException as e:
+            waiter[1] = (None, e)
+            raise
+        finally:
+            with self._lock:
+                self._waiting.pop(key, None)
+            waiter[0].set()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._in_flight) + len(self._waiting)
+            return stats
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+class ImageEncoder:
+    """
+    Encodes ComfyUI IMAGE tensors ([batch, height, width, channels], floats in 0-1) to base64
+    JPEG/PNG. Frames are encoded on a thread pool and memoized by content hash, bounded by size.
+    """
+    
+    def __init__(self, max_cache_bytes: int = 256 * 1024 * 1024, workers: int = 4):
+        self.max_cache_bytes = max_cache_bytes
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # content hash -> base64 string
+        self._cache_bytes = 0
+        self.counters = {"hits": 0, "encoded": 0}
+    
+    def encode(self, image: Any, max_size: int = 1024, image_format: str = "JPEG", quality: int = 90) -> List[str]:
+        """Base64 payload for every frame of `image`, in batch order."""
+        if hasattr(image, "cpu"):
+            image = image.detach().cpu().numpy()
+        frames = np.asarray(image, dtype=np.float32)
+        if frames.ndim == 3:
+            frames = frames[None]
+        
+        def encode_frame(frame: np.ndarray) -> str:
+            digest = hashlib.blake2b(np.ascontiguousarray(frame).data, digest_size=16).hexdigest()
+            key = f"{digest}:{frame.shape}:{max_size}:{image_format}:{quality}"
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return cached
+            encoded = self._encode_frame(frame, max_size, image_format, quality)
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = encoded
+                    self._cache_bytes += len(encoded)
+                    self.counters["encoded"] += 1
+                    while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+                        _, evicted = self._cache.popitem(last=False)
+                        self._cache_bytes -= len(evicted)
+            return encoded
+        
+        return run_bounded(encode_frame, list(frames), self.workers)
+    
+    @staticmethod
+    def _encode_frame(frame: np.ndarray, max_size: int, image_format: str, quality: int) -> str:
+        pixels = np.clip(frame * 255.0, 0, 255).astype(np.uint8)
+        if pixels.shape[-1] == 1:
+            pixels = pixels[..., 0]
+        picture = Image.fromarray(pixels)
+        if image_format == "JPEG" and picture.mode not in ("RGB", "L"):
+            picture = picture.convert("RGB")
+        if max_size > 0 and max(picture.size) > max_size:
+            picture.thumbnail((max_size, max_size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if image_format == "JPEG":
+            picture.save(buffer, format="JPEG", quality=quality)
+        else:
+            picture.save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["cached_images"] = len(self._cache)
+            stats["cached_bytes"] = self._cache_bytes
+            return stats
+
+
+IMAGE_ENCODER = ImageEncoder()
+
+
+class Cassette:
+    """
+    Recorded llama-server exchanges in an append-only file with a fixed-size index for replay.
+    """
+    
+    KEY_SIZE = 16
+    INDEX_RECORD = struct.Struct("<16sQI")
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._lock = threading.Lock()
+        self._index = {}  # key -> (offset, length); later recordings of a request win
+        self.counters = {"hits": 0, "misses": 0, "recorded": 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._load()
+    
+    @classmethod
+    def request_key(cls, url: str, data: Dict[str, Any]) -> bytes:
+        # The server address is left out so a cassette replays against any server
+        return bytes.fromhex(canonical_hash(endpoint_path(url), data))[:cls.KEY_SIZE]
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                records = f.read()
+            usable = len(records) - len(records) % self.INDEX_RECORD.size
+            for key, offset, length in self.INDEX_RECORD.iter_unpack(records[:usable]):
+                # A crash between the cassette and index writes can leave a dangling record
+                if offset + length <= size:
+                    self._index[key] = (offset, length)
+            return
+        self._rebuild_index()
+    
+    def _rebuild_index(self):
+        records = []
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    key = bytes.fromhex(json_loads(line)["key"])
+                except (ValueError, KeyError, TypeError):
+                    offset += len(line)
+                    continue
+                self._index[key] = (offset, len(line))
+                records.append(self.INDEX_RECORD.pack(key, offset, len(line)))
+                offset += len(line)
+        with open(self.index_path, "wb") as f:
+            f.write(b"".join(records))
+    
+    def __len__(self) -> int:
+        return len(self._index)
+    
+    def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        """The recorded entry for `key`, or None."""
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            with open(self.path, "rb") as f:
+                f.seek(location[0])
+                line = f.read(location[1])
+        return json_loads(line)
+    
+    def put(self, key: bytes, entry: Dict[str, Any]):
+        """Append one exchange; it replaces any earlier recording of the same request."""
+        line = json_dumps_bytes(dict(entry, key=key.hex())) + b"\n"
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+            with open(self.index_path, "ab") as f:
+                f.write(self.INDEX_RECORD.pack(key, offset, len(line)))
+            self._index[key] = (offset, len(line))
+            self.counters["recorded"] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counters, entries=len(self._index))
+
+
+class CassetteRegistry:
+    """Opens each cassette file once and shares it process-wide."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cassettes = {}
+    
+    def get(self, path: str) -> Cassette:
+        path = os.path.abspath(os.path.expanduser(path))
+        with self._lock:
+            cassette = self._cassettes.get(path)
+            if cassette is None:
+                cassette = Cassette(path)
+                self._cassettes[path] = cassette
+            return cassette
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {path: cassette.stats() for path, cassette in self._cassettes.items()}
+
+
+CASSETTES = CassetteRegistry()
+
+
+class TokenCache:
+    """
+    Bounded LRU of tokenizations and detokenizations keyed by content hash and model identity.
+    """
+    
+    def __init__(self, max_tokens: int = 16_000_000):
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> array('i') or str
+        self._size = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+    
+    @staticmethod
+    def tokenize_key(identity: str, content: str, add_special: bool, parse_special: bool) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(canonical_json(["tokenize", identity, add_special, parse_special]).encode("utf-8"))
+        digest.update(content.encode("utf-8"))
+        return digest.digest()
+    
+    @staticmethod
+    def detokenize_key(identity: str, tokens: array) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(canonical_json(["detokenize", identity]).encode("utf-8"))
+        digest.update(tokens.tobytes())
+        return digest.digest()
+    
+    @staticmethod
+    def _weight(value: Union[array, str]) -> int:
+        # Detokenized text is weighed at roughly four characters per token
+        return len(value) if isinstance(value, array) else len(value) // 4 + 1
+    
+    def get(self, key: bytes) -> Optional[Union[array, str]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+    
+    def peek(self, key: bytes) -> Optional[Union[array, str]]:
+        """Look up `key` without counting a hit or miss or refreshing its LRU position."""
+        with self._lock:
+            return self._entries.get(key)
+    
+    def put(self, key: bytes, value: Union[array, str]):
+        weight = self._weight(value)
+        if weight > self.max_tokens:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= self._weight(previous)
+            self._entries[key] = value
+            self._size += weight
+            while self._size > self.max_tokens:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._weight(evicted)
+                self.counters["evictions"] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+            stats["tokens"] = self._size
+            return stats
+
+
+TOKEN_CACHE = TokenCache()
+
+
+# Tokens a chat template adds around each message (role markers, separators); an estimate
+CHAT_MESSAGE_OVERHEAD = 4
+SUMMARY_INSTRUCTION = ("Summarize the following conversation in a few sentences. Keep names, facts, decisions "
+                       "and open questions; answer with the summary only.")
+
+
+class MessageTokenCounter:
+    """
+    Memoized token counts of chat messages and summaries of dropped turns.
+    """
+    
+    def __init__(self, max_entries: int = 65536, timeout: float = 30.0, summary_timeout: float = 300.0):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.summary_timeout = summary_timeout
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()  # digest -> token count
+        self._summaries = OrderedDict()  # digest -> summary text
+        self.counters = {"hits": 0, "misses": 0, "estimated": 0, "summaries": 0, "summary_hits": 0}
+    
+    @staticmethod
+    def message_text(message: Dict[str, Any]) -> str:
+        """The text of a message that the chat template renders (image parts are not counted)."""
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text") or "" for part in content if isinstance(part, dict))
+        elif not isinstance(content, str):
+            content = "" if content is None else canonical_json(content)
+        if message.get("tool_calls"):
+            content += canonical_json(message["tool_calls"])
+        return content
+    
+    def count(self, send, messages: List[Dict[str, Any]], identity: str) -> List[int]:
+        """Token count of every message, tokenizing only the ones not seen before."""
+        counts = []
+        for message in messages:
+            text = self.message_text(message)
+            key = hashlib.blake2b(canonical_json([identity, message.get("role"), text]).encode("utf-8"),
+                                  digest_size=16).digest()
+            with self._lock:
+                count = self._counts.get(key)
+                if count is not None:
+                    self._counts.move_to_end(key)
+                    self.counters["hits"] += 1
+            if count is None:
+                tokens = self._tokenize(send, text)
+                if tokens is None:
+                    # Rough bytes-per-token estimate; not cached so the next run asks the server again
+                    with self._lock:
+                        self.counters["estimated"] += 1
+                    count = len(text.encode("utf-8")) // 3 + CHAT_MESSAGE_OVERHEAD
+                else:
+                    count = tokens + CHAT_MESSAGE_OVERHEAD
+                    with self._lock:
+                        self.counters["misses"] += 1
+                        self._counts[key] = count
+                        while len(self._counts) > self.max_entries:
+                            self._counts.popitem(last=False)
+            counts.append(count)
+        return counts
+    
+    def _tokenize(self, send, text: str) -> Optional[int]:
+        if not text:
+            return 0
+        response, _, error, status_code = send("/tokenize", {"content": text, "add_special": False}, self.timeout)
+        if error or status_code != 200 or not isinstance(response, dict):
+            return None
+        return len(response.get("tokens") or [])
+    
+    def summary(self, send, messages: List[Dict[str, Any]], identity: str, max_tokens: int,
+                model: str = "default") -> Optional[str]:
+        """A summary of `messages` written by the server's model (None if it could not be produced)."""
+        key = hashlib.blake2b(canonical_json([identity, max_tokens, messages]).encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+                self.counters["summary_hits"] += 1
+                return summary
+        transcript = "\n\n".join(f"{message.get('role', 'user')}: {self.message_text(message)}" for message in messages)
+        body = {
+            "model": model or "default",
+            "messages": [{"role": "system", "content": SUMMARY_INSTRUCTION}, {"role": "user", "content": transcript}],
+            "max_tokens": max_tokens,
+            "temperature": 0,
+        }
+        response, _, error, status_code = send("/v1/chat/completions", body, self.summary_timeout)
+        if error or status_code != 200:
+            return None
+        try:
+            summary = (response["choices"][0]["message"].get("content") or "").strip()
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return None
+        if not summary:
+            return None
+        with self._lock:
+            self.counters["summaries"] += 1
+            self._summaries[key] = summary
+            while len(self._summaries) > 1024:
+                self._summaries.popitem(last=False)
+        return summary
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._counts)
+            return stats
+
+
+TOKEN_COUNTS = MessageTokenCounter()
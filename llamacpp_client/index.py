@@ -0,0 +1,534 @@
+"""Embedding storage and search: append-only arrays, the embedding store and the vector index."""
+
+import ast
+import base64
+import hashlib
+import os
+import struct
+import threading
+from typing import Dict, Any, List, Optional
+import numpy as np
+
+from .util import json_dumps_bytes, json_loads
+
+
+def decode_embedding(embedding: Any) -> np.ndarray:
+    """Decode one embedding from a llama-server response into a float32 vector."""
+    if isinstance(embedding, str):
+        # encoding_format=base64: little-endian float32, decoded without building a Python list
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    vector = np.asarray(embedding, dtype=np.float32)
+    if vector.ndim != 1:
+        raise ValueError("Expected a pooled embedding; the server returned per-token vectors")
+    return vector
+
+
+class AppendOnlyArray:
+    """
+    A `.npy` file that only grows, read through a memory map. Not thread-safe.
+    """
+    
+    HEADER_SIZE = 128
+    
+    def __init__(self, path: str, dtype: str = "<f4"):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.row_shape = None  # () for a vector file, (dim,) for a matrix; None until the first write
+        self._view = None
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(8)
+                header_len = struct.unpack("<H", f.read(2))[0]
+                header = ast.literal_eval(f.read(header_len).decode("latin1"))
+            self.rows = header["shape"][0]
+            self.row_shape = tuple(header["shape"][1:])
+    
+    @property
+    def row_bytes(self) -> int:
+        return int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+    
+    def _header(self, rows: int) -> bytes:
+        text = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (self.dtype.str, (rows,) + self.row_shape)
+        body_len = self.HEADER_SIZE - 10
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", body_len) + text.ljust(body_len - 1).encode("latin1") + b"\n"
+    
+    def write(self, data: np.ndarray) -> int:
+        """Write `data` after the committed rows without committing it; returns the row count to commit."""
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        if self.row_shape is None:
+            self.row_shape = tuple(data.shape[1:])
+            with open(self.path, "wb") as f:
+                f.write(self._header(0))
+        elif tuple(data.shape[1:]) != self.row_shape:
+            raise ValueError(f"Row shape {tuple(data.shape[1:])} does not match {self.path} {self.row_shape}")
+        with open(self.path, "r+b") as f:
+            f.seek(self.HEADER_SIZE + self.rows * self.row_bytes)
+            f.write(data.tobytes())
+        return self.rows + len(data)
+    
+    def commit(self, rows: int):
+        """Make the first `rows` rows the file's contents by rewriting the header."""
+        with open(self.path, "r+b") as f:
+            f.write(self._header(rows))
+        self.rows = rows
+        self._view = None
+    
+    def append(self, data: np.ndarray):
+        self.commit(self.write(data))
+    
+    def truncate(self, rows: int):
+        """Cut the file back to its first `rows` rows, dropping anything a crash left behind."""
+        size = self.HEADER_SIZE + rows * self.row_bytes
+        if rows != self.rows or os.path.getsize(self.path) > size:
+            with open(self.path, "r+b") as f:
+                f.write(self._header(rows))
+                f.truncate(size)
+            self.rows = rows
+            self._view = None
+    
+    def view(self) -> np.ndarray:
+        """The committed rows, memory-mapped read-only; a new map after every commit."""
+        if not self.rows:
+            return np.zeros((0,) + (self.row_shape or ()), dtype=self.dtype)
+        if self._view is None:
+            self._view = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.HEADER_SIZE,
+                                   shape=(self.rows,) + self.row_shape)
+        return self._view
+
+
+class EmbeddingStore:
+    """
+    Content-addressed, memory-mapped embedding store for one model.
+    """
+    
+    KEY_SIZE = 16
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.index_path = os.path.join(directory, "index.bin")
+        self._lock = threading.RLock()
+        self._index = {}  # content hash -> row
+        self._rows = 0
+        self._dim = None
+        os.makedirs(directory, exist_ok=True)
+        self._vectors = AppendOnlyArray(self.vectors_path)
+        self._load()
+    
+    @classmethod
+    def content_key(cls, text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()[:cls.KEY_SIZE]
+    
+    def _load(self):
+        if self._vectors.row_shape is None:
+            return
+        self._dim = self._vectors.row_shape[0]
+        keys = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                keys = f.read()
+        # A crash between the vector and index writes leaves extra rows or keys; cut both back
+        # to the rows they agree on so the next append lines keys up with their vectors again
+        self._rows = min(self._vectors.rows, len(keys) // self.KEY_SIZE)
+        if len(keys) > self._rows * self.KEY_SIZE:
+            with open(self.index_path, "r+b") as f:
+                f.truncate(self._rows * self.KEY_SIZE)
+        self._vectors.truncate(self._rows)
+        for row in range(self._rows):
+            self._index[keys[row * self.KEY_SIZE:(row + 1) * self.KEY_SIZE]] = row
+    
+    def __len__(self) -> int:
+        return self._rows
+    
+    def lookup(self, keys: List[bytes]) -> List[Optional[int]]:
+        """Row number for each key, or None for misses."""
+        with self._lock:
+            return [self._index.get(key) for key in keys]
+    
+    def vectors(self, rows: List[int]) -> np.ndarray:
+        """Copy the given rows out of the memory map."""
+        with self._lock:
+            return np.array(self._vectors.view()[rows], dtype=np.float32)
+    
+    def add(self, keys: List[bytes], matrix: np.ndarray):
+        """Append vectors whose keys are not stored yet."""
+        matrix = np.ascontiguousarray(matrix, dtype="<f4")
+        with self._lock:
+            fresh = []
+            seen = set()
+            for position, key in enumerate(keys):
+                if key not in self._index and key not in seen:
+                    fresh.append(position)
+                    seen.add(key)
+            if not fresh:
+                return
+            if self._dim is not None and matrix.shape[1] != self._dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store ({self._dim})")
+            
+            # Vectors, then their keys, then the header that makes both visible
+            rows = self._vectors.write(matrix[fresh])
+            with open(self.index_path, "ab") as index_file:
+                index_file.write(b"".join(keys[position] for position in fresh))
+            self._vectors.commit(rows)
+            
+            self._dim = int(matrix.shape[1])
+            for offset, position in enumerate(fresh):
+                self._index[keys[position]] = self._rows + offset
+            self._rows += len(fresh)
+
+
+class EmbeddingStoreRegistry:
+    """Opens one EmbeddingStore per (directory, model identity) and shares it process-wide."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stores = {}
+    
+    def get(self, directory: str, model_identity: str) -> EmbeddingStore:
+        path = os.path.join(os.path.abspath(directory), hashlib.sha256(model_identity.encode("utf-8")).hexdigest()[:16])
+        with self._lock:
+            store = self._stores.get(path)
+            if store is None:
+                store = EmbeddingStore(path)
+                self._stores[path] = store
+            return store
+
+
+EMBEDDING_STORES = EmbeddingStoreRegistry()
+
+
+class VectorIndex:
+    """
+    Cosine-similarity index over normalized float32 rows with exact and IVF search,
+    optionally persisted to memory-mapped `.npy` files.
+    """
+    
+    BLOCK_ROWS = 65536
+    # Training points per list below which k-means centroids are not meaningful
+    MIN_TRAIN_PER_LIST = 39
+    
+    def __init__(self, directory: Optional[str] = None, reset: bool = False):
+        self.directory = directory
+        self.model_identity = None
+        self._lock = threading.RLock()
+        # In memory: capacity-sized, rows past _rows are unused. With a directory: the memory map
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._rows = 0
+        self._texts = []
+        self._keys = {}  # content hash -> row
+        self._centroids = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._trained_rows = 0
+        self._lists = None
+        self._store = None
+        self._assignment_file = None
+        self._generation = 0  # IVF files on disk are `centroids-<generation>.npy` / `assignments-<generation>.npy`
+        self._ivf_saved = True  # whether the IVF layer in memory is the one on disk
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            if reset:
+                self._remove_files()
+            self._store = AppendOnlyArray(self._path("vectors.npy"))
+            if self._store.row_shape is not None:
+                self._load()
+    
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+    
+    def _remove_files(self):
+        for name in os.listdir(self.directory):
+            if name in ("vectors.npy", "texts.jsonl", "meta.json") or name.startswith(("centroids-", "assignments-")):
+                os.remove(self._path(name))
+    
+    def __len__(self) -> int:
+        return self._rows
+    
+    @property
+    def dim(self) -> Optional[int]:
+        return int(self._vectors.shape[1]) if self._rows else None
+    
+    @staticmethod
+    def normalize(matrix: np.ndarray) -> np.ndarray:
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+    
+    def text(self, row: int) -> str:
+        return self._texts[row]
+    
+    def missing(self, texts: List[str]) -> List[int]:
+        """Positions of the texts that are not indexed yet."""
+        with self._lock:
+            return [i for i, text in enumerate(texts) if EmbeddingStore.content_key(text) not in self._keys]
+    
+    def add(self, texts: List[str], matrix: np.ndarray, model_identity: Optional[str] = None) -> int:
+        """Add the vectors of texts not indexed yet; returns how many rows were added."""
+        matrix = self.normalize(matrix)
+        if len(texts) != len(matrix):
+            raise ValueError(f"{len(texts)} texts but {len(matrix)} vectors")
+        with self._lock:
+            if model_identity:
+                if self.model_identity and self.model_identity != model_identity:
+                    raise ValueError("The index holds embeddings of a different model")
+                self.model_identity = model_identity
+            if self._rows and matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match index ({self.dim})")
+            fresh = []
+            keys = {}  # content hash -> row of the texts added now
+            for position, text in enumerate(texts):
+                key = EmbeddingStore.content_key(text)
+                if key not in self._keys and key not in keys:
+                    keys[key] = self._rows + len(fresh)
+                    fresh.append(position)
+            if not fresh:
+                return 0
+            
+            end = self._rows + len(fresh)
+            assignments = None
+            if self._centroids is not None:
+                assignments = self._nearest(matrix[fresh], self._centroids)
+            if self._store is not None:
+                self._append_files(matrix[fresh], [texts[position] for position in fresh], assignments)
+            else:
+                self._reserve(end, matrix.shape[1])
+                self._vectors[self._rows:end] = matrix[fresh]
+            # Only rows that were stored become visible, so a failed append can simply be retried
+            if assignments is not None:
+                self._assignments = np.concatenate([self._assignments, assignments])
+                self._lists = None
+            self._keys.update(keys)
+            self._texts.extend(texts[position] for position in fresh)
+            self._rows = end
+            return len(fresh)
+    
+    def _reserve(self, rows: int, dim: int):
+        # Grow by doubling
+        if rows > len(self._vectors):
+            capacity = max(rows, 2 * len(self._vectors), 1024)
+            grown = np.empty((capacity, dim), dtype=np.float32)
+            if self._rows:
+                grown[:self._rows] = self._vectors[:self._rows]
+            self._vectors = grown
+    
+    def _append_files(self, vectors: np.ndarray, texts: List[str], assignments: Optional[np.ndarray]):
+        """Append rows to disk: vectors, then texts, then the header that commits them."""
+        rows = self._store.write(vectors)
+        with open(self._path("texts.jsonl"), "ab") as f:
+            f.write(b"".join(json_dumps_bytes(text) + b"\n" for text in texts))
+        self._store.commit(rows)
+        self._vectors = self._store.view()
+        if assignments is not None and self._ivf_saved and self._assignment_file is not None:
+            self._assignment_file.append(assignments)
+    
+    @classmethod
+    def _nearest(cls, data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Index of the most similar centroid for every row, computed in blocks."""
+        assignments = np.empty(len(data), dtype=np.int32)
+        for start in range(0, len(data), cls.BLOCK_ROWS):
+            assignments[start:start + cls.BLOCK_ROWS] = np.argmax(data[start:start + cls.BLOCK_ROWS] @ centroids.T, axis=1)
+        return assignments
+    
+    def needs_training(self, nlist: int) -> bool:
+        """Whether IVF with `nlist` lists should be (re)trained: new list count, or 4x growth since training."""
+        if nlist <= 0 or self._rows < nlist * self.MIN_TRAIN_PER_LIST:
+            return False
+        return self._centroids is None or len(self._centroids) != nlist or self._rows > 4 * self._trained_rows
+    
+    def train(self, nlist: int, iterations: int = 10, seed: int = 0):
+        """Cluster the vectors into `nlist` lists with spherical k-means on a sample of at most 256 per list."""
+        with self._lock:
+            data = self._vectors[:self._rows]
+            rng = np.random.default_rng(seed)
+            sample = data
+            if len(data) > nlist * 256:
+                sample = data[np.sort(rng.choice(len(data), nlist * 256, replace=False))]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assignments = self._nearest(sample, centroids)
+                order = np.argsort(assignments, kind="stable")
+                counts = np.bincount(assignments, minlength=nlist)
+                sums = np.zeros_like(centroids)
+                filled = np.nonzero(counts)[0]
+                starts = np.concatenate([[0], np.cumsum(counts[filled])[:-1]])
+                sums[filled] = np.add.reduceat(sample[order], starts, axis=0)
+                empty = np.nonzero(counts == 0)[0]
+                if len(empty):
+                    # Reseed empty lists with random points
+                    sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+                centroids = self.normalize(sums)
+            self._centroids = centroids
+            self._assignments = self._nearest(data, centroids)
+            self._trained_rows = self._rows
+            self._lists = None
+            self._ivf_saved = False
+    
+    def _inverted_lists(self) -> List[np.ndarray]:
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind="stable")
+            bounds = np.searchsorted(self._assignments[order], np.arange(len(self._centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        return self._lists
+    
+    def search(self, queries: np.ndarray, k: int, nprobe: int = 0):
+        """Top-`k` (rows, scores) for every query, best first; IVF scans only the `nprobe` nearest lists."""
+        queries = self.normalize(queries)
+        with self._lock:
+            data = self._vectors[:self._rows]
+            centroids = self._centroids
+            lists = self._inverted_lists() if centroids is not None and nprobe > 0 else None
+        if not len(data) or k <= 0:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+        if lists is None:
+            return self._search_exact(data, queries, k)
+        
+        results = []
+        probes = self._top(queries @ centroids.T, min(nprobe, len(centroids)))[0]
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([lists[i] for i in probe])
+            scores = data[candidates] @ query
+            top, top_scores = self._top(scores[None, :], min(k, len(candidates)))
+            results.append((candidates[top[0]], top_scores[0]))
+        return results
+    
+    def _search_exact(self, data: np.ndarray, queries: np.ndarray, k: int):
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(data), self.BLOCK_ROWS):
+            scores = queries @ data[start:start + self.BLOCK_ROWS].T
+            rows, block_scores = self._top(scores, min(k, scores.shape[1]), ordered=False)
+            best_rows = np.concatenate([best_rows, rows + start], axis=1)
+            best_scores = np.concatenate([best_scores, block_scores], axis=1)
+            if best_rows.shape[1] > k:
+                keep, best_scores = self._top(best_scores, k, ordered=False)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order, best_scores = self._top(best_scores, best_scores.shape[1])
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return list(zip(best_rows, best_scores))
+    
+    @staticmethod
+    def _top(scores: np.ndarray, k: int, ordered: bool = True):
+        """Column indices and values of the `k` largest scores per row (argpartition, then sort only those)."""
+        if k < scores.shape[1]:
+            columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+        values = np.take_along_axis(scores, columns, axis=1)
+        if ordered:
+            order = np.argsort(-values, axis=1, kind="stable")
+            columns = np.take_along_axis(columns, order, axis=1)
+            values = np.take_along_axis(values, order, axis=1)
+        return columns, values
+    
+    def save(self):
+        """Persist the model identity and a retrained IVF layer, switching generations atomically via meta.json."""
+        if not self.directory:
+            return
+        with self._lock:
+            previous = self._generation
+            if not self._ivf_saved:
+                self._generation += 1
+                if self._centroids is not None:
+                    path = self._path(f"centroids-{self._generation}.npy")
+                    with open(path, "wb") as f:
+                        np.save(f, np.ascontiguousarray(self._centroids))
+                    self._assignment_file = AppendOnlyArray(self._path(f"assignments-{self._generation}.npy"), "<i4")
+                    self._assignment_file.append(self._assignments)
+                else:
+                    self._assignment_file = None
+            meta = {"model_identity": self.model_identity, "trained_rows": self._trained_rows,
+                    "ivf_generation": self._generation if self._centroids is not None else 0}
+            path = self._path("meta.json")
+            with open(path + ".tmp", "wb") as f:
+                f.write(json_dumps_bytes(meta))
+            os.replace(path + ".tmp", path)
+            if not self._ivf_saved:
+                self._ivf_saved = True
+                for name in (f"centroids-{previous}.npy", f"assignments-{previous}.npy"):
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+    
+    def _load(self):
+        meta = {}
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json"), "rb") as f:
+                meta = json_loads(f.read())
+        texts, offsets = [], [0]
+        texts_path = self._path("texts.jsonl")
+        size = os.path.getsize(texts_path) if os.path.exists(texts_path) else 0
+        if size:
+            with open(texts_path, "rb") as f:
+                # The last piece is empty, or a line cut short by a crash
+                for line in f.read().split(b"\n")[:-1]:
+                    texts.append(json_loads(line))
+                    offsets.append(offsets[-1] + len(line) + 1)
+        # Vectors and texts are appended separately; keep only the rows both have
+        self._rows = min(self._store.rows, len(texts))
+        self._store.truncate(self._rows)
+        if size > offsets[self._rows]:
+            # Cut the torn or orphaned tail so the next append starts on a line of its own
+            with open(texts_path, "r+b") as f:
+                f.truncate(offsets[self._rows])
+        self._vectors = self._store.view()
+        self._texts = texts[:self._rows]
+        self._keys = {EmbeddingStore.content_key(text): row for row, text in enumerate(self._texts)}
+        self.model_identity = meta.get("model_identity")
+        
+        self._generation = meta.get("ivf_generation") or 0
+        centroids_path = self._path(f"centroids-{self._generation}.npy")
+        if self._generation and os.path.exists(centroids_path):
+            assignment_file = AppendOnlyArray(self._path(f"assignments-{self._generation}.npy"), "<i4")
+            # Rows added after the last save were never assigned on disk; retrain on the next run
+            if assignment_file.rows >= self._rows:
+                assignment_file.truncate(self._rows)
+                self._assignment_file = assignment_file
+                self._centroids = np.load(centroids_path)
+                self._assignments = np.array(assignment_file.view(), dtype=np.int32)
+                self._trained_rows = meta.get("trained_rows") or self._rows
+        if self._generation and self._centroids is None:
+            # The next save drops the unusable layer's files
+            self._ivf_saved = False
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rows": self._rows,
+                "dim": self.dim,
+                "ivf_lists": len(self._centroids) if self._centroids is not None else 0,
+                "trained_rows": self._trained_rows,
+                "memory_mapped": isinstance(self._vectors, np.memmap),
+            }
+
+
+class VectorIndexRegistry:
+    """Opens one VectorIndex per (directory, name) and shares it process-wide."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+    
+    def get(self, name: str, directory: str = "") -> VectorIndex:
+        path = None
+        if directory:
+            path = os.path.join(os.path.abspath(directory), hashlib.sha256(name.encode("utf-8")).hexdigest()[:16])
+        with self._lock:
+            index = self._indexes.get((path, name))
+            if index is None:
+                index = self._indexes[(path, name)] = VectorIndex(path)
+            return index
+    
+    def reset(self, name: str, directory: str = "") -> VectorIndex:
+        """Replace the index with an empty one and delete its files."""
+        index = self.get(name, directory)
+        with self._lock:
+            fresh = self._indexes[(index.directory, name)] = VectorIndex(index.directory, reset=True)
+            return fresh
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {name: index.stats() for (_, name), index in self._indexes.items()}
+
+
+VECTOR_INDEXES = VectorIndexRegistry()
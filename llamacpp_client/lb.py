@@ -0,0 +1,626 @@
+"""Routing across llama-server replicas and slots: load balancing, circuit breakers, affinity, checkpoints."""
+
+import json
+import requests
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, List, Optional
+
+from .util import canonical_hash, canonical_json, endpoint_path, run_bounded
+from .transport import SESSIONS
+
+
+class Replica:
+    """One llama-server instance behind a load-balanced `server_url`."""
+    
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = weight
+        self.in_flight = 0
+        self.healthy = True
+        self.passes = 0
+        self.failures = 0
+        self.total_slots = None
+        self.idle_slots = None
+        self.requests = 0
+        self.current_weight = 0.0  # smooth weighted round-robin state
+    
+    def free_slots(self) -> int:
+        if self.idle_slots is not None:
+            return max(self.idle_slots - self.in_flight, 0)
+        if self.total_slots is not None:
+            return max(self.total_slots - self.in_flight, 0)
+        return 0
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "total_slots": self.total_slots,
+            "idle_slots": self.idle_slots,
+        }
+
+
+class ReplicaSet:
+    """
+    Least-outstanding-requests router over llama-server replicas, with weighted round-robin
+    among ties and lazily started, self-stopping `/health` checks.
+    """
+    
+    def __init__(self, replicas: List[Replica], health_interval: float = 5.0, recover_after: int = 2,
+                 api_key: str = "", idle_stop: float = 300.0):
+        self.replicas = replicas
+        self.health_interval = health_interval
+        self.recover_after = recover_after
+        self.api_key = api_key
+        self.idle_stop = idle_stop
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._checker = None
+    
+    def configure(self, api_key: str = "", health_interval: float = 5.0):
+        """Mark the set as in use and apply the latest credentials; a `health_interval` of 0 disables checks."""
+        with self._lock:
+            self.api_key = api_key
+            self.health_interval = health_interval
+            self.last_used = time.monotonic()
+            if health_interval <= 0:
+                self._stop.set()
+    
+    def _use_locked(self):
+        # Requests keep the set alive and (re)start the health checks
+        self.last_used = time.monotonic()
+        running = self._checker is not None and self._checker.is_alive() and not self._stop.is_set()
+        if self.health_interval > 0 and not running:
+            self._stop = threading.Event()
+            self._checker = threading.Thread(target=self._health_loop, args=(self._stop,), daemon=True,
+                                             name="llamacpp-health")
+            self._checker.start()
+    
+    def stop(self):
+        """Stop the health thread; it exits at its next wake-up."""
+        with self._lock:
+            self._stop.set()
+    
+    def idle(self) -> bool:
+        """Whether the set has had no request in flight and no use for `idle_stop` seconds."""
+        with self._lock:
+            return (time.monotonic() - self.last_used > self.idle_stop
+                    and not any(replica.in_flight for replica in self.replicas))
+    
+    def pick(self, exclude: Optional[set] = None) -> Replica:
+        """Choose the healthy replica with the fewest in-flight requests per weight, without counting a request."""
+        with self._lock:
+            self._use_locked()
+            return self._pick_locked(exclude, advance=False)
+    
+    def _pick_locked(self, exclude: Optional[set] = None, advance: bool = True) -> Replica:
+        candidates = [r for r in self.replicas if r.healthy and (not exclude or r.url not in exclude)]
+        if not candidates:
+            # Everything looks down: keep trying rather than failing without a request
+            candidates = [r for r in self.replicas if not exclude or r.url not in exclude] or self.replicas
+        load = min(r.in_flight / r.weight for r in candidates)
+        tied = [r for r in candidates if r.in_flight / r.weight == load]
+        # Prefer replicas reporting a free slot, then take turns in proportion to weight
+        if any(r.free_slots() for r in tied):
+            tied = [r for r in tied if r.free_slots()]
+        if len(tied) == 1:
+            return tied[0]
+        for replica in tied:
+            replica.current_weight += replica.weight
+        chosen = max(tied, key=lambda r: r.current_weight)
+        if advance:
+            chosen.current_weight -= sum(r.weight for r in tied)
+        else:
+            for replica in tied:
+                replica.current_weight -= replica.weight
+        return chosen
+    
+    def acquire(self, exclude: Optional[set] = None, prefer: Optional[str] = None) -> Replica:
+        """Reserve a replica; `prefer` (a replica URL) wins while it is healthy."""
+        with self._lock:
+            self._use_locked()
+            replica = next((r for r in self.replicas if r.url == prefer and r.healthy), None) if prefer else None
+            if replica is None or (exclude and replica.url in exclude):
+                replica = self._pick_locked(exclude)
+            replica.in_flight += 1
+            replica.requests += 1
+            return replica
+    
+    def release(self, replica: Replica, failed: bool = False):
+        with self._lock:
+            self.last_used = time.monotonic()
+            replica.in_flight -= 1
+            if failed:
+                replica.failures += 1
+                replica.healthy = False
+                replica.passes = 0
+    
+    def check_health(self):
+        """Probe every replica once, concurrently, and update its health and slot counts."""
+        run_bounded(self._probe, self.replicas, len(self.replicas))
+    
+    def _probe(self, replica: Replica):
+        with self._lock:
+            api_key = self.api_key
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        try:
+            response = SESSIONS.get(replica.url).get(
+                f"{replica.url}/health", headers=headers, timeout=max(self.health_interval, 1.0))
+            ok = response.status_code == 200
+            body = response.json() if ok else {}
+            if ok and replica.total_slots is None:
+                props = SESSIONS.get(replica.url).get(f"{replica.url}/props", headers=headers, timeout=5)
+                if props.status_code == 200:
+                    replica.total_slots = props.json().get("total_slots")
+        except (requests.exceptions.RequestException, ValueError):
+            ok, body = False, {}
+        with self._lock:
+            if isinstance(body, dict) and "slots_idle" in body:
+                replica.idle_slots = body["slots_idle"]
+            if not ok:
+                replica.healthy = False
+                replica.passes = 0
+            elif not replica.healthy:
+                replica.passes += 1
+                if replica.passes >= self.recover_after:
+                    replica.healthy = True
+    
+    def _health_loop(self, stop: threading.Event):
+        while not stop.is_set():
+            with self._lock:
+                idle = time.monotonic() - self.last_used > self.idle_stop
+            if idle:
+                stop.set()
+                break
+            self.check_health()
+            stop.wait(self.health_interval)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {replica.url: replica.stats() for replica in self.replicas}
+
+
+class LoadBalancerRegistry:
+    """
+    Maps multi-replica `server_url` specs to shared ReplicaSets addressed as `lb://<id>`;
+    idle sets are stopped and dropped.
+    """
+    
+    SCHEME = "lb://"
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sets = {}
+    
+    @staticmethod
+    def parse(spec: str) -> List[Replica]:
+        """Parse a server spec: URLs separated by commas/newlines with optional `=weight`, or a JSON array."""
+        spec = spec.strip()
+        entries = []
+        if spec.startswith("["):
+            for item in json.loads(spec):
+                if isinstance(item, dict):
+                    entries.append((item["url"], float(item.get("weight", 1))))
+                else:
+                    entries.append((str(item), 1.0))
+        else:
+            for part in re.split(r"[,\n]", spec):
+                part = part.strip()
+                if not part:
+                    continue
+                match = re.match(r"^(.*?)\s*=\s*(\d+(?:\.\d+)?)$", part)
+                if match:
+                    entries.append((match.group(1), float(match.group(2))))
+                else:
+                    entries.append((part, 1.0))
+        return [Replica(url.strip().rstrip('/'), weight) for url, weight in entries if weight > 0]
+    
+    def resolve(self, spec: str, api_key: str = "", health_interval: float = 5.0) -> str:
+        """Return the URL to use for `spec`: itself for one server, `lb://<id>` for several."""
+        if "," not in spec and "\n" not in spec.strip() and not spec.strip().startswith("[") and "=" not in spec:
+            return spec.strip().rstrip('/')
+        replicas = self.parse(spec)
+        if len(replicas) == 1:
+            return replicas[0].url
+        key = canonical_hash([(r.url, r.weight) for r in replicas])[:16]
+        with self._lock:
+            for other in [k for k, replica_set in self._sets.items() if k != key and replica_set.idle()]:
+                self._sets.pop(other).stop()
+            replica_set = self._sets.get(key)
+            if replica_set is None:
+                replica_set = self._sets[key] = ReplicaSet(replicas)
+        # The key and interval of the latest run apply
+        replica_set.configure(api_key=api_key, health_interval=health_interval)
+        return f"{self.SCHEME}{key}"
+    
+    def stop(self):
+        """Stop the health threads of every replica set; the next request restarts them."""
+        with self._lock:
+            for replica_set in self._sets.values():
+                replica_set.stop()
+    
+    def is_balanced(self, url: str) -> bool:
+        return url.startswith(self.SCHEME)
+    
+    def get(self, url: str) -> ReplicaSet:
+        key = url[len(self.SCHEME):].split("/", 1)[0]
+        with self._lock:
+            return self._sets[key]
+    
+    def rewrite(self, url: str, replica: Replica) -> str:
+        rest = url[len(self.SCHEME):]
+        path = rest[len(rest.split("/", 1)[0]):]
+        return replica.url + path
+    
+    def concrete(self, url: str) -> str:
+        """A concrete URL for `url`, choosing a replica without counting a request."""
+        if not self.is_balanced(url):
+            return url
+        return self.rewrite(url, self.get(url).pick())
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {key: replica_set.stats() for key, replica_set in self._sets.items()}
+
+
+BALANCERS = LoadBalancerRegistry()
+
+
+# Endpoints that are safe to send again after a failure
+IDEMPOTENT_PATHS = ("/tokenize", "/detokenize", "/v1/embeddings", "/v1/rerank", "/apply-template")
+# Status codes worth retrying: timeouts, rate limiting and an unavailable server
+RETRY_STATUS = (408, 429, 502, 503, 504)
+CIRCUIT_OPEN_ERROR = "Circuit open"
+# Words in a 503 body that mean llama-server is up but loading a model or out of free slots
+BUSY_MARKERS = ("loading", "unavailable", "busy", "slot")
+
+
+def replica_unhealthy(result: tuple) -> bool:
+    """Whether a result means the replica is down (connection failure, timeout or a non-busy 503)."""
+    response, raw_response, error, status_code = result[:4]
+    if error in ("Connection error", "Request timeout"):
+        return True
+    if status_code != 503:
+        return False
+    details = response.get("error") if isinstance(response, dict) else None
+    text = str(details if details is not None else raw_response or "").lower()
+    return not any(marker in text for marker in BUSY_MARKERS)
+
+
+class CircuitBreaker:
+    """
+    Per-server circuit breaker. After `failure_threshold` consecutive failures a server is
+    skipped for `reset_timeout` seconds; then one probe request decides whether it closes again.
+    """
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._servers = {}  # base URL -> {"failures", "opened_at", "probing", "trips"}
+    
+    def configure(self, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+    
+    def _state_locked(self, server: str) -> str:
+        entry = self._servers.get(server)
+        if entry is None or entry["opened_at"] is None:
+            return "closed"
+        if time.monotonic() - entry["opened_at"] < self.reset_timeout:
+            return "open"
+        return "half_open"
+    
+    def state(self, server: str) -> str:
+        with self._lock:
+            return self._state_locked(server)
+    
+    def allow(self, server: str) -> bool:
+        """Whether a request may go to `server`; a half-open circuit lets exactly one probe through."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            state = self._state_locked(server)
+            if state == "closed":
+                return True
+            entry = self._servers[server]
+            if state == "half_open" and not entry["probing"]:
+                entry["probing"] = True
+                return True
+            return False
+    
+    def release(self, server: str):
+        """End a request that says nothing about the server (cancelled or interrupted) without an outcome."""
+        with self._lock:
+            entry = self._servers.get(server)
+            if entry is not None:
+                entry["probing"] = False
+    
+    def record(self, server: str, success: bool):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            entry = self._servers.setdefault(server, {"failures": 0, "opened_at": None, "probing": False, "trips": 0})
+            entry["probing"] = False
+            if success:
+                entry["failures"] = 0
+                entry["opened_at"] = None
+                return
+            entry["failures"] += 1
+            if entry["opened_at"] is not None or entry["failures"] >= self.failure_threshold:
+                if entry["opened_at"] is None:
+                    entry["trips"] += 1
+                entry["opened_at"] = time.monotonic()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                server: {"state": self._state_locked(server), "failures": entry["failures"], "trips": entry["trips"]}
+                for server, entry in self._servers.items()
+            }
+
+
+BREAKERS = CircuitBreaker()
+
+
+class LatencyTracker:
+    """Rolling window of successful request latencies per key, used to pick hedging delays."""
+    
+    def __init__(self, window: int = 512, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = {}
+    
+    def observe(self, key: Any, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+    
+    def percentile(self, key: Any, q: float) -> Optional[float]:
+        """The `q`-th percentile latency in seconds, or None until enough samples are in."""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * q / 100.0), len(ordered) - 1)]
+
+
+LATENCY = LatencyTracker()
+
+
+class PrefixAffinity:
+    """
+    Routes requests sharing a prompt prefix to the same (server, slot) for KV-cache reuse.
+    """
+    
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._table = OrderedDict()  # prefix hash -> (server base URL, slot)
+        self._next_slot = {}  # server base URL -> round-robin counter
+        self.counters = {"requests": 0, "table_hits": 0, "assigned": 0, "evictions": 0,
+                         "prompt_tokens": 0, "reused_tokens": 0}
+    
+    @staticmethod
+    def prefix_key(url: str, data: Dict[str, Any], prefix_chars: int) -> Optional[str]:
+        """Hash of the leading, shared part of a generation request (None if there is none)."""
+        path = endpoint_path(url)
+        if path == "/v1/chat/completions":
+            messages = data.get("messages") or []
+            # Everything before the newest turn is what consecutive requests share
+            stable = messages[:-1] if len(messages) > 1 else messages
+            text = canonical_json(stable)
+        elif path in ("/completion", "/infill"):
+            text = data.get("prompt") if path == "/completion" else data.get("input_prefix")
+            if not isinstance(text, str):
+                text = canonical_json(text)
+        else:
+            return None
+        if not text:
+            return None
+        return canonical_hash(path, text[:prefix_chars])
+    
+    def lookup(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            self.counters["requests"] += 1
+            route = self._table.get(key)
+            if route is not None:
+                self._table.move_to_end(key)
+                self.counters["table_hits"] += 1
+            return route
+    
+    def assign(self, key: str, server: str, total_slots: int) -> int:
+        """Bind `key` to the next slot of `server` and return the slot id."""
+        with self._lock:
+            counter = self._next_slot.get(server, 0)
+            slot = counter % max(total_slots, 1)
+            self._next_slot[server] = counter + 1
+            self._table[key] = (server, slot)
+            self._table.move_to_end(key)
+            self.counters["assigned"] += 1
+            while len(self._table) > self.max_entries:
+                self._table.popitem(last=False)
+                self.counters["evictions"] += 1
+            return slot
+    
+    def observe(self, response: Any):
+        """Account prompt tokens served from the KV cache, from the server's timings."""
+        if not isinstance(response, dict):
+            return
+        timings = response.get("timings") or {}
+        processed = timings.get("prompt_n")
+        total = response.get("tokens_evaluated") or (response.get("usage") or {}).get("prompt_tokens")
+        if processed is None or not total:
+            return
+        with self._lock:
+            self.counters["prompt_tokens"] += total
+            self.counters["reused_tokens"] += max(total - processed, 0)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._table)
+            stats["table_hit_rate"] = stats["table_hits"] / stats["requests"] if stats["requests"] else 0.0
+            stats["kv_reuse_rate"] = stats["reused_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+            return stats
+
+
+AFFINITY = PrefixAffinity()
+
+
+class SlotCheckpoints:
+    """
+    Client-side index of the KV-cache checkpoints saved with llama-server's slot actions
+    and of the prefix each slot currently holds.
+    """
+    
+    MAX_SEEN = 4096
+    
+    def __init__(self, timeout: float = 60.0):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._files = {}  # (server, filename) -> True if saved on the server, False if known missing
+        self._loaded = {}  # (server, slot) -> filename of the prefix the slot holds
+        self._seen = OrderedDict()  # (server, filename) of prefixes sent once, most recent last
+        self._unsupported = set()
+        self.counters = {"restored": 0, "saved": 0, "already_loaded": 0, "restore_misses": 0, "erased": 0,
+                         "first_uses": 0, "failures": 0}
+    
+    @staticmethod
+    def prefix_key(url: str, data: Dict[str, Any], prefix_chars: int) -> Optional[str]:
+        """Hash of the shared prefix: a chat's leading system messages or a prompt's first `prefix_chars` characters."""
+        path = endpoint_path(url)
+        if path == "/v1/chat/completions":
+            system = SlotCheckpoints._system_messages(data)
+            return canonical_hash(path, system) if system else None
+        if path in ("/completion", "/infill"):
+            text = data.get("prompt") if path == "/completion" else data.get("input_prefix")
+            if isinstance(text, str) and len(text) >= prefix_chars:
+                return canonical_hash(path, text[:prefix_chars])
+        return None
+    
+    @staticmethod
+    def _system_messages(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        system = []
+        for message in (data.get("messages") or [])[:-1]:
+            if message.get("role") not in ("system", "developer"):
+                break
+            system.append(message)
+        return system
+    
+    @staticmethod
+    def prefix_request(url: str, data: Dict[str, Any], prefix_chars: int) -> Dict[str, Any]:
+        """The request cut down to its prefix with nothing to generate, so only the prefix is evaluated."""
+        data = {k: v for k, v in data.items() if k not in ("stream", "stream_options")}
+        path = endpoint_path(url)
+        if path == "/v1/chat/completions":
+            return dict(data, messages=SlotCheckpoints._system_messages(data), max_tokens=0, n_predict=0)
+        if path == "/infill":
+            return dict(data, input_prefix=data["input_prefix"][:prefix_chars], input_suffix="", n_predict=0)
+        return dict(data, prompt=data["prompt"][:prefix_chars], n_predict=0)
+    
+    @staticmethod
+    def filename(key: str, model_identity: str) -> str:
+        return f"llamacpp-{canonical_hash(key, model_identity)[:24]}.bin"
+    
+    def action(self, send, server: str, slot: int, action: str, filename: str = ""):
+        """POST one slot action with `send(url, body)`; returns (ok, response)."""
+        body = {"filename": filename} if filename else {}
+        response, _, error, status_code = send(f"{server}/slots/{slot}?action={action}", body)
+        if status_code in (404, 501):
+            # Slot actions are disabled (no --slot-save-path); stop trying this server
+            with self._lock:
+                self._unsupported.add(server)
+        elif error:
+            with self._lock:
+                self.counters["failures"] += 1
+        ok = not error and status_code == 200
+        return ok, response if isinstance(response, dict) else {}
+    
+    def prepare(self, send, server: str, slot: int, filename: str) -> bool:
+        """Restore the prefix checkpoint into `slot` unless it holds it; False means skip `commit`."""
+        with self._lock:
+            if server in self._unsupported:
+                return False
+            if (server, filename) not in self._files and (server, filename) not in self._seen:
+                self._seen[(server, filename)] = True
+                if len(self._seen) > self.MAX_SEEN:
+                    self._seen.popitem(last=False)
+                self.counters["first_uses"] += 1
+                return False
+            self._seen.pop((server, filename), None)
+            if self._loaded.get((server, slot)) == filename:
+                self.counters["already_loaded"] += 1
+                return True
+            if self._files.get((server, filename)) is False:
+                return True
+        # Unknown checkpoints are tried too: they may survive from an earlier ComfyUI session
+        ok, _ = self.action(send, server, slot, "restore", filename)
+        with self._lock:
+            self._files[(server, filename)] = ok
+            if ok:
+                self._loaded[(server, slot)] = filename
+                self.counters["restored"] += 1
+            else:
+                self._loaded.pop((server, slot), None)
+                self.counters["restore_misses"] += 1
+        return True
+    
+    def commit(self, send, server: str, slot: int, filename: str, url: str, prefix: Dict[str, Any],
+                     timeout: float):
+        """Evaluate `prefix` in `slot` and save the slot, if the server lacks the checkpoint."""
+        with self._lock:
+            if server in self._unsupported or self._files.get((server, filename)):
+                return
+            self._loaded.pop((server, slot), None)
+        _, _, error, status_code = send(url, prefix, timeout)
+        if error or status_code != 200:
+            with self._lock:
+                self.counters["failures"] += 1
+            return
+        ok, _ = self.action(send, server, slot, "save", filename)
+        with self._lock:
+            self._loaded[(server, slot)] = filename
+            if ok:
+                self._files[(server, filename)] = True
+                self.counters["saved"] += 1
+    
+    def evict(self, server: str, slot: int):
+        """A request without this checkpoint ran in `slot`, so the slot no longer holds a known prefix."""
+        with self._lock:
+            self._loaded.pop((server, slot), None)
+    
+    def erase(self, send, server: str, slot: int) -> bool:
+        """Clear the KV cache of `slot` (saved checkpoint files are kept)."""
+        ok, _ = self.action(send, server, slot, "erase")
+        with self._lock:
+            self._loaded.pop((server, slot), None)
+            if ok:
+                self.counters["erased"] += 1
+        return ok
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["checkpoints"] = {}
+            for (server, filename), exists in self._files.items():
+                if exists:
+                    stats["checkpoints"].setdefault(server, []).append(filename)
+            stats["unsupported_servers"] = sorted(self._unsupported)
+            return stats
+
+
+CHECKPOINTS = SlotCheckpoints()
@@ -0,0 +1,3121 @@
+"""ComfyUI nodes for llama-server."""
+
+import asyncio
+import json
+import requests
+import base64
+import hashlib
+import heapq
+import os
+import random
+import socket
+import threading
+import time
+from array import array
+from typing import Dict, Any, List, Optional, Union
+import numpy as np
+
+from .util import (
+    ENDPOINT_PATHS, SLOT_PATHS, canonical_hash, canonical_json, endpoint_path, fingerprint_value, is_deterministic,
+    json_dumps_bytes, json_loads, output_is_linked, parse_text_list, run_bounded,
+)
+from .transport import (
+    ASYNC_HTTP, CONNECT_TIMING, INTERRUPTED_ERROR, INTERRUPTED_STATUS, IN_FLIGHT, LOOP, REQUEST_CONNECTIONS,
+    SESSIONS, SSEDecoder, SessionRegistry, StreamAccumulator, interrupt_requested, iter_sse_data,
+)
+from .lb import (
+    AFFINITY, BALANCERS, BREAKERS, CHECKPOINTS, CIRCUIT_OPEN_ERROR, IDEMPOTENT_PATHS, LATENCY, LoadBalancerRegistry,
+    PrefixAffinity, RETRY_STATUS, SlotCheckpoints, replica_unhealthy,
+)
+from .cache import (
+    CASSETTES, Cassette, IMAGE_ENCODER, PROPS, RESPONSE_CACHE, SINGLE_FLIGHT, TOKEN_CACHE, TOKEN_COUNTS, TokenCache,
+)
+from .index import EMBEDDING_STORES, EmbeddingStore, VECTOR_INDEXES, decode_embedding
+from .telemetry import BUILD_STARTED, RequestTelemetry, TELEMETRY, TELEMETRY_RECORDS
+
+
+class Conversation:
+    """
+    Append-only chat history that serializes to the same bytes on every turn,
+    optionally persisted as JSONL.
+    """
+    
+    def __init__(self, conversation_id: str, path: Optional[str] = None):
+        self.conversation_id = conversation_id
+        self.path = path
+        self.messages = []
+        self.binding = None  # (server_url input, id_slot input) the slot below was chosen for
+        self.server = None
+        self.id_slot = None
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.messages = [json_loads(line) for line in f if line.strip()]
+    
+    @property
+    def system(self) -> str:
+        if self.messages and self.messages[0].get("role") == "system":
+            return self.messages[0].get("content") or ""
+        return ""
+    
+    def reset(self, system_message: str = ""):
+        """Start over, optionally with a system message."""
+        self.replace([{"role": "system", "content": system_message}] if system_message else [])
+    
+    def replace(self, messages: List[Dict[str, Any]]):
+        """Rewrite the whole history, e.g. after old turns were trimmed."""
+        self.messages = list(messages)
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(b"".join(json_dumps_bytes(message) + b"\n" for message in self.messages))
+    
+    def append(self, *messages: Dict[str, Any]):
+        """Add messages at the end; earlier messages are never touched."""
+        self.messages.extend(messages)
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(b"".join(json_dumps_bytes(message) + b"\n" for message in messages))
+    
+    def serialized(self) -> bytes:
+        return json_dumps_bytes(self.messages)
+
+
+class ConversationStore:
+    """
+    Process-wide conversations by id, kept between workflow runs. Each conversation is bound to
+    one server slot, spreading conversations over the slots of a server.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conversations = {}  # (directory, conversation_id) -> Conversation
+    
+    def get(self, conversation_id: str, directory: str = "") -> Conversation:
+        key = (directory, conversation_id)
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                path = None
+                if directory:
+                    name = hashlib.sha256(conversation_id.encode("utf-8")).hexdigest()[:24]
+                    path = os.path.join(directory, f"conversation-{name}.jsonl")
+                conversation = self._conversations[key] = Conversation(conversation_id, path)
+            return conversation
+    
+    def bind(self, conversation: Conversation, server: str, total_slots: int) -> int:
+        """Bind `conversation` to the slot of `server` holding the fewest other conversations."""
+        with self._lock:
+            load = [0] * max(total_slots, 1)
+            for other in self._conversations.values():
+                if other is not conversation and other.server == server and other.id_slot is not None \
+                        and other.id_slot < len(load):
+                    load[other.id_slot] += 1
+            conversation.server = server
+            conversation.id_slot = load.index(min(load))
+            return conversation.id_slot
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                conversation.conversation_id: {
+                    "messages": len(conversation.messages),
+                    "server": conversation.server,
+                    "id_slot": conversation.id_slot,
+                }
+                for conversation in self._conversations.values()
+            }
+
+
+CONVERSATIONS = ConversationStore()
+
+
+# Node input that a plain-string batch item replaces, per endpoint
+BATCH_ITEM_FIELDS = {
+    "completion": "prompt",
+    "chat_completions": "user_message",
+    "embeddings": "input_text",
+    "tokenize": "content",
+    "detokenize": "tokens",
+    "apply_template": "messages",
+    "infill": "input_prefix",
+    "reranking": "query",
+}
+
+
+# Counters of the shared components, exported on /metrics next to the request metrics
+TELEMETRY.add_source("sessions", SESSIONS.stats)
+TELEMETRY.add_source("asyncio", ASYNC_HTTP.stats)
+TELEMETRY.add_source("requests", IN_FLIGHT.stats)
+TELEMETRY.add_source("circuit", BREAKERS.stats, ("server",))
+TELEMETRY.add_source("replica", BALANCERS.stats, ("balancer", "replica"))
+TELEMETRY.add_source("affinity", AFFINITY.stats)
+TELEMETRY.add_source("checkpoint", CHECKPOINTS.stats)
+TELEMETRY.add_source("single_flight", SINGLE_FLIGHT.stats)
+TELEMETRY.add_source("response_cache", RESPONSE_CACHE.stats)
+TELEMETRY.add_source("cassette", CASSETTES.stats, ("path",))
+TELEMETRY.add_source("image_cache", IMAGE_ENCODER.stats)
+TELEMETRY.add_source("token_cache", TOKEN_CACHE.stats)
+TELEMETRY.add_source("token_counts", TOKEN_COUNTS.stats)
+TELEMETRY.add_source("conversation", CONVERSATIONS.stats, ("conversation",))
+TELEMETRY.add_source("index", VECTOR_INDEXES.stats, ("index",))
+
+
+class LlamaCppClientNode:
+    """
+    ComfyUI custom node that acts as a client for llama-server from llama.cpp.
+    Supports ALL possible parameters that llama-server accepts through its various endpoints.
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "server_url": ("STRING", {
+                    "default": "http://127.0.0.1:8080",
+                    "multiline": False,
+                    "tooltip": "Base URL of the llama-server instance, or several comma-separated URLs (optional '=weight') to load-balance"
+                }),
+                "endpoint": (["completion", "chat_completions", "embeddings", "tokenize", "detokenize", "apply_template", "infill", "reranking"], {
+                    "default": "completion",
+                    "tooltip": "API endpoint to use"
+                }),
+                "prompt": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "The prompt text for completion/chat"
+                }),
+            },
+            "optional": {
+                # Connection & Auth
+                "api_key": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "API key for authentication (if required)"
+                }),
+                "timeout": ("INT", {
+                    "default": 600,
+                    "min": 1,
+                    "max": 3600,
+                    "tooltip": "Request timeout in seconds"
+                }),
+                "pool_maxsize": ("INT", {
+                    "default": 16,
+                    "min": 1,
+                    "max": 256,
+                    "tooltip": "Maximum pooled keep-alive connections per server"
+                }),
+                "keep_alive": ("BOOLEAN", {
+                    "default": True,
+                    "tooltip": "Reuse HTTP connections across requests"
+                }),
+                "idle_timeout": ("INT", {
+                    "default": 300,
+                    "min": 0,
+                    "max": 86400,
+                    "tooltip": "Close a server's pooled connections after this many idle seconds (0 = never)"
+                }),
+                "transport": (["requests", "asyncio"], {
+                    "default": "requests",
+                    "tooltip": "HTTP transport: blocking requests sessions, or pooled asyncio connections on a shared event loop"
+                }),
+                "health_interval": ("INT", {
+                    "default": 5,
+                    "min": 1,
+                    "max": 3600,
+                    "tooltip": "Seconds between /health checks of load-balanced replicas"
+                }),
+                "connect_timeout": ("INT", {
+                    "default": 10,
+                    "min": 1,
+                    "max": 600,
+                    "tooltip": "Seconds to wait for a connection; timeout applies to reading the response"
+                }),
+                "max_retries": ("INT", {
+                    "default": 2,
+                    "min": 0,
+                    "max": 10,
+                    "tooltip": "Retries for idempotent endpoints (tokenize, embeddings, rerank, ...)"
+                }),
+                "retry_backoff": ("FLOAT", {
+                    "default": 0.25,
+                    "min": 0.0,
+                    "max": 30.0,
+                    "step": 0.05,
+                    "tooltip": "Base delay in seconds for jittered exponential retry backoff"
+                }),
+                "circuit_threshold": ("INT", {
+                    "default": 5,
+                    "min": 0,
+                    "max": 100,
+                    "tooltip": "Consecutive failures before a server is skipped (0 = no circuit breaker)"
+                }),
+                "circuit_reset": ("INT", {
+                    "default": 30,
+                    "min": 1,
+                    "max": 3600,
+                    "tooltip": "Seconds an open circuit waits before probing the server again"
+                }),
+                "hedge_percentile": ("FLOAT", {
+                    "default": 0.0,
+                    "min": 0.0,
+                    "max": 99.9,
+                    "step": 0.1,
+                    "tooltip": "asyncio transport: send a second copy to another replica once a request is slower than this latency percentile (0 = off)"
+                }),
+                
+                # Core Generation Parameters
+                "n_predict": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 100000,
+                    "tooltip": "Number of tokens to predict (-1 = infinity)"
+                }),
+                "temperature": ("FLOAT", {
+                    "default": 0.8,
+                    "min": 0.0,
+                    "max": 10.0,
+                    "step": 0.01,
+                    "tooltip": "Sampling temperature"
+                }),
+                "top_k": ("INT", {
+                    "default": 40,
+                    "min": 0,
+                    "max": 1000,
+                    "tooltip": "Top-k sampling"
+                }),
+                "top_p": ("FLOAT", {
+                    "default": 0.95,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "tooltip": "Top-p (nucleus) sampling"
+                }),
+                "min_p": ("FLOAT", {
+                    "default": 0.05,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "tooltip": "Min-p sampling"
+                }),
+                "seed": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 2**31-1,
+                    "tooltip": "Random seed (-1 for random)"
+                }),
+                
+                # Dynamic Temperature
+                "dynatemp_range": ("FLOAT", {
+                    "default": 0.0,
+                    "min": 0.0,
+                    "max": 5.0,
+                    "step": 0.01,
+                    "tooltip": "Dynamic temperature range"
+                }),
+                "dynatemp_exponent": ("FLOAT", {
+                    "default": 1.0,
+                    "min": 0.1,
+                    "max": 10.0,
+                    "step": 0.01,
+                    "tooltip": "Dynamic temperature exponent"
+                }),
+                
+                # XTC Sampling
+                "xtc_probability": ("FLOAT", {
+                    "default": 0.0,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "tooltip": "XTC probability"
+                }),
+                "xtc_threshold": ("FLOAT", {
+                    "default": 0.1,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "tooltip": "XTC threshold"
+                }),
+                
+                # Repetition Control
+                "repeat_penalty": ("FLOAT", {
+                    "default": 1.1,
+                    "min": 0.1,
+                    "max": 5.0,
+                    "step": 0.01,
+                    "tooltip": "Repetition penalty"
+                }),
+                "repeat_last_n": ("INT", {
+                    "default": 64,
+                    "min": -1,
+                    "max": 2048,
+                    "tooltip": "Last n tokens for repetition penalty"
+                }),
+                "presence_penalty": ("FLOAT", {
+                    "default": 0.0,
+                    "min": -2.0,
+                    "max": 2.0,
+                    "step": 0.01,
+                    "tooltip": "Presence penalty"
+                }),
+                "frequency_penalty": ("FLOAT", {
+                    "default": 0.0,
+                    "min": -2.0,
+                    "max": 2.0,
+                    "step": 0.01,
+                    "tooltip": "Frequency penalty"
+                }),
+                
+                # DRY Sampling
+                "dry_multiplier": ("FLOAT", {
+                    "default": 0.0,
+                    "min": 0.0,
+                    "max": 5.0,
+                    "step": 0.01,
+                    "tooltip": "DRY sampling multiplier"
+                }),
+                "dry_base": ("FLOAT", {
+                    "default": 1.75,
+                    "min": 1.0,
+                    "max": 5.0,
+                    "step": 0.01,
+                    "tooltip": "DRY sampling base value"
+                }),
+                "dry_allowed_length": ("INT", {
+                    "default": 2,
+                    "min": 1,
+                    "max": 100,
+                    "tooltip": "DRY allowed length"
+                }),
+                "dry_penalty_last_n": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 2048,
+                    "tooltip": "DRY penalty last n tokens"
+                }),
+                "dry_sequence_breakers": ("STRING", {
+                    "default": '["\\n", ":", "\\"", "*"]',
+                    "multiline": False,
+                    "tooltip": "JSON array of DRY sequence breakers"
+                }),
+                
+                # Mirostat
+                "mirostat": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 2,
+                    "tooltip": "Mirostat sampling (0=disabled, 1=v1, 2=v2)"
+                }),
+                "mirostat_tau": ("FLOAT", {
+                    "default": 5.0,
+                    "min": 0.1,
+                    "max": 20.0,
+                    "step": 0.1,
+                    "tooltip": "Mirostat target entropy"
+                }),
+                "mirostat_eta": ("FLOAT", {
+                    "default": 0.1,
+                    "min": 0.001,
+                    "max": 1.0,
+                    "step": 0.001,
+                    "tooltip": "Mirostat learning rate"
+                }),
+                
+                # Other Sampling
+                "typical_p": ("FLOAT", {
+                    "default": 1.0,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.01,
+                    "tooltip": "Locally typical sampling"
+                }),
+                
+                # Control Parameters
+                "n_keep": ("INT", {
+                    "default": 0,
+                    "min": -1,
+                    "max": 2048,
+                    "tooltip": "Number of tokens to keep from prompt"
+                }),
+                "stop_sequences": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of stop sequences"
+                }),
+                "ignore_eos": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Ignore end-of-stream token"
+                }),
+                
+                # Streaming and Output
+                "stream": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Enable streaming mode"
+                }),
+                "n_probs": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 100,
+                    "tooltip": "Return top N token probabilities"
+                }),
+                "min_keep": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 100,
+                    "tooltip": "Minimum tokens to keep in sampler"
+                }),
+                "post_sampling_probs": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Return post-sampling probabilities"
+                }),
+                "return_tokens": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Return raw token IDs"
+                }),
+                "timings_per_token": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Include timing information"
+                }),
+                
+                # Grammar and JSON
+                "grammar": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "BNF grammar for constrained generation"
+                }),
+                "json_schema": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "JSON schema for constrained generation"
+                }),
+                
+                # Logit Bias
+                "logit_bias": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of logit bias modifications"
+                }),
+                
+                # Request coalescing
+                "coalesce_requests": ("BOOLEAN", {
+                    "default": True,
+                    "tooltip": "Send identical deterministic requests that are in flight at the same time only once"
+                }),
+                
+                # Response cache
+                "response_cache": (["off", "deterministic", "force"], {
+                    "default": "off",
+                    "tooltip": "Serve repeated requests from cache: 'deterministic' skips seed=-1 generations, 'force' caches everything"
+                }),
+                "cache_ttl": ("INT", {
+                    "default": 3600,
+                    "min": 0,
+                    "max": 31536000,
+                    "tooltip": "Seconds a cached response stays valid (0 = forever)"
+                }),
+                "cache_max_entries": ("INT", {
+                    "default": 512,
+                    "min": 1,
+                    "max": 1000000,
+                    "tooltip": "Maximum responses kept in the in-memory cache"
+                }),
+                "cache_db_path": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Optional SQLite file for a persistent cache shared between processes"
+                }),
+                "cassette_mode": (["off", "record", "replay", "replay_or_live"], {
+                    "default": "off",
+                    "tooltip": "Record requests to a cassette file or replay them offline"
+                }),
+                "cassette_path": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Cassette file used by cassette_mode"
+                }),
+                
+                # Cache and Slot Management
+                "cache_prompt": ("BOOLEAN", {
+                    "default": True,
+                    "tooltip": "Re-use KV cache from previous requests"
+                }),
+                "id_slot": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 100,
+                    "tooltip": "Assign to specific slot (-1 = auto)"
+                }),
+                "slot_affinity": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "With id_slot=-1, send prompts sharing a prefix to the same server slot to reuse its KV cache"
+                }),
+                "affinity_prefix_chars": ("INT", {
+                    "default": 512,
+                    "min": 16,
+                    "max": 1000000,
+                    "tooltip": "Leading characters of the prompt hashed for slot affinity"
+                }),
+                "slot_checkpoint": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Save the KV cache of long shared prompt prefixes with /slots and restore it before requests that reuse them (needs --slot-save-path)"
+                }),
+                "checkpoint_prefix_chars": ("INT", {
+                    "default": 2048,
+                    "min": 64,
+                    "max": 1000000,
+                    "tooltip": "Completion prompts at least this long are checkpointed by their first N characters; chats by their system messages"
+                }),
+                
+                # Sampler Order
+                "samplers": ("STRING", {
+                    "default": '["dry", "top_k", "typ_p", "top_p", "min_p", "xtc", "temperature"]',
+                    "multiline": False,
+                    "tooltip": "JSON array defining sampler order"
+                }),
+                
+                # Timing Constraints
+                "t_max_predict_ms": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 60000,
+                    "tooltip": "Maximum prediction time in milliseconds"
+                }),
+                
+                # Batch execution
+                "batch_prompts": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of prompts, message lists or input overrides; each is sent as its own request"
+                }),
+                "batch_concurrency": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 1024,
+                    "tooltip": "Maximum concurrent batch requests (0 = server slot count from /props)"
+                }),
+                
+                # Output formatting
+                "raw_response_mode": (["auto", "raw", "pretty", "off"], {
+                    "default": "auto",
+                    "tooltip": "raw_response: server body as-is ('raw'), re-indented JSON ('pretty'), empty ('off'), or raw only when connected ('auto')"
+                }),
+                
+                # Chat-specific parameters
+                "messages": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of chat messages (for chat_completions endpoint)"
+                }),
+                "system_message": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "System message for chat"
+                }),
+                "user_message": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "User message for chat"
+                }),
+                "assistant_message": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Assistant message for chat (for prefilling)"
+                }),
+                "max_tokens": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 100000,
+                    "tooltip": "Maximum tokens in response (OpenAI style)"
+                }),
+                "context_fit": (["off", "drop", "summarize"], {
+                    "default": "off",
+                    "tooltip": "Fit long chat histories into the context: drop the oldest turns, or replace them with a summary written by the model"
+                }),
+                "context_budget": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 10000000,
+                    "tooltip": "Token budget for the messages (0 = the server's n_ctx minus max_tokens, or minus a quarter of n_ctx when max_tokens is -1)"
+                }),
+                "keep_recent_turns": ("INT", {
+                    "default": 2,
+                    "min": 1,
+                    "max": 1000,
+                    "tooltip": "Most recent turns (a user message and its replies) that context_fit never drops"
+                }),
+                "model": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Model name/alias"
+                }),
+                
+                # Function calling
+                "tools": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of available tools/functions"
+                }),
+                "tool_choice": ("STRING", {
+                    "default": "auto",
+                    "multiline": False,
+                    "tooltip": "Tool choice strategy"
+                }),
+                
+                # Response format
+                "response_format": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "JSON object defining response format"
+                }),
+                
+                # Embeddings-specific
+                "input_text": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Input text for embeddings"
+                }),
+                "encoding_format": (["float", "base64"], {
+                    "default": "float",
+                    "tooltip": "Encoding format for embeddings"
+                }),
+                "embd_normalize": ("INT", {
+                    "default": 2,
+                    "min": -1,
+                    "max": 10,
+                    "tooltip": "Embedding normalization type"
+                }),
+                "embedding_store_dir": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Directory of a persistent embedding store; only texts not stored yet are sent to the server"
+                }),
+                
+                # Tokenization
+                "content": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Content to tokenize/detokenize"
+                }),
+                "tokens": ("STRING", {
+                    "default": "[]",
+                    "multiline": False,
+                    "tooltip": "JSON array of token IDs"
+                }),
+                "add_special": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Add special tokens during tokenization"
+                }),
+                "parse_special": ("BOOLEAN", {
+                    "default": True,
+                    "tooltip": "Parse special tokens during tokenization"
+                }),
+                "with_pieces": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Return token pieces with IDs"
+                }),
+                
+                # Infill-specific
+                "input_prefix": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Code prefix for infill"
+                }),
+                "input_suffix": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Code suffix for infill"
+                }),
+                "input_extra": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of additional context files"
+                }),
+                
+                # Reranking-specific
+                "query": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Query for reranking"
+                }),
+                "documents": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of documents to rank"
+                }),
+                "top_n": ("INT", {
+                    "default": 10,
+                    "min": 1,
+                    "max": 1000,
+                    "tooltip": "Number of top results to return"
+                }),
+                "rerank_batch_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "tooltip": "Split documents into concurrent /v1/rerank calls of this size and merge the top_n (0 = one call)"
+                }),
+                
+                # LoRA adapters
+                "lora": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of LoRA adapter configurations"
+                }),
+                
+                # Response fields selection
+                "response_fields": ("STRING", {
+                    "default": "[]",
+                    "multiline": False,
+                    "tooltip": "JSON array of specific response fields to return"
+                }),
+                
+                # Multimodal support
+                "image_data": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of image data objects"
+                }),
+                "image": ("IMAGE", {
+                    "tooltip": "Images for multimodal completion/chat (every frame of the batch is sent)"
+                }),
+                "image_max_size": ("INT", {
+                    "default": 1024,
+                    "min": 0,
+                    "max": 8192,
+                    "tooltip": "Downscale images so the longest side is at most this many pixels (0 = original size)"
+                }),
+                "image_format": (["JPEG", "PNG"], {
+                    "default": "JPEG",
+                    "tooltip": "Encoding used to send images"
+                }),
+                "image_quality": ("INT", {
+                    "default": 90,
+                    "min": 1,
+                    "max": 100,
+                    "tooltip": "JPEG quality"
+                }),
+                "telemetry_log": ("STRING", {
+                    "default": "",
+                    "tooltip": "Append one JSON line per request to this file (empty = off)"
+                }),
+                "telemetry_log_max_mb": ("INT", {
+                    "default": 10,
+                    "min": 1,
+                    "max": 1024,
+                    "tooltip": "Rotate the telemetry log at this size"
+                }),
+                "telemetry_port": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65535,
+                    "tooltip": "Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (0 = off)"
+                }),
+            },
+            "hidden": {
+                "graph_prompt": "PROMPT",
+                "unique_id": "UNIQUE_ID",
+            }
+        }
+    
+    @staticmethod
+    def _task_inputs(required: Dict[str, Any], optional: Dict[str, Any]) -> Dict[str, Any]:
+        """INPUT_TYPES of the task nodes: their own inputs between the shared server_url, api_key and timeout."""
+        return {
+            "required": {
+                "server_url": ("STRING", {
+                    "default": "http://127.0.0.1:8080",
+                    "multiline": False,
+                    "tooltip": "Base URL of the llama-server instance, or several comma-separated URLs (optional '=weight') to load-balance"
+                }),
+                **required,
+            },
+            "optional": {
+                "api_key": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "API key for authentication (if required)"
+                }),
+                "timeout": ("INT", {
+                    "default": 600,
+                    "min": 1,
+                    "max": 3600,
+                    "tooltip": "Request timeout in seconds"
+                }),
+                **optional,
+            },
+        }
+    
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "INT", "STRING")
+    RETURN_NAMES = ("response", "raw_response", "error", "status_code", "telemetry")
+    FUNCTION = "process_request"
+    CATEGORY = "AI/LlamaCpp"
+    
+    @classmethod
+    def IS_CHANGED(cls, server_url: str = "", endpoint: str = "completion", prompt: str = "", **kwargs):
+        """Fingerprint of the node inputs and the server's model identity for ComfyUI's execution cache."""
+        batch_prompts = kwargs.get("batch_prompts") or ""
+        items = [None]
+        if isinstance(batch_prompts, list) or batch_prompts.strip() not in ("", "[]"):
+            try:
+                items = json.loads(batch_prompts) if isinstance(batch_prompts, str) else batch_prompts
+            except ValueError:
+                return float("nan")
+            if not isinstance(items, list):
+                return float("nan")
+        path = ENDPOINT_PATHS.get(endpoint, "")
+        for item in items:
+            # Dict batch items override node inputs such as seed and temperature
+            sampling = dict(kwargs, **item) if isinstance(item, dict) and "role" not in item else kwargs
+            if not is_deterministic(path, {"temperature": sampling.get("temperature"), "seed": sampling.get("seed", -1)}):
+                return float("nan")  # NaN never equals itself, so ComfyUI always re-executes
+        return cls._input_fingerprint(server_url, dict(kwargs, endpoint=endpoint, prompt=prompt))
+    
+    @staticmethod
+    def _input_fingerprint(server_url: str, inputs: Dict[str, Any]):
+        """Hash of the node inputs and the identity of every model behind `server_url` (NaN if a server is down)."""
+        api_key = inputs.get("api_key", "")
+        identities = []
+        for replica in LoadBalancerRegistry.parse(server_url or ""):
+            # With the inputs as options, a replayed cassette answers instead of the server
+            props = PROPS.get(replica.url, api_key, options=inputs)
+            if not props:
+                return float("nan")
+            identities.append(PROPS.identity(props))
+        if not identities:
+            return float("nan")
+        hidden = ("graph_prompt", "unique_id", "api_key")
+        return canonical_hash(fingerprint_value({key: value for key, value in inputs.items() if key not in hidden}),
+                              identities)
+    
+    def process_request(self, server_url: str, endpoint: str, prompt: str, **kwargs):
+        """Process the request to llama-server with all provided parameters."""
+        
+        records = []
+        token = TELEMETRY_RECORDS.set(records)
+        try:
+            TELEMETRY.configure(log_max_mb=kwargs.get("telemetry_log_max_mb"), port=kwargs.get("telemetry_port", 0))
+            server_url = self._resolve_server(server_url, kwargs)
+            
+            # raw_response is only materialized when something downstream reads it
+            raw_mode = kwargs.get("raw_response_mode", "auto")
+            linked = output_is_linked(kwargs.pop("graph_prompt", None), kwargs.pop("unique_id", None), 1)
+            want_raw = raw_mode != "off" and not (raw_mode == "auto" and linked is False)
+            
+            batch_prompts = kwargs.get("batch_prompts") or ""
+            if isinstance(batch_prompts, list) or batch_prompts.strip() not in ("", "[]"):
+                response, raw_response, error, status_code = self._process_batch(
+                    server_url, endpoint, prompt, batch_prompts, kwargs, want_raw)
+            else:
+                response, raw_response, error, status_code = self._dispatch(server_url, endpoint, prompt, **kwargs)
+            
+            raw_response = self._format_raw_response(response, raw_response, raw_mode, want_raw)
+            return response, raw_response, error, status_code, self._format_telemetry(records)
+            
+        except Exception as e:
+            return "", "", f"Error processing request: {str(e)}", 500, self._format_telemetry(records)
+        finally:
+            TELEMETRY_RECORDS.reset(token)
+    
+    @staticmethod
+    def _format_telemetry(records: List[Dict[str, Any]]) -> str:
+        return json_dumps_bytes({"requests": records}).decode("utf-8")
+    
+    @staticmethod
+    def _format_raw_response(response: Any, raw_response: Optional[str], raw_mode: str, want_raw: bool) -> str:
+        """Produce the raw_response output for `raw_response_mode`."""
+        if not want_raw:
+            return ""
+        if raw_mode == "pretty" and response not in ("", None):
+            return json.dumps(response, indent=2, ensure_ascii=False)
+        if raw_response is None:
+            return json_dumps_bytes(response).decode("utf-8")
+        return raw_response
+    
+    def _dispatch(self, server_url: str, endpoint: str, prompt: str, **kwargs):
+        """Build and send the request for `endpoint`."""
+        BUILD_STARTED.set(time.perf_counter())
+        if endpoint == "completion":
+            return self._handle_completion(server_url, prompt, **kwargs)
+        elif endpoint == "chat_completions":
+            return self._handle_chat_completions(server_url, **kwargs)
+        elif endpoint == "embeddings":
+            return self._handle_embeddings(server_url, **kwargs)
+        elif endpoint == "tokenize":
+            return self._handle_tokenize(server_url, **kwargs)
+        elif endpoint == "detokenize":
+            return self._handle_detokenize(server_url, **kwargs)
+        elif endpoint == "apply_template":
+            return self._handle_apply_template(server_url, **kwargs)
+        elif endpoint == "infill":
+            return self._handle_infill(server_url, **kwargs)
+        elif endpoint == "reranking":
+            return self._handle_reranking(server_url, **kwargs)
+        else:
+            return "", "", f"Unsupported endpoint: {endpoint}", 400
+    
+    def _build_request(self, server_url: str, endpoint: str, prompt: str, **kwargs):
+        """Build (url, params) for `endpoint` without sending anything."""
+        if endpoint == "completion":
+            return self._build_completion(server_url, prompt, **kwargs)
+        builder = getattr(self, f"_build_{endpoint}", None)
+        if builder is None:
+            raise ValueError(f"Unsupported endpoint: {endpoint}")
+        return builder(server_url, **kwargs)
+    
+    def _process_batch(self, server_url: str, endpoint: str, prompt: str, batch_prompts: Union[str, List[Any]],
+                       kwargs: Dict[str, Any], want_raw: bool = True):
+        """Run one request per batch item (prompt, message list or input overrides) on a bounded worker pool."""
+        items = json.loads(batch_prompts) if isinstance(batch_prompts, str) else batch_prompts
+        if not isinstance(items, list):
+            return "", "", "batch_prompts must be a JSON array", 400
+        
+        concurrency = kwargs.get("batch_concurrency", 0) or self._server_parallelism(server_url, kwargs)
+        
+        if kwargs.get("transport") == "asyncio" and not (endpoint == "embeddings" and kwargs.get("embedding_store_dir")):
+            # Every request in flight at once on the shared event loop, no thread per item
+            telemetry = []
+            results = LOOP.run(self._process_batch_async(
+                server_url, endpoint, prompt, items, kwargs, concurrency, telemetry))
+            records = TELEMETRY_RECORDS.get()
+            if records is not None:
+                records.extend(telemetry)
+        else:
+            def run(item):
+                item_prompt, item_kwargs = self._batch_item_inputs(endpoint, prompt, item, kwargs)
+                try:
+                    return self._dispatch(server_url, endpoint, item_prompt, **item_kwargs)
+                except Exception as e:
+                    return "", "", f"Error processing request: {str(e)}", 500
+            
+            results = run_bounded(run, items, concurrency)
+        
+        responses = [result[0] for result in results]
+        failed = [result for result in results if result[2] or result[3] >= 400]
+        error = f"{len(failed)} of {len(items)} requests failed" if failed else ""
+        status_code = max((result[3] for result in failed), default=200)
+        raw_response = ""
+        if want_raw:
+            entries = [
+                {"index": index, "response": response, "error": item_error, "status_code": item_status}
+                for index, (response, _, item_error, item_status) in enumerate(results)
+            ]
+            raw_response = json_dumps_bytes(entries).decode("utf-8")
+        return responses, raw_response, error, status_code
+    
+    async def _process_batch_async(self, server_url: str, endpoint: str, prompt: str, items: List[Any],
+                                   kwargs: Dict[str, Any], concurrency: int,
+                                   telemetry: Optional[List[Dict[str, Any]]] = None):
+        """Send every batch item from the event loop, at most `concurrency` at a time."""
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        
+        async def run(item):
+            item_prompt, item_kwargs = self._batch_item_inputs(endpoint, prompt, item, kwargs)
+            try:
+                started = time.perf_counter()
+                if item_kwargs.get("context_fit", "off") != "off":
+                    # Fitting the history talks to the server, which must not block the loop
+                    url, params = await LOOP.to_thread(self._build_request, server_url, endpoint, item_prompt,
+                                                       **item_kwargs)
+                else:
+                    url, params = self._build_request(server_url, endpoint, item_prompt, **item_kwargs)
+                build_ms = (time.perf_counter() - started) * 1000.0
+                rerank_batch_size = item_kwargs.get("rerank_batch_size", 0) if endpoint == "reranking" else 0
+                async with semaphore:
+                    if rerank_batch_size and len(params["documents"]) > rerank_batch_size:
+                        # Like `_handle_reranking`: chunked calls merged into one top_n
+                        response, error, status_code = await self._rerank_chunked_async(
+                            url, params, rerank_batch_size, concurrency, item_kwargs,
+                            telemetry if telemetry is not None else [])
+                        return response, None, error, status_code
+                    item_telemetry = RequestTelemetry(url, build_ms)
+                    result = await self._request_async(url, params, item_kwargs, item_telemetry)
+                if telemetry is not None:
+                    telemetry.append(item_telemetry.record)
+                return result
+            except Exception as e:
+                return "", "", f"Error processing request: {str(e)}", 500
+        
+        return await asyncio.gather(*(run(item) for item in items))
+    
+    @staticmethod
+    def _batch_item_inputs(endpoint: str, prompt: str, item: Any, kwargs: Dict[str, Any]):
+        """Node inputs for one batch item: the shared inputs with the item's fields applied."""
+        item_kwargs = {key: value for key, value in kwargs.items() if key != "batch_prompts"}
+        if isinstance(item, dict) and "role" not in item:
+            item_kwargs.update(item)
+            return item_kwargs.pop("prompt", prompt), item_kwargs
+        
+        field = BATCH_ITEM_FIELDS.get(endpoint, "prompt")
+        if endpoint == "chat_completions" and isinstance(item, list):
+            # A message list is the whole conversation
+            item_kwargs.update(messages=json.dumps(item), system_message="", user_message="", assistant_message="")
+        elif isinstance(item, (list, dict)):
+            item_kwargs[field] = json.dumps(item)
+        else:
+            item_kwargs[field] = str(item)
+        return item_kwargs.pop("prompt", prompt), item_kwargs
+    
+    def _server_parallelism(self, server_url: str, kwargs: Dict[str, Any]) -> int:
+        """Total request slots the server (or all balanced replicas) can process at once."""
+        api_key = kwargs.get("api_key", "")
+        if BALANCERS.is_balanced(server_url):
+            replicas = BALANCERS.get(server_url).replicas
+            total = sum(PROPS.get(replica.url, api_key, options=kwargs).get("total_slots") or 1 for replica in replicas)
+        else:
+            total = PROPS.get(server_url, api_key, options=kwargs).get("total_slots") or 1
+        return max(int(total), 1)
+    
+    def _resolve_server(self, server_url: str, kwargs: Dict[str, Any]) -> str:
+        """Apply connection settings and turn `server_url` into the base URL handlers build on."""
+        # Apply connection pool settings to both transports
+        pool_settings = {
+            "pool_maxsize": kwargs.get("pool_maxsize"),
+            "keep_alive": kwargs.get("keep_alive"),
+            "idle_timeout": kwargs.get("idle_timeout"),
+        }
+        SESSIONS.configure(**pool_settings)
+        ASYNC_HTTP.configure(**pool_settings)
+        BREAKERS.configure(failure_threshold=kwargs.get("circuit_threshold"), reset_timeout=kwargs.get("circuit_reset"))
+        # Several replicas resolve to a load-balanced lb:// base URL; replay needs no health checks
+        health_interval = 0 if kwargs.get("cassette_mode") == "replay" else kwargs.get("health_interval", 5)
+        return BALANCERS.resolve(server_url, kwargs.get("api_key", ""), health_interval)
+    
+    def _make_request(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                      options: Optional[Dict[str, Any]] = None):
+        """Make HTTP request to llama-server; the requests transport runs on the calling thread."""
+        # The build phase is the time since the handler started (only the first request of a handler gets one)
+        build_started = BUILD_STARTED.get()
+        BUILD_STARTED.set(None)
+        build_ms = (time.perf_counter() - build_started) * 1000.0 if build_started is not None else None
+        telemetry = RequestTelemetry(url, build_ms)
+        try:
+            return self._make_request_sync(url, data, api_key, timeout, options, telemetry)
+        finally:
+            records = TELEMETRY_RECORDS.get()
+            if records is not None:
+                records.append(telemetry.record)
+    
+    def _request(self, url: str, data: Dict[str, Any], kwargs: Dict[str, Any]):
+        """`_make_request` with the api_key, timeout and request options taken from a node's inputs."""
+        return self._make_request(url, data, kwargs.get("api_key", ""), kwargs.get("timeout", 600), kwargs)
+    
+    def _request_async(self, url: str, data: Dict[str, Any], kwargs: Dict[str, Any],
+                       telemetry: Optional[RequestTelemetry] = None):
+        """Coroutine form of `_request`."""
+        return self._make_request_async(url, data, kwargs.get("api_key", ""), kwargs.get("timeout", 600), kwargs,
+                                        telemetry)
+    
+    @staticmethod
+    def _side_options(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Options for the client's own requests: never cached, hedged, retried or routed by prefix."""
+        return dict(options or {}, response_cache="off", slot_affinity=False, slot_checkpoint=False,
+                    hedge_percentile=0, max_retries=0)
+    
+    def _side_request(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                      options: Optional[Dict[str, Any]] = None):
+        """Send a side request through the pipeline from synchronous code (never from the event loop)."""
+        return self._make_request_sync(url, data, api_key, timeout, self._side_options(options))
+    
+    def _slot_sender(self, api_key: str, options: Dict[str, Any]):
+        """`send` for SlotCheckpoints; slot actions only happen on live requests, so they are never recorded."""
+        options = dict(self._side_options(options), cassette_mode="off", coalesce_requests=False)
+        return lambda url, body, timeout=CHECKPOINTS.timeout: self._make_request_sync(url, body, api_key, timeout,
+                                                                                       options)
+    
+    def _make_request_sync(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                           options: Optional[Dict[str, Any]] = None,
+                           telemetry: Optional[RequestTelemetry] = None):
+        """Run the request pipeline from synchronous code (never from the event loop)."""
+        options = options or {}
+        telemetry = telemetry or RequestTelemetry(url)
+        if options.get("transport") == "asyncio":
+            return LOOP.run(self._make_request_async(url, data, api_key, timeout, options, telemetry))
+        result = ("", None, "Request failed", 500)
+        try:
+            if not options.get("coalesce_requests", True) or not is_deterministic(url, data):
+                result = self._cached_request(url, data, api_key, timeout, options, telemetry)
+                return result
+            
+            def lead():
+                # Only the request that actually goes out runs this; the rest share its result
+                telemetry.set(coalesced=False)
+                return self._cached_request(url, data, api_key, timeout, options, telemetry)
+            
+            telemetry.set(coalesced=True)
+            result = SINGLE_FLIGHT.call(self._coalesce_key(url, data, api_key), lead)
+            return result
+        finally:
+            TELEMETRY.observe(telemetry.finish(result), options.get("telemetry_log", ""))
+    
+    async def _make_request_async(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                                  options: Optional[Dict[str, Any]] = None,
+                                  telemetry: Optional[RequestTelemetry] = None):
+        """Run the request pipeline from the event loop."""
+        options = options or {}
+        telemetry = telemetry or RequestTelemetry(url)
+        if options.get("transport") != "asyncio":
+            return await LOOP.to_thread(self._make_request_sync, url, data, api_key, timeout, options, telemetry)
+        result = ("", None, "Request failed", 500)
+        try:
+            if not options.get("coalesce_requests", True) or not is_deterministic(url, data):
+                result = await self._cached_request_async(url, data, api_key, timeout, options, telemetry)
+                return result
+            
+            def lead():
+                telemetry.set(coalesced=False)
+                return self._cached_request_async(url, data, api_key, timeout, options, telemetry)
+            
+            telemetry.set(coalesced=True)
+            result = await SINGLE_FLIGHT.run(self._coalesce_key(url, data, api_key), lead)
+            return result
+        finally:
+            TELEMETRY.observe(telemetry.finish(result), options.get("telemetry_log", ""))
+    
+    @staticmethod
+    def _coalesce_key(url: str, data: Dict[str, Any], api_key: str) -> str:
+        return canonical_hash(url, data, hashlib.sha256(api_key.encode("utf-8")).hexdigest())
+    
+    @staticmethod
+    def _use_cache(url: str, data: Dict[str, Any], options: Dict[str, Any], telemetry: RequestTelemetry) -> bool:
+        """Whether the response cache applies to this request; configures the cache when it does."""
+        cache_mode = options.get("response_cache", "off")
+        if cache_mode == "off" or (cache_mode == "deterministic" and not is_deterministic(url, data)):
+            telemetry.set(cache="off" if cache_mode == "off" else "bypass")
+            return False
+        RESPONSE_CACHE.configure(
+            max_entries=options.get("cache_max_entries"),
+            db_path=options.get("cache_db_path"),
+        )
+        return True
+    
+    @staticmethod
+    def _cache_key(url: str, data: Dict[str, Any], api_key: str, identity: str) -> str:
+        """Response cache key; responses are never shared between API keys."""
+        return canonical_hash(endpoint_path(url), data, identity, hashlib.sha256(api_key.encode("utf-8")).hexdigest())
+    
+    @staticmethod
+    def _cache_entry(result: tuple) -> Optional[Dict[str, Any]]:
+        """What the response cache keeps of a result; None for failures, which are never cached."""
+        response, raw_response, error, status_code = result
+        if error or status_code != 200:
+            return None
+        return {"response": response, "raw_response": raw_response, "status_code": status_code}
+    
+    def _cached_request(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                        options: Dict[str, Any], telemetry: RequestTelemetry):
+        """Serve deterministic requests from the response cache, sending the rest."""
+        if not self._use_cache(url, data, options, telemetry):
+            return self._recorded_request(url, data, api_key, timeout, options, telemetry)
+        identity = PROPS.model_identity(url, api_key, 10, options)
+        key = self._cache_key(url, data, api_key, identity)
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            telemetry.set(cache="hit")
+            return cached["response"], cached["raw_response"], "", cached["status_code"]
+        
+        telemetry.set(cache="miss")
+        result = self._recorded_request(url, data, api_key, timeout, options, telemetry)
+        entry = self._cache_entry(result)
+        if entry is not None:
+            RESPONSE_CACHE.put(key, entry, ttl=options.get("cache_ttl", 3600))
+        return result
+    
+    async def _cached_request_async(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                                    options: Dict[str, Any], telemetry: RequestTelemetry):
+        """Async form of `_cached_request`; only /props fetches and SQLite reads leave the loop."""
+        if not self._use_cache(url, data, options, telemetry):
+            return await self._recorded_request_async(url, data, api_key, timeout, options, telemetry)
+        props = PROPS.cached(url, options)
+        if props is not None:
+            identity = PROPS.identity(props)
+        else:
+            identity = await LOOP.to_thread(PROPS.model_identity, url, api_key, 10, options)
+        key = self._cache_key(url, data, api_key, identity)
+        if RESPONSE_CACHE.persistent:
+            cached = await LOOP.to_thread(RESPONSE_CACHE.get, key)
+        else:
+            cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            telemetry.set(cache="hit")
+            return cached["response"], cached["raw_response"], "", cached["status_code"]
+        
+        telemetry.set(cache="miss")
+        result = await self._recorded_request_async(url, data, api_key, timeout, options, telemetry)
+        entry = self._cache_entry(result)
+        if entry is not None:
+            if RESPONSE_CACHE.persistent:
+                await LOOP.to_thread(RESPONSE_CACHE.put, key, entry, ttl=options.get("cache_ttl", 3600))
+            else:
+                RESPONSE_CACHE.put(key, entry, ttl=options.get("cache_ttl", 3600))
+        return result
+    
+    @staticmethod
+    def _cassette_enabled(options: Dict[str, Any]) -> bool:
+        return options.get("cassette_mode", "off") != "off" and bool(options.get("cassette_path"))
+    
+    def _cassette_replay(self, url: str, data: Dict[str, Any], options: Dict[str, Any],
+                         telemetry: RequestTelemetry):
+        """Look the request up in the cassette; returns (cassette, key, result or None)."""
+        mode = options["cassette_mode"]
+        cassette = CASSETTES.get(options["cassette_path"])
+        key = Cassette.request_key(url, data)
+        if mode in ("replay", "replay_or_live"):
+            entry = cassette.get(key)
+            if entry is not None:
+                telemetry.set(cassette="hit")
+                return cassette, key, self._replay_entry(url, entry)
+            if mode == "replay":
+                telemetry.set(cassette="miss")
+                return cassette, key, ("", "", f"Cassette miss: {endpoint_path(url)} was not recorded in {cassette.path}", 404)
+        return cassette, key, None
+    
+    @staticmethod
+    def _cassette_record(cassette: Cassette, key: bytes, url: str, data: Dict[str, Any], result: tuple,
+                         events: Optional[List[str]], options: Dict[str, Any], telemetry: RequestTelemetry):
+        """Append a live exchange to the cassette (blocking file I/O); failures are not recorded."""
+        response, raw_response, error, status_code = result
+        telemetry.set(cassette="miss" if options["cassette_mode"] == "replay_or_live" else "record")
+        if not error and status_code < 400:
+            entry = {"endpoint": endpoint_path(url), "request": data, "status_code": status_code}
+            if events:
+                entry["events"] = events
+            else:
+                entry["response"] = response
+                entry["raw_response"] = raw_response
+            cassette.put(key, entry)
+    
+    def _recorded_request(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                          options: Dict[str, Any], telemetry: RequestTelemetry):
+        """Record exchanges to, or replay them from, the cassette selected by `cassette_mode`."""
+        if not self._cassette_enabled(options):
+            return self._resilient_request(url, data, api_key, timeout, options, telemetry)
+        cassette, key, replayed = self._cassette_replay(url, data, options, telemetry)
+        if replayed is not None:
+            return replayed
+        events = [] if data.get("stream") else None
+        result = self._resilient_request(url, data, api_key, timeout, options, telemetry, events)
+        self._cassette_record(cassette, key, url, data, result, events, options, telemetry)
+        return result
+    
+    async def _recorded_request_async(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                                      options: Dict[str, Any], telemetry: RequestTelemetry):
+        """Async form of `_recorded_request`."""
+        if not self._cassette_enabled(options):
+            return await self._resilient_request_async(url, data, api_key, timeout, options, telemetry)
+        cassette, key, replayed = await LOOP.to_thread(self._cassette_replay, url, data, options, telemetry)
+        if replayed is not None:
+            return replayed
+        events = [] if data.get("stream") else None
+        result = await self._resilient_request_async(url, data, api_key, timeout, options, telemetry, events)
+        await LOOP.to_thread(self._cassette_record, cassette, key, url, data, result, events, options, telemetry)
+        return result
+    
+    def _replay_entry(self, url: str, entry: Dict[str, Any]):
+        """Turn a cassette entry back into a request result; streams are re-assembled from their events."""
+        if "events" in entry:
+            accumulator = StreamAccumulator(chat=url.endswith("/chat/completions"))
+            for payload in entry["events"]:
+                accumulator.feed(payload)
+            return self._stream_result(accumulator, entry["status_code"])
+        return entry["response"], entry.get("raw_response"), "", entry["status_code"]
+    
+    @staticmethod
+    def _retries(url: str, options: Dict[str, Any]) -> int:
+        """How many times a failed request may be retried; only idempotent endpoints are."""
+        return options.get("max_retries", 2) if endpoint_path(url) in IDEMPOTENT_PATHS else 0
+    
+    @staticmethod
+    def _retry_delay(options: Dict[str, Any], attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt`."""
+        return random.uniform(0, min(options.get("retry_backoff", 0.25) * 2 ** (attempt - 1), 30.0))
+    
+    @staticmethod
+    def _retryable(result: tuple) -> bool:
+        return result[3] in RETRY_STATUS and not result[2].startswith(CIRCUIT_OPEN_ERROR)
+    
+    def _resilient_request(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                           options: Dict[str, Any], telemetry: RequestTelemetry,
+                           events: Optional[List[str]] = None):
+        """Retry idempotent requests with full-jitter exponential backoff, preferring untried replicas."""
+        tried = set()
+        for attempt in range(self._retries(url, options) + 1):
+            if attempt:
+                time.sleep(self._retry_delay(options, attempt))
+            result = self._send_request(url, data, api_key, timeout, options, telemetry, events, tried)
+            telemetry.set(attempts=attempt + 1)
+            if not self._retryable(result):
+                break
+        return result
+    
+    async def _resilient_request_async(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                                       options: Dict[str, Any], telemetry: RequestTelemetry,
+                                       events: Optional[List[str]] = None):
+        """Async form of `_resilient_request`, with hedging."""
+        tried = set()
+        for attempt in range(self._retries(url, options) + 1):
+            if attempt:
+                await asyncio.sleep(self._retry_delay(options, attempt))
+            result = await self._hedged_request(url, data, api_key, timeout, options, telemetry, events, tried)
+            telemetry.set(attempts=attempt + 1)
+            if not self._retryable(result):
+                break
+        return result
+    
+    async def _hedged_request(self, url: str, data: Dict[str, Any], api_key: str, timeout: int,
+                              options: Dict[str, Any], telemetry: RequestTelemetry,
+                              events: Optional[List[str]], tried: set):
+        """Send a request, hedging it to another replica past `hedge_percentile` (asyncio transport only)."""
+        key = (SessionRegistry.base_url(url), endpoint_path(url))
+        delay = None
+        percentile = options.get("hedge_percentile", 0)
+        if percentile > 0 and not data.get("stream") and BALANCERS.is_balanced(url) \
+                and len(BALANCERS.get(url).replicas) > 1:
+            delay = LATENCY.percentile(key, percentile)
+        
+        started = time.perf_counter()
+        if delay is None:
+            result = await self._send_request_async(url, data, api_key, timeout, options, telemetry, events, tried)
+        else:
+            result = await self._hedge(url, data, api_key, timeout, options, telemetry, tried, delay)
+        
+        if not result[2] and result[3] < 400:
+            LATENCY.observe(key, time.perf_counter() - started)
+        return result
+    
+    async def _hedge(self, url: str, data: Dict[str, Any], api_key: str, timeout: int, options: Dict[str, Any],
+                     telemetry: RequestTelemetry, tried: set, delay: float):
+        primary = asyncio.ensure_future(self._send_request_async(
+            url, data, api_key, timeout, options, telemetry, None, tried))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+            # The hedge gets its own telemetry; the record keeps the primary's phases
+            hedge = asyncio.ensure_future(self._send_request_async(
+                url, data, api_key, timeout, options, RequestTelemetry(url), None, tried))
+            result, winner = await self._first_success([primary, hedge])
+            telemetry.set(hedged=True, hedge_won=winner is hedge)
+            return result
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+    
+    @staticmethod
+    async def _first_success(tasks: List[asyncio.Future]):
+        """Wait for the first successful result among `tasks`; if all fail, return the first task's result."""
+        pending = set(tasks)
+        results = {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    results[task] = ("", "", f"Request error: {task.exception()}", 500)
+                    continue
+                result = task.result()
+                if not result[2] and result[3] < 400:
+                    return result, task
+                results[task] = result
+        return results[tasks[0]], tasks[0]
+    
+    @staticmethod
+    def _plan_attempt(url: str, data: Dict[str, Any], options: Dict[str, Any], tried: set,
+                      telemetry: RequestTelemetry):
+        """Choose the replica and slot for one attempt, or return a result when it must not be sent."""
+        if interrupt_requested():
+            # Batch items and retries queued behind an interrupt are not sent at all
+            return "", "", INTERRUPTED_ERROR, INTERRUPTED_STATUS
+        affinity_key = None
+        route = None
+        checkpoint_key = None
+        if options.get("slot_checkpoint") and data.get("cache_prompt", True):
+            checkpoint_key = SlotCheckpoints.prefix_key(url, data, options.get("checkpoint_prefix_chars", 2048))
+        if data.get("id_slot", -1) == -1:
+            if options.get("slot_affinity"):
+                affinity_key = PrefixAffinity.prefix_key(url, data, options.get("affinity_prefix_chars", 512))
+            # Checkpoints live in a slot, so checkpointed prefixes are pinned to one
+            affinity_key = affinity_key or checkpoint_key
+            if affinity_key is not None:
+                route = AFFINITY.lookup(affinity_key)
+        
+        replica_set = replica = None
+        target = url
+        if BALANCERS.is_balanced(url):
+            replica_set = BALANCERS.get(url)
+            avoid = tried | {r.url for r in replica_set.replicas if BREAKERS.state(r.url) == "open"}
+            if len(avoid) >= len(replica_set.replicas):
+                avoid = {r.url for r in replica_set.replicas if BREAKERS.state(r.url) == "open"}
+            replica = replica_set.acquire(exclude=avoid, prefer=route[0] if route else None)
+            tried.add(replica.url)
+            target = BALANCERS.rewrite(url, replica)
+        
+        server = SessionRegistry.base_url(target)
+        if not BREAKERS.allow(server):
+            if replica_set is not None:
+                replica_set.release(replica)
+            telemetry.set(server=server)
+            return "", "", f"{CIRCUIT_OPEN_ERROR} for {server}", 503
+        return {"affinity_key": affinity_key, "checkpoint_key": checkpoint_key, "replica_set": replica_set,
+                "replica": replica, "target": target, "server": server,
+                "slot": route[1] if route is not None and route[0] == server else None}
+    
+    @staticmethod
+    def _attempt_slot(attempt: Dict[str, Any], props: Dict[str, Any]) -> int:
+        """The slot the attempt's prefix is pinned to, assigned from the server's `/props` on first use."""
+        if attempt["slot"] is not None:
+            return attempt["slot"]
+        return AFFINITY.assign(attempt["affinity_key"], attempt["server"], props.get("total_slots") or 1)
+    
+    def _checkpoint(self, url: str, attempt: Dict[str, Any], data: Dict[str, Any], api_key: str, timeout: int,
+                    options: Dict[str, Any]):
+        """Restore the attempt's prefix checkpoint into its slot, or evaluate and save it (blocking I/O)."""
+        server = attempt["server"]
+        identity = PROPS.model_identity(server, api_key, 10, options)
+        checkpoint = (data["id_slot"], SlotCheckpoints.filename(attempt["checkpoint_key"], identity))
+        send = self._slot_sender(api_key, options)
+        if CHECKPOINTS.prepare(send, server, *checkpoint):
+            prefix = SlotCheckpoints.prefix_request(url, data, options.get("checkpoint_prefix_chars", 2048))
+            CHECKPOINTS.commit(send, server, *checkpoint, attempt["target"], prefix, timeout)
+    
+    @staticmethod
+    def _settle_attempt(attempt: Dict[str, Any], data: Dict[str, Any], result: tuple) -> bool:
+        """Record an attempt's outcome with the circuit breaker and slot checkpoints; returns whether it failed."""
+        server = attempt["server"]
+        if attempt["checkpoint_key"] is None and endpoint_path(attempt["target"]) in SLOT_PATHS:
+            # Whatever this request evaluated replaced the prefix a checkpointed slot held
+            slot = data.get("id_slot", -1)
+            if slot == -1 and isinstance(result[0], dict):
+                slot = result[0].get("id_slot", -1)
+            if isinstance(slot, int) and slot >= 0:
+                CHECKPOINTS.evict(server, slot)
+        if result[3] == INTERRUPTED_STATUS:
+            BREAKERS.release(server)
+        else:
+            # A loading or saturated server (429, busy 503) is healthy; only a dead one trips the circuit
+            BREAKERS.record(server, success=not replica_unhealthy(result))
+        if attempt["affinity_key"] is not None:
+            AFFINITY.observe(result[0])
+        return replica_unhealthy(result)
+    
+    def _send_request(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                      options: Optional[Dict[str, Any]] = None,
+                      telemetry: Optional[RequestTelemetry] = None,
+                      events: Optional[List[str]] = None,
+                      tried: Optional[set] = None):
+        """Send one HTTP request with the requests transport, on the calling thread."""
+        options = options or {}
+        telemetry = telemetry or RequestTelemetry(url)
+        attempt = self._plan_attempt(url, data, options, tried if tried is not None else set(), telemetry)
+        if isinstance(attempt, tuple):
+            return attempt
+        server = attempt["server"]
+        failed = False
+        try:
+            if attempt["affinity_key"] is not None:
+                props = PROPS.get(server, api_key, 10, options) if attempt["slot"] is None else {}
+                data = dict(data, id_slot=self._attempt_slot(attempt, props))
+            if attempt["checkpoint_key"] is not None:
+                self._checkpoint(url, attempt, data, api_key, timeout, options)
+            
+            # A dead server fails within connect_timeout instead of the full read timeout
+            timeouts = (options.get("connect_timeout", 10), timeout)
+            telemetry.set(server=server, transport="requests")
+            result = self._send_direct(attempt["target"], data, api_key, timeouts, telemetry, events)
+            failed = self._settle_attempt(attempt, data, result)
+            return result
+        except BaseException:
+            failed = True
+            BREAKERS.record(server, success=False)
+            raise
+        finally:
+            if attempt["replica_set"] is not None:
+                attempt["replica_set"].release(attempt["replica"], failed=failed)
+    
+    async def _send_request_async(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: int = 600,
+                                  options: Optional[Dict[str, Any]] = None,
+                                  telemetry: Optional[RequestTelemetry] = None,
+                                  events: Optional[List[str]] = None,
+                                  tried: Optional[set] = None):
+        """Send one HTTP request to llama-server with the asyncio transport (see `_send_request`)."""
+        options = options or {}
+        telemetry = telemetry or RequestTelemetry(url)
+        attempt = self._plan_attempt(url, data, options, tried if tried is not None else set(), telemetry)
+        if isinstance(attempt, tuple):
+            return attempt
+        server = attempt["server"]
+        failed = False
+        try:
+            if attempt["affinity_key"] is not None:
+                props = {} if attempt["slot"] is not None else PROPS.cached(server, options)
+                if props is None:
+                    props = await LOOP.to_thread(PROPS.get, server, api_key, 10, options)
+                data = dict(data, id_slot=self._attempt_slot(attempt, props))
+            if attempt["checkpoint_key"] is not None:
+                await LOOP.to_thread(self._checkpoint, url, attempt, data, api_key, timeout, options)
+            
+            timeouts = (options.get("connect_timeout", 10), timeout)
+            telemetry.set(server=server, transport="asyncio")
+            result = await self._send_async(attempt["target"], data, api_key, timeouts, telemetry, events)
+            failed = self._settle_attempt(attempt, data, result)
+            return result
+        except asyncio.CancelledError:
+            # Lost a hedging race or the caller gave up; says nothing about the server
+            BREAKERS.release(server)
+            raise
+        except BaseException:
+            failed = True
+            BREAKERS.record(server, success=False)
+            raise
+        finally:
+            if attempt["replica_set"] is not None:
+                attempt["replica_set"].release(attempt["replica"], failed=failed)
+    
+    async def _send_async(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: Union[int, tuple] = 600,
+                          telemetry: Optional[RequestTelemetry] = None, events: Optional[List[str]] = None):
+        """Send one HTTP request to a single llama-server with the asyncio transport."""
+        telemetry = telemetry or RequestTelemetry(url)
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        state = {"finished": False}
+        
+        def cancel():
+            # Runs on the loop; the request may have completed since the interrupt was seen
+            if not state["finished"]:
+                task.cancel()
+        
+        token = IN_FLIGHT.register(lambda: loop.call_soon_threadsafe(cancel))
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        if data.get("stream"):
+            headers["Accept"] = "text/event-stream"
+        
+        body = b""
+        accumulator = None
+        status = None
+        try:
+            started = time.perf_counter()
+            payload = json_dumps_bytes(data)
+            sent = telemetry.phase("serialize", started)
+            telemetry.set(bytes_sent=len(payload))
+            trace = {}
+            response = await ASYNC_HTTP.request("POST", url, payload, headers,
+                                                connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                                trace=trace)
+            telemetry.set(connection_reused=trace.get("connection_reused"))
+            connect_ms = trace.get("connect_ms", 0.0)
+            telemetry.phase("connect", sent, connect_ms)
+            headers_at = telemetry.phase("ttfb", sent, (time.perf_counter() - sent) * 1000.0 - connect_ms)
+            status = response.status
+            async with response:
+                if data.get("stream") and "text/event-stream" in response.headers.get("content-type", ""):
+                    accumulator = StreamAccumulator(chat=url.endswith("/chat/completions"), started=started, events=events)
+                    decoder = SSEDecoder()
+                    received = 0
+                    async for chunk in response.iter_chunks():
+                        received += len(chunk)
+                        for event in decoder.feed(chunk):
+                            accumulator.feed(event)
+                        if interrupt_requested():
+                            # Leaving the body unread closes the connection instead of pooling it
+                            accumulator.interrupted = True
+                            break
+                    else:
+                        for event in decoder.flush():
+                            accumulator.feed(event)
+                    telemetry.phase("transfer", headers_at)
+                    telemetry.set(bytes_received=received)
+                    return self._stream_result(accumulator, response.status)
+                body = await response.read()
+            telemetry.phase("transfer", headers_at)
+            telemetry.set(bytes_received=len(body))
+            return self._parse_body(body, response.status, telemetry)
+        except asyncio.CancelledError:
+            if not interrupt_requested():
+                raise
+            return self._interrupted_result(accumulator, status)
+        except asyncio.TimeoutError:
+            return "", "", "Request timeout", 408
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            return "", "", "Connection error", 503
+        except ValueError:
+            return "", body.decode("utf-8", errors="replace"), "Invalid JSON response", 502
+        finally:
+            state["finished"] = True
+            IN_FLIGHT.unregister(token)
+    
+    def _send_direct(self, url: str, data: Dict[str, Any], api_key: str = "", timeout: Union[int, tuple] = 600,
+                     telemetry: Optional[RequestTelemetry] = None, events: Optional[List[str]] = None):
+        """Send one HTTP request to a single llama-server with the requests transport."""
+        telemetry = telemetry or RequestTelemetry(url)
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        
+        held = REQUEST_CONNECTIONS.held = []
+        
+        def shutdown():
+            for conn in list(held):
+                sock = getattr(conn, "sock", None)
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+        
+        token = IN_FLIGHT.register(shutdown)
+        try:
+            if data.get("stream"):
+                return self._stream_request(url, data, headers, timeout, telemetry, events)
+            response, headers_at = self._post(url, data, headers, timeout, telemetry)
+            body = response.content
+            telemetry.phase("transfer", headers_at)
+            telemetry.set(bytes_received=len(body))
+        except requests.exceptions.RequestException as e:
+            if interrupt_requested():
+                return self._interrupted_result(None, None)
+            return self._request_error(e)
+        except ValueError:
+            return "", "", "Invalid JSON response", 502
+        finally:
+            IN_FLIGHT.unregister(token)
+            REQUEST_CONNECTIONS.held = None
+        return self._parse_body(body, response.status_code, telemetry)
+    
+    @staticmethod
+    def _request_error(e: requests.exceptions.RequestException):
+        if isinstance(e, requests.exceptions.Timeout):
+            return "", "", "Request timeout", 408
+        if isinstance(e, requests.exceptions.ConnectionError):
+            return "", "", "Connection error", 503
+        return "", "", f"Request error: {str(e)}", 500
+    
+    @staticmethod
+    def _post(url: str, data: Dict[str, Any], headers: Dict[str, str], timeout: Union[int, tuple],
+              telemetry: RequestTelemetry):
+        """POST `data` and return (response, time the headers arrived) without reading the body yet."""
+        started = time.perf_counter()
+        payload = json_dumps_bytes(data)
+        sent = telemetry.phase("serialize", started)
+        telemetry.set(bytes_sent=len(payload))
+        CONNECT_TIMING.ms = None
+        response = SESSIONS.get(url).post(url, data=payload, headers=headers, timeout=timeout, stream=True)
+        connect_ms = CONNECT_TIMING.ms
+        telemetry.set(connection_reused=connect_ms is None)
+        telemetry.phase("connect", sent, connect_ms or 0.0)
+        headers_at = telemetry.phase("ttfb", sent, (time.perf_counter() - sent) * 1000.0 - (connect_ms or 0.0))
+        return response, headers_at
+    
+    @staticmethod
+    def _parse_body(body: bytes, status_code: int, telemetry: Optional[RequestTelemetry] = None):
+        """Parse a response body once; the server's own text is kept as raw_response."""
+        started = time.perf_counter()
+        raw_response = body.decode("utf-8", errors="replace")
+        try:
+            return json_loads(body), raw_response, "", status_code
+        except ValueError:
+            return "", raw_response, "Invalid JSON response", 502
+        finally:
+            if telemetry is not None:
+                telemetry.phase("parse", started)
+    
+    def _stream_request(self, url: str, data: Dict[str, Any], headers: Dict[str, str], timeout: Union[int, tuple],
+                        telemetry: Optional[RequestTelemetry] = None, events: Optional[List[str]] = None):
+        """POST a streaming request and assemble the server-sent events as they arrive."""
+        telemetry = telemetry or RequestTelemetry(url)
+        started = time.perf_counter()
+        headers = dict(headers, Accept="text/event-stream")
+        response, headers_at = self._post(url, data, headers, timeout, telemetry)
+        with response:
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                # Errors (and servers that ignore `stream`) answer with a plain JSON body
+                body = response.content
+                telemetry.phase("transfer", headers_at)
+                telemetry.set(bytes_received=len(body))
+                return self._parse_body(body, response.status_code, telemetry)
+            
+            accumulator = StreamAccumulator(chat=url.endswith("/chat/completions"), started=started, events=events)
+            received = 0
+            
+            def chunks():
+                nonlocal received
+                for chunk in response.iter_content(chunk_size=None):
+                    received += len(chunk)
+                    yield chunk
+            
+            try:
+                for payload in iter_sse_data(chunks()):
+                    accumulator.feed(payload)
+                    if interrupt_requested():
+                        # Exiting the `with` block closes the half-read connection
+                        accumulator.interrupted = True
+                        break
+            except requests.exceptions.RequestException:
+                # The interrupt watcher shut the socket down under us
+                if not interrupt_requested():
+                    raise
+                accumulator.interrupted = True
+            telemetry.phase("transfer", headers_at)
+            telemetry.set(bytes_received=received)
+            return self._stream_result(accumulator, response.status_code)
+    
+    @classmethod
+    def _interrupted_result(cls, accumulator: Optional[StreamAccumulator], status_code: Optional[int]):
+        """Result of a request cut short by a ComfyUI interrupt: the partial stream, if any."""
+        if accumulator is None:
+            return "", "", INTERRUPTED_ERROR, INTERRUPTED_STATUS
+        accumulator.interrupted = True
+        return cls._stream_result(accumulator, status_code)
+    
+    @staticmethod
+    def _stream_result(accumulator: StreamAccumulator, status_code: int):
+        result = accumulator.result()
+        error = ""
+        if accumulator.error is not None:
+            error = f"Stream error: {json.dumps(accumulator.error)}"
+        elif accumulator.interrupted:
+            error = INTERRUPTED_ERROR
+            status_code = INTERRUPTED_STATUS
+        # There is no single server body for a stream; raw_response is serialized only if requested
+        return result, None, error, status_code
+    
+    @classmethod
+    def erase_slot(cls, server_url: str, id_slot: int, api_key: str = "") -> bool:
+        """Clear one server slot's KV cache with /slots/{id}?action=erase."""
+        send = cls()._slot_sender(api_key, {})
+        return CHECKPOINTS.erase(send, SessionRegistry.base_url(server_url), id_slot)
+    
+    def _clean_params(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Remove None values and convert string parameters to appropriate types."""
+        cleaned = {}
+        
+        for key, value in params.items():
+            if value is None:
+                continue
+                
+            # Handle string parameters that should be parsed as JSON
+            if key in ['stop_sequences', 'logit_bias', 'samplers', 'messages', 'tools', 
+                      'response_format', 'input_extra', 'documents', 'lora', 'response_fields',
+                      'image_data', 'dry_sequence_breakers', 'tokens']:
+                if isinstance(value, str) and value.strip():
+                    try:
+                        cleaned[key] = json.loads(value)
+                    except json.JSONDecodeError:
+                        continue
+                elif isinstance(value, (list, dict)):
+                    # Value is already a list or dict, use as is
+                    cleaned[key] = value
+            else:
+                cleaned[key] = value
+        
+        return cleaned
+    
+    def _handle_completion(self, server_url: str, prompt: str, **kwargs):
+        """Handle /completion endpoint."""
+        url, params = self._build_completion(server_url, prompt, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_completion(self, server_url: str, prompt: str, **kwargs):
+        """Build the /completion request."""
+        url = f"{server_url}/completion"
+        
+        # Build parameters
+        params = {
+            "prompt": prompt,
+        }
+        
+        # Add all relevant parameters
+        param_mapping = {
+            "n_predict": "n_predict",
+            "temperature": "temperature", 
+            "top_k": "top_k",
+            "top_p": "top_p",
+            "min_p": "min_p",
+            "seed": "seed",
+            "dynatemp_range": "dynatemp_range",
+            "dynatemp_exponent": "dynatemp_exponent",
+            "xtc_probability": "xtc_probability",
+            "xtc_threshold": "xtc_threshold",
+            "repeat_penalty": "repeat_penalty",
+            "repeat_last_n": "repeat_last_n",
+            "presence_penalty": "presence_penalty",
+            "frequency_penalty": "frequency_penalty",
+            "dry_multiplier": "dry_multiplier",
+            "dry_base": "dry_base",
+            "dry_allowed_length": "dry_allowed_length",
+            "dry_penalty_last_n": "dry_penalty_last_n",
+            "dry_sequence_breakers": "dry_sequence_breakers",
+            "mirostat": "mirostat",
+            "mirostat_tau": "mirostat_tau",
+            "mirostat_eta": "mirostat_eta",
+            "typical_p": "typical_p",
+            "n_keep": "n_keep",
+            "stop_sequences": "stop",
+            "ignore_eos": "ignore_eos",
+            "stream": "stream",
+            "n_probs": "n_probs",
+            "min_keep": "min_keep",
+            "post_sampling_probs": "post_sampling_probs",
+            "return_tokens": "return_tokens",
+            "timings_per_token": "timings_per_token",
+            "grammar": "grammar",
+            "json_schema": "json_schema",
+            "logit_bias": "logit_bias",
+            "cache_prompt": "cache_prompt",
+            "id_slot": "id_slot",
+            "samplers": "samplers",
+            "t_max_predict_ms": "t_max_predict_ms",
+            "lora": "lora",
+            "response_fields": "response_fields",
+            "image_data": "image_data",
+        }
+        
+        for param_key, api_key in param_mapping.items():
+            if param_key in kwargs and kwargs[param_key] is not None:
+                if param_key == "stop_sequences":
+                    params[api_key] = kwargs[param_key]
+                else:
+                    params[api_key] = kwargs[param_key]
+        
+        # Clean parameters
+        params = self._clean_params(params)
+        
+        images = self._encode_images(kwargs)
+        if images:
+            # Referenced from the prompt as [img-<id>], numbered after any hand-written image_data
+            image_data = list(params.get("image_data") or [])
+            next_id = max((item.get("id", 0) for item in image_data if isinstance(item, dict)), default=0) + 1
+            image_data.extend({"data": data, "id": next_id + i} for i, data in enumerate(images))
+            params["image_data"] = image_data
+        
+        return url, params
+    
+    def _handle_chat_completions(self, server_url: str, **kwargs):
+        """Handle /v1/chat/completions endpoint."""
+        url, params = self._build_chat_completions(server_url, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_chat_completions(self, server_url: str, **kwargs):
+        """Build the /v1/chat/completions request."""
+        url = f"{server_url}/v1/chat/completions"
+        
+        # Build messages array
+        messages = []
+        
+        # Parse existing messages if provided
+        if kwargs.get("messages") and kwargs["messages"].strip():
+            try:
+                messages = json.loads(kwargs["messages"])
+            except json.JSONDecodeError:
+                pass
+        
+        # Add individual messages if provided
+        if kwargs.get("system_message") and kwargs["system_message"].strip():
+            messages.append({"role": "system", "content": kwargs["system_message"]})
+        
+        if kwargs.get("user_message") and kwargs["user_message"].strip():
+            messages.append({"role": "user", "content": kwargs["user_message"]})
+        
+        if kwargs.get("assistant_message") and kwargs["assistant_message"].strip():
+            messages.append({"role": "assistant", "content": kwargs["assistant_message"]})
+        
+        # If no messages, use prompt as user message
+        if not messages and kwargs.get("prompt"):
+            messages.append({"role": "user", "content": kwargs["prompt"]})
+        
+        if kwargs.get("context_fit", "off") != "off":
+            messages = self._fit_messages(server_url, messages, kwargs)
+        
+        images = self._encode_images(kwargs)
+        if images:
+            messages = self._attach_images(messages, images, kwargs.get("image_format", "JPEG"))
+        
+        params = {
+            "messages": messages,
+            "model": kwargs.get("model", "default"),
+        }
+        
+        # Add chat-specific parameters
+        param_mapping = {
+            "max_tokens": "max_tokens",
+            "temperature": "temperature",
+            "top_p": "top_p",
+            "top_k": "top_k",
+            "min_p": "min_p",
+            "seed": "seed",
+            "stream": "stream",
+            "stop_sequences": "stop",
+            "presence_penalty": "presence_penalty",
+            "frequency_penalty": "frequency_penalty",
+            "tools": "tools",
+            "tool_choice": "tool_choice",
+            "response_format": "response_format",
+            "n_probs": "logprobs",
+            "cache_prompt": "cache_prompt",
+            "id_slot": "id_slot",
+        }
+        
+        for param_key, api_key in param_mapping.items():
+            if param_key in kwargs and kwargs[param_key] is not None:
+                params[api_key] = kwargs[param_key]
+        
+        # Clean parameters
+        params = self._clean_params(params)
+        
+        return url, params
+    
+    def _fit_messages(self, server_url: str, messages: List[Dict[str, Any]], kwargs: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Drop or summarize the oldest turns of `messages` until the history fits the token budget."""
+        api_key = kwargs.get("api_key", "")
+        server = SessionRegistry.base_url(BALANCERS.concrete(server_url))
+        budget = kwargs.get("context_budget", 0)
+        if not budget:
+            props = PROPS.get(server, api_key, options=kwargs)
+            n_ctx = (props.get("default_generation_settings") or {}).get("n_ctx") or props.get("n_ctx")
+            if not n_ctx:
+                return messages
+            max_tokens = kwargs.get("max_tokens", -1)
+            budget = n_ctx - (max_tokens if max_tokens and max_tokens > 0 else n_ctx // 4)
+        
+        identity = PROPS.model_identity(server, api_key, options=kwargs)
+        
+        def send(path: str, body: Dict[str, Any], timeout: float):
+            return self._side_request(f"{server}{path}", body, api_key, timeout, kwargs)
+        
+        counts = TOKEN_COUNTS.count(send, messages, identity)
+        total = sum(counts)
+        if total <= budget:
+            return messages
+        
+        # A turn is a user message and everything up to the next one, so tool calls stay with their results
+        turns = []
+        for index, message in enumerate(messages):
+            if message.get("role") in ("system", "developer"):
+                continue
+            if message.get("role") == "user" or not turns:
+                turns.append([index])
+            else:
+                turns[-1].append(index)
+        keep_recent = max(1, kwargs.get("keep_recent_turns", 2))
+        summarize = kwargs.get("context_fit") == "summarize"
+        summary_tokens = min(512, max(budget // 8, 32)) if summarize else 0
+        
+        dropped = []
+        for turn in turns[:-keep_recent]:
+            if dropped and total + summary_tokens <= budget:
+                break
+            dropped.extend(turn)
+            total -= sum(counts[index] for index in turn)
+        if not dropped:
+            return messages
+        
+        dropped_set = set(dropped)
+        kept = [message for index, message in enumerate(messages) if index not in dropped_set]
+        if summarize:
+            summary = TOKEN_COUNTS.summary(send, [messages[index] for index in dropped], identity, summary_tokens,
+                                           kwargs.get("model", "default"))
+            if summary:
+                note = f"Summary of the earlier conversation:\n{summary}"
+                # Many chat templates accept only one leading system message, so the summary joins it
+                if kept and kept[0].get("role") == "system" and isinstance(kept[0].get("content"), str):
+                    kept[0] = dict(kept[0], content=f"{kept[0]['content']}\n\n{note}")
+                else:
+                    kept.insert(0, {"role": "system", "content": note})
+        return kept
+    
+    @staticmethod
+    def _encode_images(kwargs: Dict[str, Any]) -> List[str]:
+        """Base64 frames of the IMAGE input, if one is connected."""
+        image = kwargs.get("image")
+        if image is None:
+            return []
+        return IMAGE_ENCODER.encode(
+            image,
+            max_size=kwargs.get("image_max_size", 1024),
+            image_format=kwargs.get("image_format", "JPEG"),
+            quality=kwargs.get("image_quality", 90),
+        )
+    
+    @staticmethod
+    def _attach_images(messages: List[Dict[str, Any]], images: List[str], image_format: str) -> List[Dict[str, Any]]:
+        """Add images as OpenAI-style image_url parts to the last user message."""
+        mime = "image/jpeg" if image_format == "JPEG" else "image/png"
+        parts = [{"type": "image_url", "image_url": {"url": f"data:{mime};base64,{data}"}} for data in images]
+        messages = list(messages)
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index].get("role") == "user":
+                content = messages[index].get("content") or ""
+                if isinstance(content, str):
+                    content = [{"type": "text", "text": content}] if content else []
+                messages[index] = dict(messages[index], content=list(content) + parts)
+                return messages
+        messages.append({"role": "user", "content": parts})
+        return messages
+    
+    def _handle_embeddings(self, server_url: str, **kwargs):
+        """Handle /v1/embeddings endpoint."""
+        url, params = self._build_embeddings(server_url, **kwargs)
+        input_text = params.get("input")
+        
+        store = self._embedding_store(server_url, kwargs)
+        if store is None or not isinstance(input_text, str):
+            return self._request(url, params, kwargs)
+        
+        key = EmbeddingStore.content_key(input_text)
+        row = store.lookup([key])[0]
+        if row is not None:
+            vector = store.vectors([row])[0]
+            if params["encoding_format"] == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            result = {
+                "object": "list",
+                "model": params["model"],
+                "data": [{"object": "embedding", "index": 0, "embedding": embedding}],
+                "cached": True,
+            }
+            return result, None, "", 200
+        
+        response, raw_response, error, status_code = self._request(url, params, kwargs)
+        if not error and status_code == 200 and isinstance(response, dict) and response.get("data"):
+            store.add([key], decode_embedding(response["data"][0]["embedding"])[None, :])
+        return response, raw_response, error, status_code
+    
+    def _build_embeddings(self, server_url: str, **kwargs):
+        """Build the /v1/embeddings request."""
+        url = f"{server_url}/v1/embeddings"
+        
+        # Use input_text or content or prompt
+        input_text = kwargs.get("input_text") or kwargs.get("content") or kwargs.get("prompt", "")
+        
+        params = {
+            "input": input_text,
+            "model": kwargs.get("model", "default"),
+            "encoding_format": kwargs.get("encoding_format", "float"),
+        }
+        
+        # Clean parameters
+        params = self._clean_params(params)
+        
+        return url, params
+    
+    def _embedding_store(self, server_url: str, kwargs: Dict[str, Any]) -> Optional[EmbeddingStore]:
+        """The persistent embedding store for this server's model, if `embedding_store_dir` is set."""
+        directory = kwargs.get("embedding_store_dir") or ""
+        if not directory.strip():
+            return None
+        identity = PROPS.model_identity(server_url, kwargs.get("api_key", ""), options=kwargs)
+        return EMBEDDING_STORES.get(directory.strip(), canonical_json([identity, kwargs.get("model") or "default"]))
+    
+    def embed_batch(self, server_url: str, texts: List[str], batch_size: int = 0, **kwargs):
+        """Embed many texts in as few requests as possible; returns (float32 matrix, info, error, status_code)."""
+        server_url = self._resolve_server(server_url, kwargs)
+        url = f"{server_url}/v1/embeddings"
+        
+        matrix = None
+        pending = list(range(len(texts)))
+        store = self._embedding_store(server_url, kwargs)
+        keys = []
+        if store is not None:
+            keys = [EmbeddingStore.content_key(text) for text in texts]
+            rows = store.lookup(keys)
+            hits = [i for i, row in enumerate(rows) if row is not None]
+            if hits:
+                matrix = np.empty((len(texts), store.vectors([rows[hits[0]]]).shape[1]), dtype=np.float32)
+                matrix[hits] = store.vectors([rows[i] for i in hits])
+            pending = [i for i, row in enumerate(rows) if row is None]
+        
+        # Only texts missing from the store go to the server
+        pending_texts = [texts[i] for i in pending]
+        batches = self._plan_embedding_batches(server_url, pending_texts, batch_size, kwargs)
+        payloads = [{
+            "input": pending_texts[start:end],
+            "model": kwargs.get("model") or "default",
+            "encoding_format": "base64",
+        } for start, end in batches]
+        concurrency = kwargs.get("batch_concurrency", 0) or self._server_parallelism(server_url, kwargs)
+        records = TELEMETRY_RECORDS.get()
+        results = LOOP.run(self._send_batches_async(url, payloads, kwargs, concurrency,
+                                                    records if records is not None else []))
+        
+        failure = None
+        for (start, end), (response, raw_response, error, status_code) in zip(batches, results):
+            if error or status_code >= 400 or not isinstance(response, dict):
+                failure = failure or ([start, end], error or f"Embedding batch failed: {(raw_response or '')[:500]}",
+                                      status_code)
+                continue
+            items = response.get("data", [])
+            if len(items) != end - start:
+                failure = failure or ([start, end], f"Expected {end - start} embeddings, got {len(items)}", 502)
+                continue
+            for item in items:
+                vector = decode_embedding(item.get("embedding"))
+                if matrix is None:
+                    matrix = np.empty((len(texts), vector.shape[0]), dtype=np.float32)
+                matrix[pending[start + item.get("index", 0)]] = vector
+            if store is not None:
+                # Batches that succeeded are kept even when another one failed
+                batch_rows = pending[start:end]
+                store.add([keys[i] for i in batch_rows], matrix[batch_rows])
+        if failure is not None:
+            return matrix, {"texts": len(texts), "failed_batch": failure[0]}, failure[1], failure[2]
+        
+        if matrix is None:
+            matrix = np.empty((len(texts), 0), dtype=np.float32)
+        info = {
+            "texts": len(texts),
+            "dim": int(matrix.shape[1]),
+            "batches": len(batches),
+            "store_hits": len(texts) - len(pending),
+        }
+        return matrix, info, "", 200
+    
+    async def _send_batches_async(self, url: str, payloads: List[Dict[str, Any]], kwargs: Dict[str, Any],
+                                  concurrency: int, telemetry: List[Dict[str, Any]]) -> List[tuple]:
+        """Send `payloads` to `url` with at most `concurrency` in flight; results keep payload order."""
+        results = [None] * len(payloads)
+        pending = iter(enumerate(payloads))
+        
+        async def worker():
+            for index, params in pending:
+                item_telemetry = RequestTelemetry(url)
+                results[index] = await self._request_async(url, params, kwargs, item_telemetry)
+                telemetry.append(item_telemetry.record)
+        
+        await asyncio.gather(*(worker() for _ in range(min(max(concurrency, 1), len(payloads)))))
+        return results
+    
+    def iter_token_chunks(self, server_url: str, text: str, chunk_tokens: int, overlap_tokens: int = 0,
+                          segment_tokens: int = 4096, **kwargs):
+        """Lazily yield (chunk_text, token_start, token_end) windows of at most `chunk_tokens` tokens."""
+        stride = chunk_tokens - overlap_tokens
+        if chunk_tokens <= 0 or stride <= 0:
+            raise ValueError("chunk_tokens must be positive and larger than the overlap")
+        
+        options = dict(kwargs, add_special=False, parse_special=False)
+        group_size = kwargs.get("batch_concurrency", 0) or 16
+        segments = self._text_segments(text, max(segment_tokens, chunk_tokens) * 4)
+        window = array("i")  # tokens not yet past the window start
+        offset = 0  # token index of window[0]
+        emitted = False
+        while True:
+            group = [segment for _, segment in zip(range(group_size), segments)]
+            if not group:
+                break
+            token_lists, _, error, status_code = self.tokenize_many(server_url, group, **options)
+            if error:
+                raise RuntimeError(f"Tokenization failed ({status_code}): {error}")
+            windows = []
+            for tokens in token_lists:
+                window.extend(tokens)
+                while len(window) >= chunk_tokens:
+                    windows.append((window[:chunk_tokens], offset))
+                    del window[:stride]
+                    offset += stride
+            emitted = emitted or bool(windows)
+            yield from self._detokenize_windows(server_url, windows, options)
+        
+        # The tail, unless it is only the overlap of the last full window
+        if window and (not emitted or len(window) > overlap_tokens):
+            yield from self._detokenize_windows(server_url, [(window, offset)], options)
+    
+    @staticmethod
+    def _text_segments(text: str, segment_chars: int):
+        """Consecutive pieces of `text` of about `segment_chars` characters, cut before whitespace."""
+        position = 0
+        while position < len(text):
+            end = min(position + segment_chars, len(text))
+            if end < len(text):
+                # Most tokenizers start a token at whitespace, so a cut there rarely splits one
+                cut = max(text.rfind(" ", position + 1, end), text.rfind("\n", position + 1, end))
+                end = cut if cut > position else end
+            yield text[position:end]
+            position = end
+    
+    def _detokenize_windows(self, server_url: str, windows: List[tuple], kwargs: Dict[str, Any]):
+        """Yield (text, token_start, token_end) for (tokens, token_start) windows, detokenized together."""
+        if not windows:
+            return
+        texts, _, error, status_code = self.detokenize_many(server_url, [tokens for tokens, _ in windows], **kwargs)
+        if error:
+            raise RuntimeError(f"Detokenization failed ({status_code}): {error}")
+        for chunk_text, (tokens, token_start) in zip(texts, windows):
+            yield chunk_text, token_start, token_start + len(tokens)
+    
+    def embed_chunked(self, server_url: str, texts: List[str], chunk_tokens: int, overlap_tokens: int = 0,
+                      batch_size: int = 0, **kwargs):
+        """Embed token windows of every text as they are produced; returns (matrix, info, error, status_code)."""
+        base_url = self._resolve_server(server_url, kwargs)
+        props = PROPS.get(base_url, kwargs.get("api_key", ""), options=kwargs)
+        n_ctx = (props.get("default_generation_settings") or {}).get("n_ctx") or 2048
+        chunk_tokens = min(chunk_tokens, n_ctx)
+        overlap_tokens = min(overlap_tokens, chunk_tokens - 1)
+        group_size = batch_size or max(n_ctx * max(props.get("total_slots") or 1, 1) // chunk_tokens, 1)
+        store = self._embedding_store(base_url, kwargs)
+        
+        matrices = []
+        keys = []
+        chunks = []
+        pending = []
+        batches = 0
+        store_hits = 0
+        
+        def flush():
+            nonlocal batches, store_hits
+            matrix, info, error, status_code = self.embed_batch(base_url, pending, len(pending), **kwargs)
+            if error:
+                return error, status_code
+            if store is None:
+                matrices.append(matrix)
+            else:
+                keys.extend(EmbeddingStore.content_key(chunk_text) for chunk_text in pending)
+            batches += info["batches"]
+            store_hits += info["store_hits"]
+            pending.clear()
+            return "", 200
+        
+        for text_index, text in enumerate(texts):
+            for chunk_text, token_start, token_end in self.iter_token_chunks(
+                    base_url, text, chunk_tokens, overlap_tokens, **kwargs):
+                chunks.append({"text": text_index, "tokens": [token_start, token_end]})
+                pending.append(chunk_text)
+                if len(pending) >= group_size:
+                    error, status_code = flush()
+                    if error:
+                        return None, {"texts": len(texts), "chunks": len(chunks)}, error, status_code
+        if pending:
+            error, status_code = flush()
+            if error:
+                return None, {"texts": len(texts), "chunks": len(chunks)}, error, status_code
+        
+        if store is not None and keys:
+            matrix = store.vectors(store.lookup(keys))
+        elif matrices:
+            matrix = np.concatenate(matrices)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        info = {
+            "texts": len(texts),
+            "dim": int(matrix.shape[1]),
+            "chunk_tokens": chunk_tokens,
+            "overlap_tokens": overlap_tokens,
+            "batches": batches,
+            "store_hits": store_hits,
+            "chunks": chunks,
+        }
+        return matrix, info, "", 200
+    
+    def _plan_embedding_batches(self, server_url: str, texts: List[str], batch_size: int, kwargs: Dict[str, Any]):
+        """Split `texts` into [start, end) ranges by `batch_size` or the server's context."""
+        if batch_size > 0:
+            return [(start, min(start + batch_size, len(texts))) for start in range(0, len(texts), batch_size)]
+        
+        api_key = kwargs.get("api_key", "")
+        props = PROPS.get(server_url, api_key, options=kwargs)
+        n_ctx = (props.get("default_generation_settings") or {}).get("n_ctx") or 2048
+        token_budget = n_ctx * max(props.get("total_slots") or 1, 1)
+        identity = PROPS.model_identity(server_url, api_key, options=kwargs)
+        
+        batches = []
+        start = 0
+        used = 0
+        for index, text in enumerate(texts):
+            estimate = self._embedding_tokens(identity, text)
+            if index > start and used + estimate > token_budget:
+                batches.append((start, index))
+                start, used = index, 0
+            used += estimate
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+    
+    @staticmethod
+    def _embedding_tokens(identity: str, text: str) -> int:
+        """Tokens `text` takes in an embedding batch: the cached count, or an over-estimate."""
+        for add_special in (True, False):
+            tokens = TOKEN_CACHE.peek(TokenCache.tokenize_key(identity, text, add_special, True))
+            if tokens is not None:
+                # Room for BOS/EOS the server adds to each input
+                return len(tokens) + (0 if add_special else 2)
+        return len(text.encode("utf-8")) // 2 + 1
+    
+    def _handle_tokenize(self, server_url: str, **kwargs):
+        """Handle /tokenize endpoint."""
+        url, params = self._build_tokenize(server_url, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_tokenize(self, server_url: str, **kwargs):
+        """Build the /tokenize request."""
+        url = f"{server_url}/tokenize"
+        
+        content = kwargs.get("content") or kwargs.get("prompt", "")
+        
+        params = {
+            "content": content,
+            "add_special": kwargs.get("add_special", False),
+            "parse_special": kwargs.get("parse_special", True),
+            "with_pieces": kwargs.get("with_pieces", False),
+        }
+        
+        return url, params
+    
+    def _handle_detokenize(self, server_url: str, **kwargs):
+        """Handle /detokenize endpoint."""
+        url, params = self._build_detokenize(server_url, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_detokenize(self, server_url: str, **kwargs):
+        """Build the /detokenize request."""
+        url = f"{server_url}/detokenize"
+        
+        tokens = kwargs.get("tokens", "[]")
+        if isinstance(tokens, str):
+            try:
+                tokens = json.loads(tokens)
+            except json.JSONDecodeError:
+                tokens = []
+        
+        params = {
+            "tokens": tokens,
+        }
+        
+        return url, params
+    
+    def tokenize_many(self, server_url: str, texts: List[str], **kwargs):
+        """Tokenize many texts concurrently; returns (array('i') per text, info, error, status_code)."""
+        server_url = self._resolve_server(server_url, kwargs)
+        identity = PROPS.model_identity(server_url, kwargs.get("api_key", ""), options=kwargs)
+        add_special = kwargs.get("add_special", False)
+        parse_special = kwargs.get("parse_special", True)
+        keys = [TokenCache.tokenize_key(identity, text, add_special, parse_special) for text in texts]
+        
+        def payload(index):
+            return {"content": texts[index], "add_special": add_special, "parse_special": parse_special}
+        
+        def decode(response):
+            return array("i", response.get("tokens") or [])
+        
+        return self._bulk_request(f"{server_url}/tokenize", keys, payload, decode, kwargs)
+    
+    def detokenize_many(self, server_url: str, token_lists: List[Any], **kwargs):
+        """Detokenize many token id sequences concurrently; returns (texts, info, error, status_code)."""
+        server_url = self._resolve_server(server_url, kwargs)
+        identity = PROPS.model_identity(server_url, kwargs.get("api_key", ""), options=kwargs)
+        sequences = [tokens if isinstance(tokens, array) and tokens.typecode == "i" else array("i", [int(t) for t in tokens])
+                     for tokens in token_lists]
+        keys = [TokenCache.detokenize_key(identity, tokens) for tokens in sequences]
+        
+        def payload(index):
+            return {"tokens": sequences[index].tolist()}
+        
+        def decode(response):
+            return response.get("content", "")
+        
+        return self._bulk_request(f"{server_url}/detokenize", keys, payload, decode, kwargs)
+    
+    def _bulk_request(self, url: str, keys: List[bytes], payload, decode, kwargs: Dict[str, Any]):
+        """Resolve every key from the token cache or with one request per distinct miss."""
+        known = {}
+        payloads = {}
+        for index, key in enumerate(keys):
+            if key in known or key in payloads:
+                continue
+            value = TOKEN_CACHE.get(key)
+            if value is None:
+                payloads[key] = payload(index)
+            else:
+                known[key] = value
+        
+        records = TELEMETRY_RECORDS.get()
+        failures = []
+        if payloads:
+            failures = LOOP.run(self._bulk_request_async(url, payloads, decode, known, kwargs,
+                                                         records if records is not None else []))
+        results = [known.get(key) for key in keys]
+        info = {"items": len(keys), "requested": len(payloads), "cached": len(keys) - len(payloads)}
+        counts = [len(result) if isinstance(result, array) else None for result in results]
+        if any(count is not None for count in counts):
+            info["tokens"] = sum(count for count in counts if count is not None)
+            info["counts"] = counts
+        if not failures:
+            return results, info, "", 200
+        error, status_code = failures[0]
+        return results, info, f"{len(failures)} of {len(payloads)} requests failed: {error}", status_code
+    
+    async def _bulk_request_async(self, url: str, payloads: Dict[bytes, Dict[str, Any]], decode,
+                                  known: Dict[bytes, Any], kwargs: Dict[str, Any], telemetry: List[Dict[str, Any]]):
+        pending = iter(payloads.items())
+        failures = []
+        
+        async def worker():
+            for key, params in pending:
+                item_telemetry = RequestTelemetry(url)
+                response, _, error, status_code = await self._request_async(url, params, kwargs, item_telemetry)
+                telemetry.append(item_telemetry.record)
+                if error or status_code >= 400 or not isinstance(response, dict):
+                    failures.append((error or f"HTTP {status_code}", status_code))
+                    continue
+                known[key] = decode(response)
+                TOKEN_CACHE.put(key, known[key])
+        
+        concurrency = kwargs.get("batch_concurrency", 0) or 16
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(payloads)))))
+        return failures
+    
+    def _handle_apply_template(self, server_url: str, **kwargs):
+        """Handle /apply-template endpoint."""
+        url, params = self._build_apply_template(server_url, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_apply_template(self, server_url: str, **kwargs):
+        """Build the /apply-template request."""
+        url = f"{server_url}/apply-template"
+        
+        messages = kwargs.get("messages", "[]")
+        if isinstance(messages, str):
+            try:
+                messages = json.loads(messages)
+            except json.JSONDecodeError:
+                messages = []
+        
+        params = {
+            "messages": messages,
+        }
+        
+        return url, params
+    
+    def _handle_infill(self, server_url: str, **kwargs):
+        """Handle /infill endpoint."""
+        url, params = self._build_infill(server_url, **kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _build_infill(self, server_url: str, **kwargs):
+        """Build the /infill request."""
+        url = f"{server_url}/infill"
+        
+        params = {
+            "input_prefix": kwargs.get("input_prefix", ""),
+            "input_suffix": kwargs.get("input_suffix", ""),
+        }
+        
+        if kwargs.get("input_extra"):
+            try:
+                params["input_extra"] = json.loads(kwargs["input_extra"])
+            except json.JSONDecodeError:
+                pass
+        
+        if kwargs.get("prompt"):
+            params["prompt"] = kwargs["prompt"]
+        
+        # Add completion parameters
+        completion_params = [
+            "temperature", "top_k", "top_p", "min_p", "seed", "stream",
+            "n_predict", "stop_sequences", "repeat_penalty", "repeat_last_n", "cache_prompt", "id_slot"
+        ]
+        
+        for param in completion_params:
+            if param in kwargs and kwargs[param] is not None:
+                if param == "stop_sequences":
+                    params["stop"] = kwargs[param]
+                else:
+                    params[param] = kwargs[param]
+        
+        # Clean parameters
+        params = self._clean_params(params)
+        
+        return url, params
+    
+    def _handle_reranking(self, server_url: str, **kwargs):
+        """Handle /v1/rerank endpoint."""
+        url, params = self._build_reranking(server_url, **kwargs)
+        batch_size = kwargs.get("rerank_batch_size", 0)
+        if batch_size and len(params["documents"]) > batch_size:
+            return self._rerank_chunked(server_url, url, params, batch_size, kwargs)
+        return self._request(url, params, kwargs)
+    
+    def _rerank_chunked(self, server_url: str, url: str, params: Dict[str, Any], batch_size: int,
+                        kwargs: Dict[str, Any]):
+        """Rerank a large document list in concurrent batches, keeping a global top_n in a bounded heap."""
+        concurrency = kwargs.get("batch_concurrency", 0) or self._server_parallelism(server_url, kwargs)
+        telemetry = []
+        response, error, status_code = LOOP.run(self._rerank_chunked_async(url, params, batch_size, concurrency,
+                                                                           kwargs, telemetry))
+        records = TELEMETRY_RECORDS.get()
+        if records is not None:
+            records.extend(telemetry)
+        return response, None, error, status_code
+    
+    async def _rerank_chunked_async(self, url: str, params: Dict[str, Any], batch_size: int, concurrency: int,
+                                    kwargs: Dict[str, Any], telemetry: List[Dict[str, Any]]):
+        documents = params["documents"]
+        top_n = max(int(params.get("top_n") or len(documents)), 1)
+        offsets = iter(range(0, len(documents), batch_size))
+        heap = []  # (score, -index, result): the smallest of the current top_n on top
+        usage = {"prompt_tokens": 0, "total_tokens": 0}
+        failures = []
+        model = None
+        
+        async def worker():
+            nonlocal model
+            for start in offsets:
+                chunk = documents[start:start + batch_size]
+                chunk_params = dict(params, documents=chunk, top_n=min(top_n, len(chunk)))
+                chunk_telemetry = RequestTelemetry(url)
+                response, _, error, status_code = await self._request_async(url, chunk_params, kwargs, chunk_telemetry)
+                telemetry.append(chunk_telemetry.record)
+                if error or status_code >= 400 or not isinstance(response, dict):
+                    failures.append((start, error or "Invalid rerank response", status_code))
+                    continue
+                model = model or response.get("model")
+                for key in usage:
+                    usage[key] += (response.get("usage") or {}).get(key, 0)
+                for result in response.get("results") or []:
+                    index = start + result["index"]
+                    entry = (result["relevance_score"], -index, dict(result, index=index))
+                    if len(heap) < top_n:
+                        heapq.heappush(heap, entry)
+                    elif entry[:2] > heap[0][:2]:
+                        heapq.heapreplace(heap, entry)
+        
+        batches = (len(documents) + batch_size - 1) // batch_size
+        await asyncio.gather(*(worker() for _ in range(min(max(concurrency, 1), batches))))
+        
+        results = [entry[2] for entry in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+        response = {"model": model or params.get("model"), "object": "list", "usage": usage, "results": results}
+        if not failures:
+            return response, "", 200
+        start, error, status_code = failures[0]
+        return response, f"{len(failures)} of {batches} rerank batches failed (documents {start}+: {error})", \
+            max(status for _, _, status in failures)
+    
+    def _build_reranking(self, server_url: str, **kwargs):
+        """Build the /v1/rerank request."""
+        url = f"{server_url}/v1/rerank"
+        
+        query = kwargs.get("query", "")
+        documents = kwargs.get("documents", "[]")
+        
+        if isinstance(documents, str):
+            try:
+                documents = json.loads(documents)
+            except json.JSONDecodeError:
+                documents = []
+        
+        params = {
+            "model": kwargs.get("model", "default"),
+            "query": query,
+            "documents": documents,
+            "top_n": kwargs.get("top_n", 10),
+        }
+        
+        return url, params
+
+
+class LlamaCppBatchEmbeddingsNode(LlamaCppClientNode):
+    """
+    Embeds a list of texts in server-sized batches and returns a single float32 NumPy matrix.
+    Vectors are requested base64-encoded and decoded straight into the output array.
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return cls._task_inputs(
+            {
+                "texts": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "JSON array of texts, or one text per line"
+                }),
+                "batch_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 4096,
+                    "tooltip": "Texts per request (0 = size batches from the server's context and slots)"
+                }),
+            },
+            {
+                "model": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Model name/alias"
+                }),
+                "embedding_store_dir": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Directory of a persistent embedding store; only texts not stored yet are sent to the server"
+                }),
+                "chunk_tokens": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 32768,
+                    "tooltip": "Split each text into windows of this many tokens and embed every window (0 = whole texts)"
+                }),
+                "chunk_overlap": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 8192,
+                    "tooltip": "Tokens shared by consecutive windows"
+                }),
+            },
+        )
+    
+    RETURN_TYPES = ("EMBEDDINGS", "STRING", "STRING", "INT")
+    RETURN_NAMES = ("embeddings", "info", "error", "status_code")
+    FUNCTION = "process_batch"
+    CATEGORY = "AI/LlamaCpp"
+    
+    @classmethod
+    def IS_CHANGED(cls, server_url: str = "", **kwargs):
+        # Embeddings only change with the texts, the settings or the loaded model
+        return cls._input_fingerprint(server_url, kwargs)
+    
+    def process_batch(self, server_url: str, texts: str, batch_size: int, **kwargs):
+        """Embed every text and return the (n_texts, dim) matrix."""
+        try:
+            text_list = parse_text_list(texts)
+            chunk_tokens = kwargs.pop("chunk_tokens", 0)
+            chunk_overlap = kwargs.pop("chunk_overlap", 0)
+            if chunk_tokens:
+                matrix, info, error, status_code = self.embed_chunked(
+                    server_url, text_list, chunk_tokens, chunk_overlap, batch_size, **kwargs)
+            else:
+                matrix, info, error, status_code = self.embed_batch(server_url, text_list, batch_size, **kwargs)
+            return matrix, json.dumps(info), error, status_code
+        except Exception as e:
+            return None, "", f"Error processing batch: {str(e)}", 500
+
+
+class LlamaCppConversationNode(LlamaCppClientNode):
+    """
+    Multi-turn chat with an append-only history pinned to one server slot.
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return cls._task_inputs(
+            {
+                "conversation_id": ("STRING", {
+                    "default": "default",
+                    "multiline": False,
+                    "tooltip": "Name of the conversation; runs with the same id continue the same history"
+                }),
+                "user_message": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Message appended as the next user turn"
+                }),
+            },
+            {
+                "system_message": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "System message; changing it starts the conversation over"
+                }),
+                "reset": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Clear the history before this turn"
+                }),
+                "id_slot": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 100,
+                    "tooltip": "Server slot holding this conversation (-1 = the slot with the fewest conversations)"
+                }),
+                "max_tokens": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 100000,
+                    "tooltip": "Maximum tokens in response (OpenAI style)"
+                }),
+                "temperature": ("FLOAT", {
+                    "default": 0.8,
+                    "min": 0.0,
+                    "max": 10.0,
+                    "step": 0.01,
+                    "tooltip": "Sampling temperature"
+                }),
+                "seed": ("INT", {
+                    "default": -1,
+                    "min": -1,
+                    "max": 2**31-1,
+                    "tooltip": "Random seed (-1 for random)"
+                }),
+                "model": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Model name/alias"
+                }),
+                "conversation_dir": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Directory where the history is appended as JSONL so it survives restarts (empty = memory only)"
+                }),
+                "context_fit": (["off", "drop"], {
+                    "default": "off",
+                    "tooltip": "Trim the history when it outgrows the context: the oldest turns are removed for good"
+                }),
+                "context_budget": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 10000000,
+                    "tooltip": "Token budget for the history (0 = the server's n_ctx minus max_tokens, or minus a quarter of n_ctx when max_tokens is -1)"
+                }),
+                "keep_recent_turns": ("INT", {
+                    "default": 2,
+                    "min": 1,
+                    "max": 1000,
+                    "tooltip": "Most recent turns that context_fit never removes"
+                }),
+            },
+        )
+    
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "STRING", "INT")
+    RETURN_NAMES = ("response", "history", "info", "error", "status_code")
+    FUNCTION = "converse"
+    CATEGORY = "AI/LlamaCpp"
+    
+    @classmethod
+    def IS_CHANGED(cls, server_url: str = "", **kwargs):
+        # Re-running a turn would append it twice, so unchanged inputs (and model) keep ComfyUI's cached output
+        return cls._input_fingerprint(server_url, kwargs)
+    
+    def converse(self, server_url: str, conversation_id: str, user_message: str, **kwargs):
+        """Append `user_message` to the conversation, send the whole history and append the reply."""
+        conversation = None
+        try:
+            base_url = self._resolve_server(server_url, kwargs)
+            api_key = kwargs.get("api_key", "")
+            conversation = CONVERSATIONS.get(conversation_id, kwargs.get("conversation_dir", ""))
+            with conversation.lock:
+                system_message = kwargs.get("system_message", "")
+                if kwargs.get("reset") or conversation.system != system_message:
+                    conversation.reset(system_message)
+                if not user_message.strip():
+                    return "", conversation.serialized().decode("utf-8"), "", "user_message is empty", 400
+                
+                binding = (server_url, kwargs.get("id_slot", -1))
+                if conversation.binding != binding:
+                    self._bind(conversation, BALANCERS.concrete(base_url), binding, kwargs)
+                
+                turn = {"role": "user", "content": user_message}
+                messages = conversation.messages + [turn]
+                if kwargs.get("context_fit", "off") != "off":
+                    fitted = self._fit_messages(conversation.server, messages, kwargs)
+                    if len(fitted) < len(messages):
+                        # Trimmed for good: the next turns share the shorter prefix again
+                        conversation.replace(fitted[:-1])
+                        messages = fitted
+                params = self._clean_params({
+                    "model": kwargs.get("model") or "default",
+                    "messages": messages,
+                    "id_slot": conversation.id_slot,
+                    "cache_prompt": True,
+                    "max_tokens": kwargs.get("max_tokens", -1),
+                    "temperature": kwargs.get("temperature"),
+                    "seed": kwargs.get("seed"),
+                })
+                # The slot is already chosen; affinity routing must not move the conversation
+                options = dict(kwargs, slot_affinity=False)
+                result = self._request(f"{conversation.server}/v1/chat/completions", params, options)
+                if result[2].startswith(CIRCUIT_OPEN_ERROR) or replica_unhealthy(result):
+                    # The bound server is gone: the next run binds afresh, and another replica takes
+                    # this turn at the cost of processing the whole history once
+                    failed = conversation.server
+                    conversation.binding = None
+                    replica = self._failover_replica(base_url, failed)
+                    if replica is not None:
+                        self._bind(conversation, replica, binding, kwargs)
+                        params["id_slot"] = conversation.id_slot
+                        result = self._request(f"{conversation.server}/v1/chat/completions", params, options)
+                response, raw_response, error, status_code = result
+                if error or status_code >= 400 or not isinstance(response, dict):
+                    return "", conversation.serialized().decode("utf-8"), "", error or f"HTTP {status_code}", status_code
+                
+                message = (response.get("choices") or [{}])[0].get("message") or {}
+                content = message.get("content") or ""
+                # Stored exactly as received so the next turn's prompt starts with the same bytes
+                conversation.append(turn, {"role": "assistant", "content": content})
+                timings = response.get("timings") or {}
+                info = {
+                    "conversation_id": conversation_id,
+                    "messages": len(conversation.messages),
+                    "server": conversation.server,
+                    "id_slot": conversation.id_slot,
+                    "prompt_n": timings.get("prompt_n"),
+                    "cache_n": timings.get("cache_n"),
+                }
+                return content, conversation.serialized().decode("utf-8"), json.dumps(info), "", status_code
+        except Exception as e:
+            history = conversation.serialized().decode("utf-8") if conversation is not None else "[]"
+            return "", history, "", f"Error processing conversation: {str(e)}", 500
+    
+    @staticmethod
+    def _bind(conversation: Conversation, server_url: str, binding: tuple, kwargs: Dict[str, Any]):
+        """Bind `conversation` to a slot of `server_url`: the `id_slot` input, or the least used slot."""
+        server = SessionRegistry.base_url(server_url)
+        if binding[1] >= 0:
+            conversation.server, conversation.id_slot = server, binding[1]
+        else:
+            total_slots = PROPS.get(server, kwargs.get("api_key", ""), options=kwargs).get("total_slots") or 1
+            CONVERSATIONS.bind(conversation, server, total_slots)
+        conversation.binding = binding
+    
+    @staticmethod
+    def _failover_replica(base_url: str, failed: str) -> Optional[str]:
+        """Another replica of a load-balanced `base_url` than `failed` whose circuit is not open, if any."""
+        if not BALANCERS.is_balanced(base_url):
+            return None
+        replica_set = BALANCERS.get(base_url)
+        exclude = {r.url for r in replica_set.replicas
+                   if SessionRegistry.base_url(r.url) == failed or BREAKERS.state(r.url) == "open"}
+        replica = replica_set.pick(exclude=exclude)
+        return replica.url if replica.url not in exclude else None
+
+
+class LlamaCppVectorIndexNode(LlamaCppClientNode):
+    """
+    Local similarity search over embeddings from the server or an EMBEDDINGS input.
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return cls._task_inputs(
+            {
+                "index_name": ("STRING", {
+                    "default": "default",
+                    "multiline": False,
+                    "tooltip": "Name of the index; runs with the same name share it"
+                }),
+                "texts": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "Texts to add (JSON array or one per line); texts already indexed are skipped"
+                }),
+                "queries": ("STRING", {
+                    "default": "",
+                    "multiline": True,
+                    "tooltip": "Query texts (JSON array or one per line)"
+                }),
+                "top_k": ("INT", {
+                    "default": 5,
+                    "min": 1,
+                    "max": 10000,
+                    "tooltip": "Matches returned per query"
+                }),
+            },
+            {
+                "embeddings": ("EMBEDDINGS", {
+                    "tooltip": "Precomputed vectors for `texts`, one row per text (e.g. from Llama.cpp Batch Embeddings)"
+                }),
+                "query_embeddings": ("EMBEDDINGS", {
+                    "tooltip": "Precomputed vectors for `queries`"
+                }),
+                "model": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Model name/alias"
+                }),
+                "index_dir": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "tooltip": "Directory where the index is saved after adds and memory-mapped on load (empty = memory only)"
+                }),
+                "ivf_lists": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "tooltip": "Approximate search with this many k-means lists (0 = exact); trained once the index holds 39 vectors per list"
+                }),
+                "nprobe": ("INT", {
+                    "default": 8,
+                    "min": 1,
+                    "max": 65536,
+                    "tooltip": "Lists scanned per query in approximate mode"
+                }),
+                "reset": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Empty the index before adding"
+                }),
+            },
+        )
+    
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "INT")
+    RETURN_NAMES = ("results", "info", "error", "status_code")
+    FUNCTION = "process_index"
+    CATEGORY = "AI/LlamaCpp"
+    
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # Results depend on the index contents, which other runs may have changed
+        return float("nan")
+    
+    def process_index(self, server_url: str, index_name: str, texts: str, queries: str, top_k: int, **kwargs):
+        """Add `texts` to the index, then return the `top_k` matches of every query."""
+        try:
+            directory = kwargs.get("index_dir", "")
+            index = VECTOR_INDEXES.reset(index_name, directory) if kwargs.get("reset") else \
+                VECTOR_INDEXES.get(index_name, directory)
+            embeddings = kwargs.pop("embeddings", None)
+            query_embeddings = kwargs.pop("query_embeddings", None)
+            ivf_lists = kwargs.get("ivf_lists", 0)
+            identity = None
+            if (embeddings is None and texts.strip() not in ("", "[]")) or (query_embeddings is None and queries.strip()):
+                identity = PROPS.model_identity(self._resolve_server(server_url, kwargs), kwargs.get("api_key", ""),
+                                                options=kwargs)
+                if index.model_identity and index.model_identity != identity:
+                    return "", json.dumps(index.stats()), "The index holds embeddings of a different model", 409
+            
+            text_list = parse_text_list(texts)
+            added = 0
+            if text_list:
+                if embeddings is None:
+                    # Texts already in the index are not embedded again
+                    fresh = [text_list[i] for i in index.missing(text_list)]
+                    matrix = None
+                    if fresh:
+                        matrix, _, error, status_code = self.embed_batch(server_url, fresh, 0, **kwargs)
+                        if error:
+                            return "", json.dumps(index.stats()), error, status_code
+                    text_list = fresh
+                else:
+                    matrix = embeddings
+                if text_list:
+                    added = index.add(text_list, matrix, identity)
+            trained = index.needs_training(ivf_lists)
+            if trained:
+                index.train(ivf_lists)
+            if added or trained or kwargs.get("reset"):
+                index.save()
+            
+            query_list = parse_text_list(queries)
+            if query_embeddings is None and query_list:
+                query_embeddings, _, error, status_code = self.embed_batch(server_url, query_list, 0, **kwargs)
+                if error:
+                    return "", json.dumps(index.stats()), error, status_code
+            results = []
+            if query_embeddings is not None:
+                nprobe = kwargs.get("nprobe", 8) if ivf_lists else 0
+                for position, (rows, scores) in enumerate(index.search(query_embeddings, top_k, nprobe)):
+                    results.append({
+                        "query": query_list[position] if position < len(query_list) else position,
+                        "matches": [{"row": int(row), "score": round(float(score), 6), "text": index.text(int(row))}
+                                    for row, score in zip(rows, scores)],
+                    })
+            info = dict(index.stats(), added=added, trained=trained)
+            return json.dumps(results, ensure_ascii=False), json.dumps(info), "", 200
+        except Exception as e:
+            return "", "", f"Error processing index: {str(e)}", 500
+
+
+class LlamaCppBulkTokenizeNode(LlamaCppClientNode):
+    """
+    Tokenizes or detokenizes a whole list concurrently, backed by the shared token cache.
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return cls._task_inputs(
+            {
+                "mode": (["tokenize", "detokenize"], {
+                    "default": "tokenize",
+                    "tooltip": "Texts to token ids, or token ids to texts"
+                }),
+                "items": ("STRING", {
+                    "default": "[]",
+                    "multiline": True,
+                    "tooltip": "tokenize: JSON array of texts or one per line; detokenize: JSON array of token id arrays"
+                }),
+            },
+            {
+                "token_arrays": ("TOKENS", {
+                    "tooltip": "Token id arrays to detokenize (e.g. from another Bulk Tokenize node); replaces `items`"
+                }),
+                "output_format": (["numpy", "array"], {
+                    "default": "numpy",
+                    "tooltip": "Token ids as read-only int32 NumPy arrays or as array('i')"
+                }),
+                "add_special": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Add special tokens (BOS) when tokenizing"
+                }),
+                "parse_special": ("BOOLEAN", {
+                    "default": True,
+                    "tooltip": "Parse special tokens in the texts"
+                }),
+                "batch_concurrency": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 256,
+                    "tooltip": "Requests in flight at once (0 = 16)"
+                }),
+            },
+        )
+    
+    RETURN_TYPES = ("TOKENS", "STRING", "STRING", "STRING", "INT")
+    RETURN_NAMES = ("tokens", "texts", "info", "error", "status_code")
+    FUNCTION = "process_bulk"
+    CATEGORY = "AI/LlamaCpp"
+    
+    @classmethod
+    def IS_CHANGED(cls, server_url: str = "", **kwargs):
+        # Token ids only change with the inputs or the loaded model
+        return cls._input_fingerprint(server_url, kwargs)
+    
+    def process_bulk(self, server_url: str, mode: str, items: str, **kwargs):
+        """Tokenize or detokenize every item and return the token arrays and texts."""
+        try:
+            token_arrays = kwargs.pop("token_arrays", None)
+            output_format = kwargs.pop("output_format", "numpy")
+            if mode == "tokenize":
+                texts = parse_text_list(items)
+                sequences, info, error, status_code = self.tokenize_many(server_url, texts, **kwargs)
+                text_output = ""
+            else:
+                if token_arrays is None:
+                    token_arrays = json.loads(items) if items.strip() else []
+                    if not isinstance(token_arrays, list):
+                        return None, "", "", "items must be a JSON array of token id arrays", 400
+                sequences = [tokens if isinstance(tokens, array) else array("i", [int(t) for t in tokens])
+                             for tokens in token_arrays]
+                texts, info, error, status_code = self.detokenize_many(server_url, sequences, **kwargs)
+                text_output = json.dumps(texts, ensure_ascii=False)
+            return self._token_output(sequences, output_format), text_output, json.dumps(info), error, status_code
+        except Exception as e:
+            return None, "", "", f"Error processing bulk {mode}: {str(e)}", 500
+    
+    @staticmethod
+    def _token_output(sequences: List[Optional[array]], output_format: str) -> List[Any]:
+        """Copies as array('i'), or zero-copy read-only NumPy views of the cached buffers."""
+        output = []
+        for tokens in sequences:
+            if tokens is None:
+                output.append(None)
+            elif output_format == "array":
+                output.append(array("i", tokens))
+            else:
+                view = np.frombuffer(tokens, dtype=np.intc)
+                view.flags.writeable = False
+                output.append(view)
+        return output
+
+
+# Node mappings for ComfyUI
+NODE_CLASS_MAPPINGS = {
+    "LlamaCppClient": LlamaCppClientNode,
+    "LlamaCppBatchEmbeddings": LlamaCppBatchEmbeddingsNode,
+    "LlamaCppConversation": LlamaCppConversationNode,
+    "LlamaCppVectorIndex": LlamaCppVectorIndexNode,
+    "LlamaCppBulkTokenize": LlamaCppBulkTokenizeNode,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "LlamaCppClient": "Llama.cpp Server Client",
+    "LlamaCppBatchEmbeddings": "Llama.cpp Batch Embeddings",
+    "LlamaCppConversation": "Llama.cpp Conversation",
+    "LlamaCppVectorIndex": "Llama.cpp Vector Index",
+    "LlamaCppBulkTokenize": "Llama.cpp Bulk Tokenize",
+}
@@ -0,0 +1,272 @@
+"""Per-request telemetry records, the JSONL log and the Prometheus exporter."""
+
+import contextvars
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, Tuple
+
+from .util import endpoint_path, json_dumps_bytes
+
+
+# Records of the requests made on behalf of the current node execution
+TELEMETRY_RECORDS = contextvars.ContextVar("llamacpp_telemetry_records", default=None)
+# When the current handler started building its payload
+BUILD_STARTED = contextvars.ContextVar("llamacpp_build_started", default=None)
+
+
+class RequestTelemetry:
+    """
+    Client-side phase timings, transfer sizes and server-reported timings of one request.
+    Phases: build, serialize, connect, ttfb (request sent until headers), transfer, parse, total.
+    """
+    
+    def __init__(self, url: str, build_ms: Optional[float] = None):
+        self.started = time.perf_counter()
+        self.phases = {}
+        if build_ms is not None:
+            self.phases["build"] = round(build_ms, 3)
+        self.record = {
+            "timestamp": round(time.time(), 6),
+            "endpoint": endpoint_path(url),
+            "server": None,
+            "transport": None,
+            "status_code": None,
+            "error": "",
+            "cache": "off",
+            "cassette": "off",
+            "coalesced": False,
+            "attempts": 1,
+            "hedged": False,
+            "hedge_won": False,
+            "connection_reused": None,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "ttft_ms": None,
+            "phases_ms": self.phases,
+            "server_timings": None,
+        }
+    
+    def phase(self, name: str, started: float, ms: Optional[float] = None) -> float:
+        """Record phase `name` as the time since `started` (or `ms`); returns the current time."""
+        now = time.perf_counter()
+        self.phases[name] = round(ms if ms is not None else (now - started) * 1000.0, 3)
+        return now
+    
+    def set(self, **fields):
+        self.record.update(fields)
+    
+    def finish(self, result) -> Dict[str, Any]:
+        """Complete the record with the request's outcome."""
+        response, _, error, status_code = result
+        self.phase("total", self.started)
+        self.record["status_code"] = status_code
+        self.record["error"] = error
+        if isinstance(response, dict):
+            timings = response.get("timings")
+            if isinstance(timings, dict):
+                self.record["server_timings"] = timings
+            stream_stats = response.get("stream_stats")
+            if isinstance(stream_stats, dict):
+                self.record["ttft_ms"] = stream_stats.get("ttft_ms")
+        return self.record
+
+
+class TelemetryHub:
+    """
+    Aggregates request telemetry for a Prometheus /metrics endpoint and appends each record
+    to a size-rotated JSONL log.
+    """
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+    HOST = "127.0.0.1"
+    
+    def __init__(self, log_max_bytes: int = 10 * 1024 * 1024, log_backups: int = 3):
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self._lock = threading.Lock()
+        self._requests = {}  # (endpoint, status_code) -> count
+        self._latency = {}  # endpoint -> [bucket counts..., +Inf count, sum]
+        self._phases = {}  # (endpoint, phase) -> [seconds, count]
+        self._totals = {}  # (metric, endpoint) -> value
+        self._loggers = {}
+        self._servers = {}
+        self._sources = {}  # component -> (stats callable, label names of its nested mappings)
+    
+    def add_source(self, component: str, stats, labels: Tuple[str, ...] = ()):
+        """Export the numeric fields of `stats()` as `llamacpp_client_<component>_<field>` gauges."""
+        self._sources[component] = (stats, labels)
+    
+    def configure(self, log_max_mb: Optional[int] = None, port: int = 0):
+        if log_max_mb:
+            self.log_max_bytes = int(log_max_mb) * 1024 * 1024
+        if port:
+            self.serve(port)
+    
+    def observe(self, record: Dict[str, Any], log_path: str = ""):
+        """Add one finished request record to the metrics and, with `log_path`, to the JSONL log."""
+        endpoint = record["endpoint"]
+        phases = record["phases_ms"]
+        timings = record.get("server_timings") or {}
+        with self._lock:
+            key = (endpoint, record["status_code"])
+            self._requests[key] = self._requests.get(key, 0) + 1
+            
+            seconds = phases.get("total", 0.0) / 1000.0
+            latency = self._latency.setdefault(endpoint, [0] * (len(self.BUCKETS) + 1) + [0.0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += 1
+            latency[-1] += seconds
+            
+            for name, ms in phases.items():
+                totals = self._phases.setdefault((endpoint, name), [0.0, 0])
+                totals[0] += ms / 1000.0
+                totals[1] += 1
+            
+            increments = {
+                "bytes_sent": record["bytes_sent"],
+                "bytes_received": record["bytes_received"],
+                "cache_hits": record["cache"] == "hit",
+                "coalesced": record["coalesced"],
+                "prompt_tokens": timings.get("prompt_n", 0),
+                "prompt_seconds": timings.get("prompt_ms", 0.0) / 1000.0,
+                "predicted_tokens": timings.get("predicted_n", 0),
+                "predicted_seconds": timings.get("predicted_ms", 0.0) / 1000.0,
+            }
+            if record.get("ttft_ms") is not None:
+                increments["ttft_seconds"] = record["ttft_ms"] / 1000.0
+                increments["ttft_count"] = 1
+            for metric, value in increments.items():
+                self._totals[(metric, endpoint)] = self._totals.get((metric, endpoint), 0) + value
+        
+        if log_path:
+            self._logger(log_path).info(json_dumps_bytes(record).decode("utf-8"))
+    
+    def _logger(self, path: str) -> logging.Logger:
+        path = os.path.abspath(os.path.expanduser(path))
+        with self._lock:
+            logger = self._loggers.get(path)
+            if logger is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                logger = logging.getLogger(f"llamacpp_client.telemetry.{len(self._loggers)}")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=self.log_max_bytes, backupCount=self.log_backups, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                self._loggers[path] = logger
+            for handler in logger.handlers:
+                handler.maxBytes = self.log_max_bytes
+            return logger
+    
+    def render(self) -> str:
+        """Current metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines.append("# HELP llamacpp_client_requests_total Requests sent to llama-server.")
+            lines.append("# TYPE llamacpp_client_requests_total counter")
+            for (endpoint, status), count in sorted(self._requests.items(), key=str):
+                lines.append(f'llamacpp_client_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            
+            lines.append("# HELP llamacpp_client_request_duration_seconds Client-side request latency.")
+            lines.append("# TYPE llamacpp_client_request_duration_seconds histogram")
+            for endpoint, latency in sorted(self._latency.items()):
+                name = "llamacpp_client_request_duration_seconds"
+                for bound, count in zip(self.BUCKETS, latency):
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {latency[-2]}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {latency[-1]:.6f}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {latency[-2]}')
+            
+            lines.append("# HELP llamacpp_client_phase_seconds Time spent per request phase.")
+            lines.append("# TYPE llamacpp_client_phase_seconds summary")
+            for (endpoint, phase), (seconds, count) in sorted(self._phases.items()):
+                labels = f'endpoint="{endpoint}",phase="{phase}"'
+                lines.append(f"llamacpp_client_phase_seconds_sum{{{labels}}} {seconds:.6f}")
+                lines.append(f"llamacpp_client_phase_seconds_count{{{labels}}} {count}")
+            
+            counters = {
+                "bytes_sent": ("llamacpp_client_sent_bytes_total", "Request body bytes sent."),
+                "bytes_received": ("llamacpp_client_received_bytes_total", "Response body bytes received."),
+                "cache_hits": ("llamacpp_client_cache_hits_total", "Requests answered by the response cache."),
+                "coalesced": ("llamacpp_client_coalesced_total", "Requests that shared an identical in-flight request."),
+                "prompt_tokens": ("llamacpp_server_prompt_tokens_total", "Prompt tokens evaluated by the server."),
+                "prompt_seconds": ("llamacpp_server_prompt_seconds_total", "Server time spent on prompt evaluation."),
+                "predicted_tokens": ("llamacpp_server_predicted_tokens_total", "Tokens generated by the server."),
+                "predicted_seconds": ("llamacpp_server_predicted_seconds_total", "Server time spent generating."),
+                "ttft_seconds": ("llamacpp_client_ttft_seconds_total", "Summed time to first token of streams."),
+                "ttft_count": ("llamacpp_client_ttft_count_total", "Streams with a time to first token."),
+            }
+            for metric, (name, help_text) in counters.items():
+                values = sorted((endpoint, value) for (key, endpoint), value in self._totals.items() if key == metric)
+                if not values:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for endpoint, value in values:
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {float(value):g}')
+        
+        for component, (stats, labels) in sorted(self._sources.items()):
+            samples = {}
+            self._collect(stats(), labels, (), samples)
+            for field, values in samples.items():
+                name = re.sub(r"[^a-zA-Z0-9_]", "_", f"llamacpp_client_{component}_{field}")
+                lines.append(f"# TYPE {name} gauge")
+                for label_pairs, value in values:
+                    label_text = ",".join(f'{label}="{self._escape(str(key))}"' for label, key in label_pairs)
+                    lines.append(f"{name}{{{label_text}}} {float(value):g}" if label_text else f"{name} {float(value):g}")
+        return "\n".join(lines) + "\n"
+    
+    @classmethod
+    def _collect(cls, stats: Dict[str, Any], labels: Tuple[str, ...], label_pairs: tuple, samples: Dict[str, list]):
+        # Each name in `labels` turns one level of nested mappings (per server, per index, ...) into a label
+        if labels:
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    cls._collect(value, labels[1:], label_pairs + ((labels[0], key),), samples)
+            return
+        for field, value in stats.items():
+            if isinstance(value, (bool, int, float)):
+                samples.setdefault(field, []).append((label_pairs, value))
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    
+    def serve(self, port: int):
+        """Serve /metrics on `port` from a daemon thread (once per port)."""
+        with self._lock:
+            if port in self._servers:
+                return
+            hub = self
+            
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?", 1)[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = hub.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                
+                def log_message(self, format, *args):
+                    pass
+            
+            server = ThreadingHTTPServer((self.HOST, port), MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f"llamacpp-metrics-{port}", daemon=True).start()
+            self._servers[port] = server
+
+
+# Shared by all node instances in this process
+TELEMETRY = TelemetryHub()
@@ -0,0 +1,672 @@
+"""HTTP transports for llama-server: pooled requests sessions, the asyncio client, SSE and interrupts."""
+
+import asyncio
+import requests
+import threading
+import time
+import ssl
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .util import json_loads
+
+try:
+    import comfy.model_management as model_management
+except ImportError:
+    # Running outside ComfyUI (tests, benchmark.py): nothing can interrupt a request
+    model_management = None
+
+
+# Connect time of the newest connection the current thread opened, read by request telemetry
+CONNECT_TIMING = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        CONNECT_TIMING.ms = (time.perf_counter() - started) * 1000.0
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        CONNECT_TIMING.ms = (time.perf_counter() - started) * 1000.0
+
+
+# Connections checked out by the current thread's request, closed if the workflow is interrupted
+REQUEST_CONNECTIONS = threading.local()
+
+
+class TrackedPoolMixin:
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        held = getattr(REQUEST_CONNECTIONS, "held", None)
+        if held is not None:
+            held.append(conn)
+        return conn
+
+
+class TimedHTTPConnectionPool(TrackedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(TrackedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+INTERRUPTED_ERROR = "Interrupted"
+# nginx's "client closed request": the workflow was cancelled before the response was complete
+INTERRUPTED_STATUS = 499
+
+
+def interrupt_requested() -> bool:
+    """Whether ComfyUI has been asked to stop the running workflow (always False outside ComfyUI)."""
+    return model_management is not None and model_management.processing_interrupted()
+
+
+class InFlightRequests:
+    """
+    Abort callbacks of the requests waiting on llama-server, fired when ComfyUI is interrupted
+    so the server stops generating and frees the slot.
+    """
+    
+    def __init__(self, poll_interval: float = 0.1):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._aborts = {}
+        self._next_token = 0
+        self._watcher = None
+        self._aborted = 0
+    
+    def register(self, abort) -> int:
+        """Register a callable that tears down one request; returns a token for `unregister()`."""
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._aborts[token] = abort
+            if model_management is not None and self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="llamacpp-interrupt", daemon=True)
+                self._watcher.start()
+        return token
+    
+    def unregister(self, token: int):
+        with self._lock:
+            self._aborts.pop(token, None)
+    
+    def abort_all(self) -> int:
+        """Fire and forget every registered abort callback; returns how many were fired."""
+        with self._lock:
+            aborts = list(self._aborts.values())
+            self._aborts.clear()
+            self._aborted += len(aborts)
+        for abort in aborts:
+            try:
+                abort()
+            except Exception:
+                pass
+        return len(aborts)
+    
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._aborts:
+                    self._watcher = None
+                    return
+            if interrupt_requested():
+                self.abort_all()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"in_flight": len(self._aborts), "aborted": self._aborted}
+
+
+IN_FLIGHT = InFlightRequests()
+
+
+class SessionRegistry:
+    """
+    Process-wide registry of keep-alive HTTP sessions, one per llama-server base URL and pool
+    settings. Sessions are shared by every node instance and thread; idle ones are evicted lazily.
+    """
+    
+    def __init__(self, pool_maxsize: int = 16, keep_alive: bool = True, idle_timeout: float = 300.0):
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}  # (base_url, pool_maxsize, keep_alive) -> [session, last_used]
+        self._closed_stats = {"connections_new": 0, "requests": 0}
+        self._sessions_created = 0
+        self._sessions_evicted = 0
+    
+    def configure(self, pool_maxsize: Optional[int] = None, keep_alive: Optional[bool] = None,
+                  idle_timeout: Optional[float] = None):
+        """Update pool settings for new sessions; sessions with other settings are evicted once idle."""
+        with self._lock:
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if keep_alive is not None:
+                self.keep_alive = keep_alive
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+    
+    def get(self, url: str) -> requests.Session:
+        """Return the shared session for the server that `url` points at."""
+        now = time.monotonic()
+        with self._lock:
+            key = (self.base_url(url), self.pool_maxsize, self.keep_alive)
+            self._evict_idle_locked(now)
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = [self._new_session(), now]
+                self._sessions[key] = entry
+                self._sessions_created += 1
+            entry[1] = now
+            return entry[0]
+    
+    def close(self, url: Optional[str] = None):
+        """Close one server's session, or all of them."""
+        with self._lock:
+            base_url = self.base_url(url) if url else None
+            for key in list(self._sessions):
+                if base_url is None or key[0] == base_url:
+                    self._close_locked(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Connection reuse counters, aggregated and per server."""
+        with self._lock:
+            servers = {}
+            totals = dict(self._closed_stats)
+            for (base_url, _, _), (session, last_used) in self._sessions.items():
+                counts = self._pool_counts(session)
+                idle_seconds = round(time.monotonic() - last_used, 3)
+                server = servers.get(base_url)
+                if server is None:
+                    servers[base_url] = dict(counts, idle_seconds=idle_seconds)
+                else:
+                    # Sessions with older pool settings that are still draining
+                    for name, value in counts.items():
+                        server[name] += value
+                    server["idle_seconds"] = min(server["idle_seconds"], idle_seconds)
+                totals["connections_new"] += counts["connections_new"]
+                totals["requests"] += counts["requests"]
+            totals["connections_reused"] = max(totals["requests"] - totals["connections_new"], 0)
+            totals["sessions_created"] = self._sessions_created
+            totals["sessions_evicted"] = self._sessions_evicted
+            totals["servers"] = servers
+            return totals
+    
+    @staticmethod
+    def base_url(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+    
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=False)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+    
+    def _evict_idle_locked(self, now: float):
+        if self.idle_timeout <= 0:
+            return
+        for key, (_, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout:
+                self._close_locked(key)
+                self._sessions_evicted += 1
+    
+    def _close_locked(self, key: tuple):
+        entry = self._sessions.pop(key, None)
+        if entry is None:
+            return
+        counts = self._pool_counts(entry[0])
+        self._closed_stats["connections_new"] += counts["connections_new"]
+        self._closed_stats["requests"] += counts["requests"]
+        entry[0].close()
+    
+    @staticmethod
+    def _pool_counts(session: requests.Session) -> Dict[str, int]:
+        new_connections = 0
+        request_count = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                new_connections += getattr(pool, "num_connections", 0)
+                request_count += getattr(pool, "num_requests", 0)
+        return {
+            "connections_new": new_connections,
+            "requests": request_count,
+            "connections_reused": max(request_count - new_connections, 0),
+        }
+
+
+# Shared by all node instances in this process
+SESSIONS = SessionRegistry()
+
+
+class EventLoopThread:
+    """
+    One asyncio event loop in a daemon thread, shared by every node in the process.
+    """
+    
+    def __init__(self, blocking_workers: int = 256):
+        self.blocking_workers = blocking_workers
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._executor = None
+    
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(max_workers=self.blocking_workers,
+                                                    thread_name_prefix="llamacpp-blocking")
+                self._loop.set_default_executor(self._executor)
+                self._thread = threading.Thread(target=self._loop.run_forever, name="llamacpp-asyncio",
+                                                daemon=True)
+                self._thread.start()
+            return self._loop
+    
+    def run(self, coro):
+        """Run `coro` on the shared loop and wait for its result."""
+        loop = self.loop
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Synchronous llama-server call made from inside the client event loop")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    
+    async def to_thread(self, fn, *args, **kwargs):
+        """Run a blocking function in the loop's executor."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+
+
+LOOP = EventLoopThread()
+
+
+class AsyncHTTPResponse:
+    """Response of AsyncHTTPClient; the body is read lazily and the connection returned to the pool."""
+    
+    def __init__(self, client, key, reader, writer, status: int, headers: Dict[str, str], read_timeout: float):
+        self._client = client
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.headers = headers
+        self.read_timeout = read_timeout
+        self._consumed = False
+    
+    async def iter_chunks(self):
+        """Yield body bytes as they arrive; a failed read closes the connection."""
+        try:
+            async for data in self._chunks():
+                yield data
+        except BaseException:
+            self.release()
+            raise
+    
+    async def _chunks(self):
+        reader = self._reader
+        timeout = self.read_timeout
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not size_line:
+                    raise ConnectionResetError("Connection closed mid-body")
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if size == 0:
+                    while (await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                data = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                yield data[:-2]
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, 1 << 16)), timeout)
+                if not data:
+                    raise ConnectionResetError("Connection closed mid-body")
+                remaining -= len(data)
+                yield data
+        else:
+            # Body delimited by connection close; the connection cannot be reused
+            self.headers["connection"] = "close"
+            while True:
+                data = await asyncio.wait_for(reader.read(1 << 16), timeout)
+                if not data:
+                    break
+                yield data
+        self._consumed = True
+    
+    async def read(self) -> bytes:
+        parts = []
+        async for chunk in self.iter_chunks():
+            parts.append(chunk)
+        return b"".join(parts)
+    
+    def release(self):
+        """Return the connection to the pool if the body was fully read, otherwise close it."""
+        if self._writer is None:
+            return
+        reusable = self._consumed and self.headers.get("connection", "").lower() != "close"
+        self._client._release(self._key, self._reader, self._writer, reusable)
+        self._writer = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class AsyncHTTPClient:
+    """
+    Minimal HTTP/1.1 client on asyncio streams with per-server keep-alive connection pools.
+    Covers exactly what llama-server needs: JSON requests, Content-Length and chunked bodies.
+    """
+    
+    def __init__(self, pool_maxsize: int = 16, keep_alive: bool = True, idle_timeout: float = 300.0):
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # (scheme, host, port) -> deque of (reader, writer, released_at)
+        self.counters = {"connections_new": 0, "connections_reused": 0, "requests": 0}
+        self._ssl_context = None
+    
+    def configure(self, pool_maxsize: Optional[int] = None, keep_alive: Optional[bool] = None,
+                  idle_timeout: Optional[float] = None):
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+    
+    async def request(self, method: str, url: str, body: bytes = b"", headers: Optional[Dict[str, str]] = None,
+                      connect_timeout: float = 30.0, read_timeout: float = 600.0,
+                      trace: Optional[Dict[str, Any]] = None) -> AsyncHTTPResponse:
+        """Send a request and return once the headers arrived; `trace` receives connect_ms and connection_reused."""
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        lines = [
+            f"{method} {target} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            f"Content-Length: {len(body)}",
+            "Accept-Encoding: identity",
+            f"Connection: {'keep-alive' if self.keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin1")
+        
+        # A pooled connection may have been closed by the server; retry those once on a fresh one
+        for attempt in range(2):
+            connect_started = time.perf_counter()
+            reader, writer, reused = await self._acquire(key, connect_timeout)
+            if trace is not None:
+                trace["connect_ms"] = (time.perf_counter() - connect_started) * 1000.0 if not reused else 0.0
+                trace["connection_reused"] = reused
+            try:
+                writer.write(head + body)
+                await asyncio.wait_for(writer.drain(), read_timeout)
+                status_line = await asyncio.wait_for(reader.readline(), read_timeout)
+                if not status_line:
+                    raise ConnectionResetError("Server closed the connection")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+        
+        self.counters["requests"] += 1
+        try:
+            status = int(status_line.split(b" ", 2)[1])
+            response_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), read_timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            # A timeout, cancellation or malformed response must not leave the socket open
+            writer.close()
+            raise
+        return AsyncHTTPResponse(self, key, reader, writer, status, response_headers, read_timeout)
+    
+    async def _acquire(self, key, connect_timeout: float):
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            reader, writer, released_at = idle.pop()
+            if writer.is_closing() or reader.at_eof() or (self.idle_timeout > 0 and now - released_at > self.idle_timeout):
+                writer.close()
+                continue
+            self.counters["connections_reused"] += 1
+            return reader, writer, True
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context, limit=1 << 20), connect_timeout)
+        self.counters["connections_new"] += 1
+        return reader, writer, False
+    
+    def _release(self, key, reader, writer, reusable: bool):
+        idle = self._idle.setdefault(key, deque())
+        if reusable and self.keep_alive and len(idle) < self.pool_maxsize:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self.counters)
+        stats["idle_connections"] = sum(len(idle) for idle in self._idle.values())
+        return stats
+
+
+# Only ever used from the LOOP thread
+ASYNC_HTTP = AsyncHTTPClient()
+
+
+class SSEDecoder:
+    """
+    Incremental server-sent-events decoder. Feed raw byte chunks as they arrive; each call
+    returns the `data` payloads of the events completed by that chunk.
+    """
+    
+    def __init__(self):
+        self._buffer = b""
+        self._data_lines = []
+    
+    def feed(self, chunk: bytes) -> List[str]:
+        payloads = []
+        buffer = self._buffer + chunk if self._buffer else chunk
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", start)
+            if newline < 0:
+                break
+            line = buffer[start:newline].rstrip(b"\r")
+            start = newline + 1
+            if not line:
+                if self._data_lines:
+                    payloads.append(b"\n".join(self._data_lines).decode("utf-8", errors="replace"))
+                    self._data_lines = []
+            elif line.startswith(b"data:"):
+                self._data_lines.append(line[5:].lstrip(b" "))
+            elif line.startswith(b"error:"):
+                # Older llama-server builds report stream failures on an `error:` line
+                self._data_lines.append(b'{"error": ' + line[6:].strip() + b"}")
+        # Only the unfinished last line is kept, so a chunk holding many lines is not re-copied per line
+        self._buffer = buffer[start:]
+        return payloads
+    
+    def flush(self) -> List[str]:
+        """Payload of a final event that was not followed by a blank line."""
+        tail = self._buffer.strip()
+        self._buffer = b""
+        if tail.startswith(b"data:"):
+            self._data_lines.append(tail[5:].lstrip(b" "))
+        payloads = []
+        if self._data_lines:
+            payloads.append(b"\n".join(self._data_lines).decode("utf-8", errors="replace"))
+            self._data_lines = []
+        return payloads
+
+
+def iter_sse_data(chunks):
+    """Decode a server-sent-events byte stream, yielding each event's data as soon as it completes."""
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        if chunk:
+            yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+class StreamAccumulator:
+    """
+    Folds streamed llama-server events into the shape of a non-streamed response.
+    """
+    
+    def __init__(self, chat: bool = False, started: Optional[float] = None, events: Optional[List[str]] = None):
+        self.chat = chat
+        self.events = events
+        self.started = started if started is not None else time.perf_counter()
+        self.ttft_ms = None
+        self.n_events = 0
+        self.error = None
+        self.done = False
+        self.interrupted = False
+        self._text = []
+        self._reasoning = []
+        self._probs = []
+        self._tool_calls = {}
+        self._final = {}
+        self._finish_reason = None
+        self._role = "assistant"
+    
+    def feed(self, payload: str):
+        """Consume one SSE data payload."""
+        if self.events is not None:
+            self.events.append(payload)
+        if payload.strip() == "[DONE]":
+            self.done = True
+            return
+        try:
+            event = json_loads(payload)
+        except ValueError:
+            return
+        self.n_events += 1
+        if isinstance(event, dict) and "error" in event:
+            self.error = event["error"]
+            self.done = True
+            return
+        if self.chat:
+            self._feed_chat(event)
+        else:
+            self._feed_completion(event)
+    
+    def _mark_token(self, piece: str):
+        if piece and self.ttft_ms is None:
+            self.ttft_ms = (time.perf_counter() - self.started) * 1000.0
+    
+    def _feed_completion(self, event: Dict[str, Any]):
+        piece = event.get("content", "")
+        self._mark_token(piece)
+        if piece:
+            self._text.append(piece)
+        if event.get("completion_probabilities"):
+            self._probs.extend(event["completion_probabilities"])
+        # Keep the metadata of the last event (timings, stop reason, token counts)
+        for key, value in event.items():
+            if key not in ("content", "completion_probabilities"):
+                self._final[key] = value
+        if event.get("stop"):
+            self.done = True
+    
+    def _feed_chat(self, event: Dict[str, Any]):
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            piece = delta.get("content") or ""
+            self._mark_token(piece)
+            if piece:
+                self._text.append(piece)
+            if delta.get("reasoning_content"):
+                self._reasoning.append(delta["reasoning_content"])
+            if delta.get("role"):
+                self._role = delta["role"]
+            for call in delta.get("tool_calls") or []:
+                merged = self._tool_calls.setdefault(call.get("index", 0), {
+                    "id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                if call.get("id"):
+                    merged["id"] = call["id"]
+                function = call.get("function") or {}
+                merged["function"]["name"] += function.get("name") or ""
+                merged["function"]["arguments"] += function.get("arguments") or ""
+            if (choice.get("logprobs") or {}).get("content"):
+                self._probs.extend(choice["logprobs"]["content"])
+            if choice.get("finish_reason"):
+                self._finish_reason = choice["finish_reason"]
+        for key, value in event.items():
+            if key != "choices":
+                self._final[key] = value
+    
+    @property
+    def text(self) -> str:
+        return "".join(self._text)
+    
+    def result(self) -> Dict[str, Any]:
+        """Assemble the final response dict."""
+        result = dict(self._final)
+        if self.chat:
+            message = {"role": self._role, "content": self.text}
+            if self._reasoning:
+                message["reasoning_content"] = "".join(self._reasoning)
+            if self._tool_calls:
+                message["tool_calls"] = [self._tool_calls[i] for i in sorted(self._tool_calls)]
+            choice = {"index": 0, "message": message, "finish_reason": self._finish_reason}
+            if self._probs:
+                choice["logprobs"] = {"content": self._probs}
+            result["object"] = "chat.completion"
+            result["choices"] = [choice]
+        else:
+            result["content"] = self.text
+            if self._probs:
+                result["completion_probabilities"] = self._probs
+        result["stream_stats"] = {
+            "ttft_ms": round(self.ttft_ms, 3) if self.ttft_ms is not None else None,
+            "total_ms": round((time.perf_counter() - self.started) * 1000.0, 3),
+            "events": self.n_events,
+        }
+        if self.interrupted:
+            result["stream_stats"]["interrupted"] = True
+        return result
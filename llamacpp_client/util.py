@@ -0,0 +1,116 @@
+"""JSON, hashing and request-classification helpers shared by the llama.cpp client modules."""
+
+import json
+import contextvars
+import hashlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Union
+from urllib.parse import urlsplit
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """Parse JSON with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps_bytes(obj: Any) -> bytes:
+    """Compact UTF-8 JSON for request bodies, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers wider than 64 bits; the stdlib encoder handles them
+            pass
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def output_is_linked(graph: Any, node_id: Any, output_index: int) -> Optional[bool]:
+    """Whether any node in a ComfyUI prompt graph consumes `output_index` of `node_id` (None if unknown)."""
+    if not isinstance(graph, dict) or node_id is None:
+        return None
+    for node in graph.values():
+        for value in ((node or {}).get("inputs") or {}).values():
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) == str(node_id) and value[1] == output_index:
+                return True
+    return False
+
+
+def canonical_json(obj: Any) -> str:
+    """Serialize `obj` the same way every time, regardless of key order."""
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def canonical_hash(*parts: Any) -> str:
+    """SHA-256 over the canonical JSON form of `parts`."""
+    return hashlib.sha256(canonical_json(parts).encode("utf-8")).hexdigest()
+
+
+# Endpoints whose output depends on sampling, and therefore on `seed`
+GENERATION_PATHS = ("/completion", "/v1/chat/completions", "/infill")
+# Endpoints that evaluate their input in a server slot, replacing what the slot's KV cache held
+SLOT_PATHS = GENERATION_PATHS + ("/v1/embeddings", "/v1/rerank")
+
+
+def endpoint_path(url: str) -> str:
+    return urlsplit(url).path
+
+
+# Request path of each generation endpoint, for deciding determinism from node inputs alone
+ENDPOINT_PATHS = {"completion": "/completion", "chat_completions": "/v1/chat/completions", "infill": "/infill"}
+
+
+def fingerprint_value(value: Any) -> Any:
+    """A JSON-able stand-in for a node input; tensors and arrays are reduced to a content digest."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): fingerprint_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [fingerprint_value(item) for item in value]
+    if hasattr(value, "cpu") and hasattr(value, "numpy"):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, array):
+        value = np.frombuffer(value, dtype=np.intc) if len(value) else np.zeros(0, dtype=np.intc)
+    if isinstance(value, np.ndarray):
+        digest = hashlib.blake2b(np.ascontiguousarray(value).data, digest_size=16).hexdigest()
+        return {"digest": digest, "shape": list(value.shape), "dtype": str(value.dtype)}
+    return repr(value)
+
+
+def is_deterministic(url: str, data: Dict[str, Any]) -> bool:
+    """Whether the same payload is expected to produce the same response."""
+    if endpoint_path(url) not in GENERATION_PATHS:
+        return True
+    if data.get("temperature") is not None and data["temperature"] <= 0:
+        return True
+    return data.get("seed", -1) != -1
+
+
+def parse_text_list(value: Union[str, List[str]]) -> List[str]:
+    """Accept a JSON array of strings or one text per non-empty line."""
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    if value.strip().startswith("["):
+        try:
+            return [str(item) for item in json.loads(value)]
+        except json.JSONDecodeError:
+            pass
+    return [line for line in value.splitlines() if line.strip()]
+
+
+def run_bounded(fn, items: List[Any], concurrency: int) -> List[Any]:
+    """Apply `fn` to every item on at most `concurrency` threads; results keep input order."""
+    if concurrency <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix="llamacpp") as pool:
+        return list(pool.map(lambda context, item: context.run(fn, item), contexts, items))
@@ -0,0 +1,902 @@
+"""
+Offline tests for the LlamaCpp client nodes, run against the stub llama-server from benchmark.py.
+"""
+
+import asyncio
+import json
+import math
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+import llamacpp_client_node as client
+from benchmark import StubLlamaServer
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with StubLlamaServer() as server:
+        yield server
+
+
+def default_inputs(node_class):
+    """Every input of `node_class` that has a default, as ComfyUI would pass it."""
+    inputs = {}
+    spec = node_class.INPUT_TYPES()
+    for section in ("required", "optional"):
+        for name, (kind, *options) in spec.get(section, {}).items():
+            options = options[0] if options else {}
+            if isinstance(kind, list):
+                inputs[name] = options.get("default", kind[0])
+            elif "default" in options:
+                inputs[name] = options["default"]
+    return inputs
+
+
+def patch_shared(monkeypatch, name, value):
+    """Replace a shared object in every client module that imported it."""
+    for module_name, module in list(sys.modules.items()):
+        if (module_name == client.__name__ or module_name.startswith("llamacpp_client.")) and hasattr(module, name):
+            monkeypatch.setattr(module, name, value)
+
+
+def is_nan(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+@pytest.mark.parametrize("name", sorted(client.NODE_CLASS_MAPPINGS))
+def test_is_changed_accepts_default_inputs(stub, name):
+    node_class = client.NODE_CLASS_MAPPINGS[name]
+    inputs = dict(default_inputs(node_class), server_url=stub.url)
+    first = node_class.IS_CHANGED(**inputs)
+    second = node_class.IS_CHANGED(**inputs)
+    assert isinstance(first, str) or is_nan(first)
+    if isinstance(first, str):
+        assert first == second
+
+
+@pytest.mark.parametrize("name", sorted(client.NODE_CLASS_MAPPINGS))
+def test_is_changed_without_server(name):
+    node_class = client.NODE_CLASS_MAPPINGS[name]
+    inputs = dict(default_inputs(node_class), server_url="http://127.0.0.1:9")
+    assert is_nan(node_class.IS_CHANGED(**inputs))
+
+
+def test_is_changed_follows_determinism_and_inputs(stub):
+    inputs = dict(default_inputs(client.LlamaCppClientNode), server_url=stub.url)
+    assert is_nan(client.LlamaCppClientNode.IS_CHANGED(**inputs))
+    inputs["seed"] = 42
+    fixed = client.LlamaCppClientNode.IS_CHANGED(**inputs)
+    assert isinstance(fixed, str)
+    assert client.LlamaCppClientNode.IS_CHANGED(**dict(inputs, prompt="something else")) != fixed
+    # A batch item that samples randomly makes the whole run non-deterministic
+    assert is_nan(client.LlamaCppClientNode.IS_CHANGED(**dict(inputs, batch_prompts='[{"seed": -1}]')))
+
+
+def test_is_changed_has_no_side_effects(stub):
+    inputs = dict(default_inputs(client.LlamaCppClientNode), seed=1, pool_maxsize=3, keep_alive=False,
+                  server_url=f"{stub.url},{stub.url}/=2", context_fit="summarize")
+    settings = (client.SESSIONS.pool_maxsize, client.SESSIONS.keep_alive)
+    balancers = client.BALANCERS.stats()
+    summaries = client.TOKEN_COUNTS.stats()["summaries"]
+    handled = len(stub.handled)
+    client.LlamaCppClientNode.IS_CHANGED(**inputs)
+    assert (client.SESSIONS.pool_maxsize, client.SESSIONS.keep_alive) == settings
+    assert client.BALANCERS.stats() == balancers
+    assert client.TOKEN_COUNTS.stats()["summaries"] == summaries
+    # Only /props (a GET) may have been served
+    assert len(stub.handled) == handled
+
+
+def test_circuit_breaker_states():
+    breakers = client.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    server = "http://replica"
+    breakers.record(server, success=False)
+    assert breakers.state(server) == "closed"
+    breakers.record(server, success=False)
+    assert breakers.state(server) == "open" and not breakers.allow(server)
+    time.sleep(0.06)
+    assert breakers.state(server) == "half_open"
+    assert breakers.allow(server) and not breakers.allow(server)  # exactly one probe
+    breakers.release(server)
+    assert breakers.state(server) == "half_open" and breakers.allow(server)
+    breakers.record(server, success=False)
+    assert breakers.state(server) == "open"
+    time.sleep(0.06)
+    assert breakers.allow(server)
+    breakers.record(server, success=True)
+    assert breakers.state(server) == "closed"
+    assert breakers.stats()[server] == {"state": "closed", "failures": 0, "trips": 1}
+
+
+def test_cancelled_probe_is_not_a_success(stub, monkeypatch):
+    breakers = client.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    patch_shared(monkeypatch, "BREAKERS", breakers)
+    breakers.record(stub.url, success=False)
+    time.sleep(0.06)
+    node = client.LlamaCppClientNode()
+
+    async def cancelled_probe():
+        task = asyncio.ensure_future(node._send_request_async(
+            f"{stub.url}/v1/embeddings", {"input": ["x"]}, options={"transport": "asyncio"}))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    stub.configure(latency_ms=300)
+    try:
+        client.LOOP.run(cancelled_probe())
+    finally:
+        stub.configure(latency_ms=0)
+    assert breakers.stats()[stub.url] == {"state": "half_open", "failures": 1, "trips": 1}
+    assert breakers.allow(stub.url)
+
+
+@pytest.mark.parametrize("transport, on_caller", [("requests", True), ("asyncio", False)])
+def test_only_the_asyncio_transport_enters_the_loop(stub, transport, on_caller):
+    node = client.LlamaCppClientNode()
+    threads = []
+    send_direct, send_async = node._send_direct, node._send_async
+
+    def direct(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return send_direct(*args, **kwargs)
+
+    async def via_loop(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return await send_async(*args, **kwargs)
+
+    node._send_direct, node._send_async = direct, via_loop
+    result = node._make_request(f"{stub.url}/v1/embeddings", {"input": ["x"]},
+                                options={"transport": transport, "coalesce_requests": False})
+    assert result[3] == 200
+    assert (threads == [threading.current_thread()]) is on_caller
+
+
+def test_checkpoint_holds_only_the_prefix(stub, monkeypatch):
+    checkpoints = client.SlotCheckpoints()
+    patch_shared(monkeypatch, "CHECKPOINTS", checkpoints)
+    node = client.LlamaCppClientNode()
+    sent = []
+    make_request = node._make_request_sync
+
+    def recording(url, data, *args, **kwargs):
+        result = make_request(url, data, *args, **kwargs)
+        sent.append((url.split("?action=")[-1] if "/slots/" in url else data, result[3]))
+        return result
+
+    node._make_request_sync = recording
+    options = {"slot_checkpoint": True, "checkpoint_prefix_chars": 16}
+    prompt = "checkpointed prefix, then the question"
+    for question in ("first", "second", "third"):
+        body = {"prompt": f"{prompt} {question}", "n_predict": 3}
+        node._make_request(f"{stub.url}/completion", body, options=options)
+    # A prefix is checkpointed from its second use on
+    first, restore, prefix, save, second, third = sent
+    assert restore == ("restore", 400) and save == ("save", 200)
+    assert prefix[0]["prompt"] == prompt[:16] and prefix[0]["n_predict"] == 0 and "id_slot" in prefix[0]
+    assert first[0]["n_predict"] == second[0]["n_predict"] == third[0]["n_predict"] == 3
+    assert checkpoints.stats()["saved"] == 1 and checkpoints.stats()["already_loaded"] == 1
+
+    # Any other request in that slot replaces the prefix, so the next use restores it
+    node._make_request(f"{stub.url}/completion", {"prompt": "unrelated", "id_slot": prefix[0]["id_slot"]})
+    node._make_request(f"{stub.url}/completion", {"prompt": f"{prompt} fourth", "n_predict": 3}, options=options)
+    assert sent[-2] == ("restore", 200) and checkpoints.stats()["restored"] == 1
+
+
+@pytest.mark.parametrize("message, opens", [("no slot available", False), ("Loading model", False),
+                                             ("upstream gone", True)])
+def test_busy_server_does_not_open_the_circuit(monkeypatch, message, opens):
+    class Busy(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.dumps({"error": {"code": 503, "message": message}}).encode()
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Busy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    breakers = client.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    patch_shared(monkeypatch, "BREAKERS", breakers)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        node = client.LlamaCppClientNode()
+        for _ in range(5):
+            node._make_request(f"{url}/completion", {"prompt": "x"}, options={"max_retries": 0})
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert breakers.state(url) == ("open" if opens else "closed")
+
+
+@pytest.mark.parametrize("transport", ["requests", "asyncio"])
+def test_only_the_asyncio_transport_hedges(stub, monkeypatch, transport):
+    class Latency:
+        def percentile(self, key, percentile):
+            return 0.0
+
+        def observe(self, key, seconds):
+            pass
+
+    patch_shared(monkeypatch, "LATENCY", Latency())
+    with StubLlamaServer() as other:
+        url = client.BALANCERS.resolve(f"{stub.url},{other.url}", "", 0)
+        stub.configure(latency_ms=50)
+        other.configure(latency_ms=50)
+        try:
+            node = client.LlamaCppClientNode()
+            telemetry = client.RequestTelemetry(url)
+            result = client.LOOP.run(node._make_request_async(
+                f"{url}/v1/embeddings", {"input": ["hedge"]},
+                options={"hedge_percentile": 50, "transport": transport}, telemetry=telemetry))
+        finally:
+            stub.configure(latency_ms=0)
+        client.BALANCERS.stop()
+    assert result[3] == 200
+    assert telemetry.record["hedged"] == (transport == "asyncio")
+
+
+@pytest.mark.parametrize("result, unhealthy", [
+    (("", "", "Connection error", 503), True),
+    (("", "", "Request timeout", 408), True),
+    (({"error": {"code": 503, "message": "Loading model", "type": "unavailable_error"}}, "", "", 503), False),
+    (({"error": {"code": 503, "message": "no slot available", "type": "unavailable_error"}}, "", "", 503), False),
+    (("", "<html>503 Service Temporarily Unavailable</html>", "Invalid JSON response", 502), False),
+    (("", "upstream connect error", "Invalid JSON response", 503), True),
+    (({"error": {"code": 429, "message": "busy"}}, "", "", 429), False),
+    (("", "", client.INTERRUPTED_ERROR, client.INTERRUPTED_STATUS), False),
+])
+def test_replica_unhealthy(result, unhealthy):
+    assert client.replica_unhealthy(result) is unhealthy
+
+
+def test_embedding_store_recovers_from_a_crash(tmp_path):
+    store = client.EmbeddingStore(str(tmp_path))
+    a, b, c, stray = (client.EmbeddingStore.content_key(text) for text in ("a", "b", "c", "zzz"))
+    store.add([a, b], np.array([[1, 1], [2, 2]], dtype=np.float32))
+    # Crash after the index write but before the header update: a key without a row
+    with open(store.index_path, "ab") as f:
+        f.write(stray)
+    store = client.EmbeddingStore(str(tmp_path))
+    assert len(store) == 2 and store.lookup([stray]) == [None]
+    store.add([c], np.array([[3, 3]], dtype=np.float32))
+    store = client.EmbeddingStore(str(tmp_path))
+    assert store.lookup([a, b, c, stray]) == [0, 1, 2, None]
+    assert store.vectors([2]).tolist() == [[3, 3]]
+    # Crash after the vector write: a row without a key
+    with open(store.vectors_path, "ab") as f:
+        f.write(np.array([9, 9], dtype="<f4").tobytes())
+    store = client.EmbeddingStore(str(tmp_path))
+    store.add([stray], np.array([[4, 4]], dtype=np.float32))
+    store = client.EmbeddingStore(str(tmp_path))
+    assert store.lookup([c, stray]) == [2, 3]
+    assert store.vectors([0, 1, 2, 3]).tolist() == [[1, 1], [2, 2], [3, 3], [4, 4]]
+    assert np.load(store.vectors_path).shape == (4, 2)
+
+
+def test_cassette_replay_needs_no_network(stub, tmp_path, monkeypatch):
+    history = [{"role": "system", "content": "Be brief."}]
+    for turn in range(6):
+        history += [{"role": "user", "content": f"Question {turn}: " + "word " * 40},
+                    {"role": "assistant", "content": f"Answer {turn}: " + "word " * 40}]
+    history.append({"role": "user", "content": "And now?"})
+    inputs = dict(default_inputs(client.LlamaCppClientNode), server_url=stub.url, endpoint="chat_completions",
+                  seed=7, messages=json.dumps(history), context_fit="summarize", context_budget=200,
+                  keep_recent_turns=1, cassette_mode="record", cassette_path=str(tmp_path / "session.jsonl"))
+    node = client.LlamaCppClientNode()
+    recorded = node.process_request(**inputs)
+    assert recorded[2] == "" and client.TOKEN_COUNTS.stats()["summaries"] >= 1
+
+    # A fresh process with the server gone: nothing may be fetched or memoized already
+    patch_shared(monkeypatch, "TOKEN_COUNTS", client.MessageTokenCounter())
+    patch_shared(monkeypatch, "PROPS", client.ServerPropsCache())
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("replay opened a connection")
+
+    monkeypatch.setattr(socket.socket, "connect", no_network)
+    monkeypatch.setattr(socket.socket, "connect_ex", no_network)
+    replay_inputs = dict(inputs, server_url="http://127.0.0.1:9", cassette_mode="replay")
+    replayed = node.process_request(**replay_inputs)
+    assert replayed[:4] == recorded[:4]
+    assert client.TOKEN_COUNTS.stats()["summaries"] == 1
+    # The recorded /props also identifies the model for ComfyUI's cache
+    assert isinstance(client.LlamaCppClientNode.IS_CHANGED(**replay_inputs), str)
+
+
+def test_replica_set_weights_idle_traffic():
+    heavy, light = client.Replica("http://heavy", 3), client.Replica("http://light", 1)
+    replicas = client.ReplicaSet([heavy, light], health_interval=0)
+    for _ in range(8):
+        replicas.release(replicas.acquire())
+    assert (heavy.requests, light.requests) == (6, 2)
+    # Under load the least busy replica for its weight still wins
+    held = [replicas.acquire() for _ in range(4)]
+    assert (heavy.in_flight, light.in_flight) == (3, 1)
+    for replica in held:
+        replicas.release(replica)
+
+
+def test_replica_set_health_thread_lifecycle(stub):
+    registry = client.LoadBalancerRegistry()
+    spec = f"{stub.url},{stub.url}/=2"
+    url = registry.resolve(spec, "first-key", health_interval=1)
+    replica_set = registry.get(url)
+    # Resolving alone starts no thread; the first routed request does
+    assert replica_set._checker is None
+    replica_set.release(replica_set.acquire())
+    assert replica_set._checker.is_alive()
+    registry.resolve(spec, "second-key", health_interval=1)
+    assert replica_set.api_key == "second-key"
+    registry.stop()
+    replica_set._checker.join(timeout=5)
+    assert not replica_set._checker.is_alive()
+    replica_set.pick()
+    assert replica_set._checker.is_alive()
+    replica_set.idle_stop = 0
+    replica_set._checker.join(timeout=5)
+    assert not replica_set._checker.is_alive()
+
+    # An edited server list leaves the old set idle; the next resolve drops it
+    busy = replica_set.acquire()
+    other_url = registry.resolve(f"{stub.url},{stub.url}/=3", "second-key", health_interval=0)
+    assert registry.get(url) is replica_set
+    replica_set.release(busy)
+    registry.resolve(f"{stub.url},{stub.url}/=3", "second-key", health_interval=0)
+    assert list(registry.stats()) == [other_url[len(registry.SCHEME):]]
+    assert replica_set._stop.is_set()
+
+
+def test_session_settings_do_not_tear_down_sessions(stub):
+    sessions = client.SessionRegistry()
+    small = sessions.get(stub.url)
+    assert small.get(f"{stub.url}/props").status_code == 200
+    sessions.configure(pool_maxsize=4, keep_alive=False)
+    other = sessions.get(stub.url)
+    assert other is not small
+    # A request still holding the old session keeps its pooled connection
+    assert small.get(f"{stub.url}/props").status_code == 200
+    sessions.configure(pool_maxsize=16, keep_alive=True)
+    assert sessions.get(stub.url) is small
+    stats = sessions.stats()
+    assert stats["sessions_created"] == 2 and stats["connections_reused"] >= 1
+
+
+def test_embedding_batches_use_token_counts_and_keep_order(stub):
+    node = client.LlamaCppClientNode()
+    identity = client.PROPS.model_identity(stub.url)
+    text = "an uncached sentence of forty characters"
+    assert node._embedding_tokens(identity, text) == len(text) // 2 + 1
+    client.TOKEN_CACHE.put(client.TokenCache.tokenize_key(identity, text, True, True), client.array("i", [1, 2, 3]))
+    hits = client.TOKEN_CACHE.stats()["hits"]
+    assert node._embedding_tokens(identity, text) == 3
+    assert client.TOKEN_CACHE.stats()["hits"] == hits
+
+    texts = [f"document {i}" for i in range(10)]
+    together, _, error, _ = node.embed_batch(stub.url, texts, 10)
+    apart, info, error_apart, _ = node.embed_batch(stub.url, texts, 3, batch_concurrency=4)
+    assert error == error_apart == "" and info["batches"] == 4
+    assert np.array_equal(together, apart)
+
+
+def test_vector_index_appends_rows_and_survives_reloads(tmp_path):
+    rng = np.random.default_rng(0)
+    index = client.VectorIndex(str(tmp_path))
+    vectors_path = tmp_path / "vectors.npy"
+    index.add([f"text {i}" for i in range(100)], rng.normal(size=(100, 8)))
+    size = vectors_path.stat().st_size
+    index.add([f"text {i}" for i in range(100, 110)], rng.normal(size=(10, 8)))
+    # Appending writes only the new rows; nothing is rewritten
+    assert vectors_path.stat().st_size == size + 10 * 8 * 4
+    index.train(2)
+    index.save()
+    index.add(["late"], rng.normal(size=(1, 8)))
+
+    reloaded = client.VectorIndex(str(tmp_path))
+    assert len(reloaded) == 111 and reloaded.text(110) == "late"
+    assert reloaded.stats()["ivf_lists"] == 2 and reloaded.stats()["memory_mapped"]
+    query = rng.normal(size=(1, 8))
+    assert reloaded.search(query, 5)[0][0].tolist() == index.search(query, 5)[0][0].tolist()
+
+    # A crash after the text append but before the vector header update
+    texts_size = (tmp_path / "texts.jsonl").stat().st_size
+    with open(tmp_path / "texts.jsonl", "ab") as f:
+        f.write(b'"orphan"\n"cut sh')
+    recovered = client.VectorIndex(str(tmp_path))
+    assert len(recovered) == 111 and recovered.missing(["orphan"]) == [0]
+    assert (tmp_path / "texts.jsonl").stat().st_size == texts_size
+    recovered.add(["orphan"], rng.normal(size=(1, 8)))
+    assert client.VectorIndex(str(tmp_path)).text(111) == "orphan"
+
+    fresh = client.VectorIndex(str(tmp_path), reset=True)
+    assert len(fresh) == 0 and len(client.VectorIndex(str(tmp_path))) == 0
+
+
+def test_vector_index_failed_append_leaves_no_keys(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    index = client.VectorIndex(str(tmp_path))
+    index.add(["kept"], rng.normal(size=(1, 8)))
+
+    def full_disk(rows):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(index._store, "write", full_disk)
+    with pytest.raises(OSError):
+        index.add(["lost", "kept"], rng.normal(size=(2, 8)))
+    assert len(index) == 1 and index.missing(["lost", "kept"]) == [0]
+    monkeypatch.undo()
+    assert index.add(["lost"], rng.normal(size=(1, 8))) == 1
+    assert client.VectorIndex(str(tmp_path)).text(1) == "lost"
+
+
+def test_response_cache_hits_misses_and_expires(stub, monkeypatch):
+    cache = client.ResponseCache()
+    patch_shared(monkeypatch, "RESPONSE_CACHE", cache)
+    node = client.LlamaCppClientNode()
+    options = {"response_cache": "deterministic", "cache_ttl": 0.2}
+
+    def generate(api_key="", **body):
+        return client.LOOP.run(node._make_request_async(f"{stub.url}/completion", body, api_key, options=options))
+
+    first = generate(prompt="cached prompt", n_predict=2, seed=1)
+    assert generate(prompt="cached prompt", n_predict=2, seed=1) == first
+    generate(prompt="cached prompt", n_predict=2, seed=2)
+    generate(prompt="cached prompt", n_predict=2, seed=-1)  # not deterministic: bypasses the cache
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2 and cache.stats()["stores"] == 2
+    time.sleep(0.3)
+    assert generate(prompt="cached prompt", n_predict=2, seed=1) == first
+    assert cache.stats()["expirations"] == 1 and cache.stats()["hits"] == 1
+
+    hit = generate(prompt="cached prompt", n_predict=2, seed=1)
+    hit[0]["content"] = "modified by a caller"
+    assert generate(prompt="cached prompt", n_predict=2, seed=1) == first
+    generate(api_key="other key", prompt="cached prompt", n_predict=2, seed=1)
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 4
+
+
+def test_vector_index_exact_and_ivf_search():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(8, 16))
+    vectors = np.repeat(centers, 100, axis=0) + rng.normal(scale=0.2, size=(800, 16))
+    index = client.VectorIndex()
+    index.add([f"text {i}" for i in range(800)], vectors)
+    queries = centers + rng.normal(scale=0.2, size=(8, 16))
+
+    scores = client.VectorIndex.normalize(queries) @ client.VectorIndex.normalize(vectors).T
+    expected = np.argsort(-scores, axis=1)[:, :10]
+    exact = index.search(queries, 10)
+    assert [rows.tolist() for rows, _ in exact] == expected.tolist()
+    assert all(np.all(np.diff(found) <= 0) for _, found in exact)
+
+    index.train(8)
+    assert index.stats()["ivf_lists"] == 8
+    every_list = index.search(queries, 10, nprobe=8)
+    assert [rows.tolist() for rows, _ in every_list] == expected.tolist()
+    nearest = index.search(queries, 10, nprobe=2)
+    recall = np.mean([len(set(rows) & set(truth)) / 10 for (rows, _), truth in zip(nearest, expected)])
+    assert recall >= 0.9
+
+
+@pytest.mark.parametrize("reply, read_body", [
+    (b"HTTP/1.1 200 OK\r\nContent-Le", False),  # headers cut short
+    (b"garbage\r\n\r\n", False),  # no status code
+    (b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n0123456789", True),  # body cut short
+])
+def test_async_http_closes_connection_on_failed_reads(reply, read_body):
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        conn, _ = listener.accept()
+        conn.recv(65536)
+        conn.sendall(reply)
+        time.sleep(0.3)
+        conn.close()
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    http = client.AsyncHTTPClient()
+    writers = []
+    acquire = http._acquire
+
+    async def tracked_acquire(*args):
+        reader, writer, reused = await acquire(*args)
+        writers.append(writer)
+        return reader, writer, reused
+
+    http._acquire = tracked_acquire
+
+    async def exchange():
+        response = await http.request("GET", f"http://127.0.0.1:{listener.getsockname()[1]}/health",
+                                      read_timeout=0.1)
+        assert read_body
+        await response.read()
+
+    with pytest.raises(Exception):
+        client.LOOP.run(exchange())
+    assert writers and writers[0].is_closing()
+    server.join()
+    listener.close()
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_sse_decoder_handles_any_chunking(size):
+    raw = b'data: {"content": "a"}\r\n\r\n' * 50 + b'error: {"code": 500}\n\ndata: [DONE]'
+    decoder = client.SSEDecoder()
+    payloads = []
+    for start in range(0, len(raw), size):
+        payloads += decoder.feed(raw[start:start + size])
+    payloads += decoder.flush()
+    assert payloads == ['{"content": "a"}'] * 50 + ['{"error": {"code": 500}}', "[DONE]"]
+    accumulator = client.StreamAccumulator()
+    for payload in payloads:
+        accumulator.feed(payload)
+    assert accumulator.error == {"code": 500} and accumulator.n_events == 51
+
+
+def test_conversation_appends_turns_and_trims_old_ones(stub, monkeypatch, tmp_path):
+    patch_shared(monkeypatch, "CONVERSATIONS", client.ConversationStore())
+    node = client.LlamaCppConversationNode()
+    sent = []
+    make_request = node._make_request
+
+    def recording(url, data, *args, **kwargs):
+        if url.endswith("/chat/completions"):
+            sent.append(data["messages"])
+        return make_request(url, data, *args, **kwargs)
+
+    node._make_request = recording
+    inputs = {"system_message": "be brief", "max_tokens": 2, "conversation_dir": str(tmp_path)}
+    for message in ("one", "two", "three"):
+        response, history, info, error, status_code = node.converse(stub.url, "talk", message, **inputs)
+        assert status_code == 200 and response == "tok0 tok1 "
+    # Each prompt starts with the previous one and its reply, byte for byte
+    prompts = [client.json_dumps_bytes(messages) for messages in sent]
+    assert all(later.startswith(earlier[:-1]) for earlier, later in zip(prompts, prompts[1:]))
+    assert json.loads(info)["messages"] == 7
+    assert client.ConversationStore().get("talk", str(tmp_path)).messages == json.loads(history)
+
+    trim = dict(inputs, context_fit="drop", context_budget=1, keep_recent_turns=1)
+    _, history, info, _, status_code = node.converse(stub.url, "talk", "four", **trim)
+    assert status_code == 200 and sent[-1] == [{"role": "system", "content": "be brief"},
+                                               {"role": "user", "content": "four"}]
+    assert [message["role"] for message in json.loads(history)] == ["system", "user", "assistant"]
+    assert client.ConversationStore().get("talk", str(tmp_path)).messages == json.loads(history)
+
+
+def test_conversation_fails_over_to_another_replica(monkeypatch):
+    breakers = client.CircuitBreaker(failure_threshold=1)
+    patch_shared(monkeypatch, "BREAKERS", breakers)
+    patch_shared(monkeypatch, "BALANCERS", client.LoadBalancerRegistry())
+    patch_shared(monkeypatch, "CONVERSATIONS", client.ConversationStore())
+    node = client.LlamaCppConversationNode()
+    with StubLlamaServer() as first, StubLlamaServer() as second:
+        spec = f"{first.url},{second.url}"
+        inputs = {"max_tokens": 2, "health_interval": 0}
+        _, _, info, _, status_code = node.converse(spec, "failover", "hello", **inputs)
+        bound = json.loads(info)["server"]
+        assert status_code == 200 and bound in (first.url, second.url)
+
+        breakers.record(bound, success=False)
+        _, history, info, error, status_code = node.converse(spec, "failover", "still there?", **inputs)
+        assert status_code == 200 and not error
+        assert json.loads(info)["server"] != bound and len(json.loads(history)) == 4
+        assert client.CONVERSATIONS.stats()["failover"]["server"] == json.loads(info)["server"]
+
+
+@pytest.mark.parametrize("chunk_tokens, overlap", [(4, 1), (16, 0), (16, 5), (200, 3)])
+def test_token_chunks_cover_the_text_with_overlap(stub, chunk_tokens, overlap):
+    node = client.LlamaCppClientNode()
+    # The stub has one token per byte, so token offsets are character offsets
+    text = " ".join(f"word{i:02d}" for i in range(40))
+    chunks = list(node.iter_token_chunks(stub.url, text, chunk_tokens, overlap, segment_tokens=8,
+                                         batch_concurrency=2))
+    stride = chunk_tokens - overlap
+    assert [start for _, start, _ in chunks] == list(range(0, stride * len(chunks), stride))
+    assert all(end - start == chunk_tokens for _, start, end in chunks[:-1])
+    assert all(chunk == text[start:end] for chunk, start, end in chunks)
+    assert chunks[-1][2] == len(text) and chunks[-1][2] - chunks[-1][1] > overlap
+
+    # A tail that is only the overlap of the last window is not a chunk of its own
+    assert [chunk for chunk, _, _ in node.iter_token_chunks(stub.url, "abcdefghij", 4, 1)] == ["abcd", "defg", "ghij"]
+
+
+def test_chunked_embeddings_stream_into_the_store(stub, tmp_path):
+    node = client.LlamaCppClientNode()
+    texts = ["alpha " * 30, "beta " * 7]
+    matrix, info, error, _ = node.embed_chunked(stub.url, texts, 64, 8, embedding_store_dir=str(tmp_path))
+    assert not error and matrix.shape == (len(info["chunks"]), stub.embedding_dim)
+    assert all(set(chunk) == {"text", "tokens"} for chunk in info["chunks"])
+    chunk_texts = [texts[chunk["text"]][slice(*chunk["tokens"])] for chunk in info["chunks"]]
+    expected, _, _, _ = node.embed_batch(stub.url, chunk_texts)
+    assert np.array_equal(matrix, expected)
+    again, info, _, _ = node.embed_chunked(stub.url, texts, 64, 8, embedding_store_dir=str(tmp_path))
+    assert np.array_equal(again, expected) and info["store_hits"] == len(chunk_texts)
+
+
+@pytest.mark.parametrize("transport", ["requests", "asyncio"])
+def test_batched_rerank_matches_one_unchunked_call(stub, transport):
+    node = client.LlamaCppClientNode()
+    documents = [("apple " if i % 3 == 0 else "pear ") + "x" * i for i in range(50)]
+    kwargs = {"documents": json.dumps(documents), "top_n": 12, "model": "stub", "transport": transport}
+    queries = ["apple pie", "ripe pear"]
+    whole, _, error, _ = node._process_batch(stub.url, "reranking", "", queries, kwargs)
+    stub.configure()
+    merged, _, merged_error, _ = node._process_batch(stub.url, "reranking", "", queries,
+                                                     dict(kwargs, rerank_batch_size=7))
+    assert not error and not merged_error
+    assert len(stub.handled) == len(queries) * 8
+    for single, chunked in zip(whole, merged):
+        assert len(chunked["results"]) == 12
+        assert [(r["index"], r["relevance_score"]) for r in chunked["results"]] == \
+            [(r["index"], r["relevance_score"]) for r in single["results"]]
+
+
+def test_slot_affinity_pins_shared_prefixes(stub, monkeypatch):
+    affinity = client.PrefixAffinity()
+    patch_shared(monkeypatch, "AFFINITY", affinity)
+    node = client.LlamaCppClientNode()
+    slots = []
+    send_direct = node._send_direct
+
+    def recording(url, data, *args, **kwargs):
+        slots.append(data.get("id_slot"))
+        return send_direct(url, data, *args, **kwargs)
+
+    node._send_direct = recording
+    options = {"slot_affinity": True, "affinity_prefix_chars": 64}
+    history = [{"role": "system", "content": "shared instructions"}, {"role": "user", "content": "hi"}]
+    for question in ("one", "two", "three"):
+        node._make_request(f"{stub.url}/v1/chat/completions",
+                           {"messages": history + [{"role": "user", "content": question}]}, options=options)
+    node._make_request(f"{stub.url}/completion", {"prompt": "a different prefix"}, options=options)
+    assert slots == [0, 0, 0, 1]
+    assert affinity.stats()["assigned"] == 2 and affinity.stats()["table_hits"] == 2
+
+    # Completion and chat timings: prompt tokens minus the ones the server had to process
+    fresh = client.PrefixAffinity()
+    fresh.observe({"timings": {"prompt_n": 10}, "tokens_evaluated": 40})
+    fresh.observe({"timings": {"prompt_n": 60}, "usage": {"prompt_tokens": 60}})
+    fresh.observe("not a response")
+    assert fresh.stats()["prompt_tokens"] == 100 and fresh.stats()["kv_reuse_rate"] == 0.3
+
+
+@pytest.mark.parametrize("transport", ["requests", "asyncio"])
+def test_batch_keeps_item_order_and_reports_item_errors(stub, transport):
+    node = client.LlamaCppClientNode()
+    # The first item finishes last and the second one times out
+    items = [{"prompt": "slow", "n_predict": 12}, {"prompt": "stuck", "n_predict": 60, "timeout": 0.15},
+             {"prompt": "fast", "n_predict": 1}, "plain prompt"]
+    inputs = dict(default_inputs(client.LlamaCppClientNode), server_url=stub.url, seed=3, n_predict=2,
+                  transport=transport, batch_prompts=json.dumps(items), batch_concurrency=4)
+    stub.configure(token_rate=100)
+    try:
+        responses, raw_response, error, status_code, _ = client.LlamaCppClientNode().process_request(**inputs)
+        # The stub keeps generating the timed-out item; let it finish before the next test counts requests
+        deadline = time.monotonic() + 5
+        while len(stub.handled) < len(items) and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        stub.configure(token_rate=0)
+    assert [response["tokens_predicted"] if response else None for response in responses] == [12, None, 1, 2]
+    assert error == "1 of 4 requests failed" and status_code == 408
+    entries = json.loads(raw_response)
+    assert [entry["index"] for entry in entries] == [0, 1, 2, 3]
+    assert [entry["status_code"] for entry in entries] == [200, 408, 200, 200]
+    assert entries[1]["error"] == "Request timeout" and not entries[0]["error"]
+
+
+@pytest.mark.parametrize("transport", ["requests", "asyncio"])
+def test_identical_requests_in_flight_are_sent_once(stub, monkeypatch, transport):
+    single_flight = client.SingleFlight()
+    patch_shared(monkeypatch, "SINGLE_FLIGHT", single_flight)
+    node = client.LlamaCppClientNode()
+    body = {"prompt": f"coalesced over {transport}", "n_predict": 2, "seed": 5}
+    results = []
+
+    def send():
+        results.append(node._make_request(f"{stub.url}/completion", body, options={"transport": transport}))
+
+    stub.configure(latency_ms=200)
+    try:
+        threads = [threading.Thread(target=send) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        handled = len(stub.handled)
+    finally:
+        stub.configure(latency_ms=0)
+    assert handled == 1 and all(result == results[0] for result in results)
+    assert single_flight.stats() == {"leaders": 1, "shared": 4, "in_flight": 0}
+
+
+def test_raw_response_modes_and_linked_output(stub):
+    node = client.LlamaCppClientNode()
+    inputs = dict(default_inputs(client.LlamaCppClientNode), server_url=stub.url, endpoint="tokenize",
+                  prompt="raw text")
+    linked = {"5": {"inputs": {}}, "7": {"inputs": {"text": ["5", 1]}}}
+    unlinked = {"5": {"inputs": {}}, "7": {"inputs": {"text": ["5", 0]}}}
+
+    def raw_output(mode, graph=None):
+        response, raw_response, error, _, _ = node.process_request(
+            **dict(inputs, raw_response_mode=mode, graph_prompt=graph, unique_id="5"))
+        assert not error
+        return response, raw_response
+
+    response, raw_response = raw_output("auto", linked)
+    # The server's own text, not a re-serialization
+    assert raw_response == json.dumps(response)
+    assert raw_output("auto", unlinked)[1] == ""
+    assert raw_output("auto")[1] == raw_response  # graph unknown: keep it
+    assert raw_output("raw", unlinked)[1] == raw_response
+    assert raw_output("pretty")[1] == json.dumps(response, indent=2, ensure_ascii=False)
+    assert raw_output("off", linked)[1] == ""
+    assert client.output_is_linked(linked, 5, 1) and client.output_is_linked(unlinked, "5", 1) is False
+
+
+def test_image_encoder_memoizes_frames():
+    encoder = client.ImageEncoder(workers=2)
+    rng = np.random.default_rng(0)
+    frames = rng.random((3, 40, 60, 3), dtype=np.float32)
+    frames[2] = frames[0]
+    first = encoder.encode(frames, max_size=32)
+    assert len(first) == 3 and first[2] == first[0]
+    assert encoder.stats()["encoded"] + encoder.stats()["hits"] == 3 and encoder.stats()["cached_images"] == 2
+    hits = encoder.stats()["hits"]
+    assert encoder.encode(frames[1], max_size=32) == [first[1]]
+    assert encoder.stats()["hits"] == hits + 1
+    # Other encoding settings are other cache entries
+    png = encoder.encode(frames[:1], max_size=32, image_format="PNG")
+    assert png != first[:1] and encoder.stats()["cached_images"] == 3
+
+    small = client.ImageEncoder(max_cache_bytes=1)
+    small.encode(frames[:2])
+    assert small.stats()["cached_images"] == 1
+
+
+def test_telemetry_output_log_and_metrics(stub, monkeypatch, tmp_path):
+    hub = client.TelemetryHub()
+    patch_shared(monkeypatch, "TELEMETRY", hub)
+    log_path = tmp_path / "telemetry.jsonl"
+    inputs = dict(default_inputs(client.LlamaCppClientNode), server_url=stub.url, prompt="measured", n_predict=3,
+                  seed=1, telemetry_log=str(log_path))
+    *_, telemetry = client.LlamaCppClientNode().process_request(**inputs)
+    record, = json.loads(telemetry)["requests"]
+    assert record["endpoint"] == "/completion" and record["status_code"] == 200
+    assert record["bytes_sent"] > 0 and record["bytes_received"] > 0
+    assert {"serialize", "ttfb", "parse", "total"} <= set(record["phases_ms"])
+    assert record["server_timings"]["predicted_n"] == 3
+    assert json.loads(log_path.read_text().splitlines()[-1]) == record
+
+    metrics = hub.render()
+    assert 'llamacpp_client_requests_total{endpoint="/completion",status="200"} 1' in metrics
+    assert 'llamacpp_client_request_duration_seconds_count{endpoint="/completion"} 1' in metrics
+    assert 'llamacpp_server_predicted_tokens_total{endpoint="/completion"} 3' in metrics
+
+    # The log rotates at its size bound and keeps `log_backups` old files
+    small = client.TelemetryHub(log_max_bytes=2 * len(json.dumps(record)), log_backups=2)
+    rotated = tmp_path / "rotated.jsonl"
+    for _ in range(10):
+        small.observe(record, str(rotated))
+    assert sorted(path.name for path in tmp_path.glob("rotated.jsonl*")) == [
+        "rotated.jsonl", "rotated.jsonl.1", "rotated.jsonl.2"]
+    assert 'status="200"} 10' in small.render()
+
+
+@pytest.mark.parametrize("transport", ["requests", "asyncio"])
+def test_interrupt_returns_the_partial_stream(stub, monkeypatch, transport):
+    interrupted = threading.Event()
+    patch_shared(monkeypatch, "interrupt_requested", interrupted.is_set)
+    node = client.LlamaCppClientNode()
+    body = {"prompt": f"interrupted over {transport}", "n_predict": 200, "stream": True}
+
+    def interrupt():
+        time.sleep(0.3)
+        interrupted.set()
+        client.IN_FLIGHT.abort_all()
+
+    disconnects = stub.disconnects
+    stub.configure(token_rate=100)
+    try:
+        threading.Thread(target=interrupt).start()
+        response, _, error, status_code = node._make_request(f"{stub.url}/completion", body,
+                                                             options={"transport": transport})
+        # The server notices the closed connection and stops generating
+        deadline = time.monotonic() + 5
+        while stub.disconnects == disconnects and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        stub.configure(token_rate=0)
+    assert error == "Interrupted" and status_code == 499
+    assert response["content"].startswith("tok0 tok1 ") and len(response["content"].split()) < 200
+    assert stub.disconnects == disconnects + 1
+    assert client.IN_FLIGHT.stats()["in_flight"] == 0
+
+
+def test_fit_messages_drops_whole_old_turns(stub, monkeypatch):
+    patch_shared(monkeypatch, "TOKEN_COUNTS", client.MessageTokenCounter())
+    node = client.LlamaCppClientNode()
+    per_message = 40 + client.CHAT_MESSAGE_OVERHEAD
+
+    def message(role, turn):
+        return {"role": role, "content": f"{role} {turn} ".ljust(40, ".")}
+
+    messages = [message("system", 0)]
+    for turn in range(5):
+        messages.append(message("user", turn))
+        if turn == 1:
+            # A tool result belongs to the turn of the call
+            messages.append(message("tool", turn))
+        messages.append(message("assistant", turn))
+    kwargs = {"context_budget": 6 * per_message, "keep_recent_turns": 2, "context_fit": "drop"}
+
+    stub.configure()
+    fitted = node._fit_messages(stub.url, messages, kwargs)
+    # Turns 0-2 go, oldest first; the tool result leaves with its turn
+    assert fitted == [messages[0]] + messages[-4:]
+    assert len(stub.handled) == len(messages)
+
+    # Recent turns are kept even when they do not fit
+    assert node._fit_messages(stub.url, messages, dict(kwargs, context_budget=per_message)) == fitted
+    # A grown conversation only tokenizes its new message
+    stub.configure()
+    assert node._fit_messages(stub.url, messages + [message("user", 5)], kwargs)[-1]["content"].startswith("user 5")
+    assert len(stub.handled) == 1
+    assert node._fit_messages(stub.url, messages[:3], kwargs) == messages[:3]
+
+
+def test_bulk_tokenize_round_trip_and_token_cache(stub, monkeypatch):
+    patch_shared(monkeypatch, "TOKEN_CACHE", client.TokenCache())
+    node = client.LlamaCppBulkTokenizeNode()
+    inputs = dict(default_inputs(client.LlamaCppBulkTokenizeNode), server_url=stub.url)
+    texts = ["alpha", "beta", "alpha", "gamma"]
+
+    def bulk(**overrides):
+        return node.process_bulk(**dict(inputs, **overrides))
+
+    stub.configure()
+    tokens, _, info, error, status_code = bulk(mode="tokenize", items=json.dumps(texts))
+    assert not error and status_code == 200
+    # Duplicates are requested once
+    assert len(stub.handled) == 3 and json.loads(info)["requested"] == 3
+    assert [len(ids) for ids in tokens] == [5, 4, 5, 5] and tokens[0].dtype == np.intc
+    assert not tokens[0].flags.writeable and np.array_equal(tokens[0], tokens[2])
+
+    _, texts_out, _, error, _ = bulk(mode="detokenize", token_arrays=tokens)
+    assert not error and json.loads(texts_out) == texts
+
+    # Everything is cached now; the array format hands out independent copies
+    stub.configure()
+    arrays, _, info, _, _ = bulk(mode="tokenize", items="\n".join(texts), output_format="array")
+    assert len(stub.handled) == 0 and json.loads(info)["cached"] == 4
+    assert [ids.tolist() for ids in arrays] == [ids.tolist() for ids in tokens]
+    arrays[0][0] = 0
+    assert tokens[0][0] != 0
+    texts_again, _, error, _ = node.detokenize_many(stub.url, [ids.tolist() for ids in tokens[:2]])
+    assert not error and texts_again == texts[:2] and len(stub.handled) == 0
+
+
+def test_component_counters_are_exported_as_metrics(stub):
+    client.LlamaCppClientNode()._make_request(f"{stub.url}/tokenize", {"content": "counted"}, options={})
+    metrics = client.TELEMETRY.render()
+    assert "# TYPE llamacpp_client_sessions_connections_reused gauge" in metrics
+    assert "llamacpp_client_single_flight_in_flight 0" in metrics
+    assert "llamacpp_client_response_cache_db_path" not in metrics
+
+    hub = client.TelemetryHub()
+    hub.add_source("replica", lambda: {"a1": {'http://x"y': {"healthy": True, "in_flight": 2, "url": "x"}}},
+                   ("balancer", "replica"))
+    assert hub.render().endswith('llamacpp_client_replica_in_flight{balancer="a1",replica="http://x\\"y"} 2\n')
+    assert 'llamacpp_client_replica_healthy{balancer="a1",replica="http://x\\"y"} 1' in hub.render()
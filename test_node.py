@@ -23,7 +23,7 @@ def test_node():
     # Test 1: Basic completion
     print("\n1. Testing basic completion...")
     try:
-        response, raw_response, error, status_code = node.process_request(
+        response, raw_response, error, status_code, telemetry = node.process_request(
             server_url=server_url,
             endpoint="completion",
             prompt="Hello, how are you?",
@@ -48,7 +48,7 @@ def test_node():
     # Test 2: Chat completions
     print("\n2. Testing chat completions...")
     try:
-        response, raw_response, error, status_code = node.process_request(
+        response, raw_response, error, status_code, telemetry = node.process_request(
             server_url=server_url,
             endpoint="chat_completions",
             prompt="",  # Empty prompt as it's not used for chat_completions
@@ -83,7 +83,7 @@ def test_node():
     # Test 3: Tokenization
     print("\n3. Testing tokenization...")
     try:
-        response, raw_response, error, status_code = node.process_request(
+        response, raw_response, error, status_code, telemetry = node.process_request(
             server_url=server_url,
             endpoint="tokenize",
             prompt="",  # Empty prompt as we use content parameter
@@ -113,7 +113,7 @@ def test_node():
     # Test 4: Advanced sampling
     print("\n4. Testing advanced sampling parameters...")
     try:
-        response, raw_response, error, status_code = node.process_request(
+        response, raw_response, error, status_code, telemetry = node.process_request(
             server_url=server_url,
             endpoint="completion",
             prompt="Write a creative sentence:",